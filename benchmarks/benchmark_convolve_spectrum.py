@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+#    This file is part of iSpec.
+#    Copyright Sergi Blanco-Cuaresma - http://www.blancocuaresma.com/s/
+#
+#    iSpec is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    iSpec is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with iSpec. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Time the compiled convolution kernel used by ispec.convolve_spectrum. If a git
+revision is given, the kernel from ispec/spectrum_c.pyx at that revision is
+compiled in a temporary directory and compared with the current one.
+
+    python benchmarks/benchmark_convolve_spectrum.py [number_of_points] [git_revision]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import subprocess
+import numpy as np
+
+ispec_dir = os.path.dirname(os.path.realpath(__file__)) + "/../"
+sys.path.insert(0, os.path.abspath(ispec_dir))
+import ispec
+from ispec import spectrum_c
+
+
+def load_kernel(revision, tmp_dir):
+    import pyximport
+    source = subprocess.check_output(["git", "show", "{}:ispec/spectrum_c.pyx".format(revision)], cwd=ispec_dir)
+    with open(os.path.join(tmp_dir, "reference_spectrum_c.pyx"), "wb") as pyx:
+        pyx.write(source)
+    sys.path.insert(0, tmp_dir)
+    pyximport.install(setup_args={'include_dirs':[np.get_include()]}, build_dir=tmp_dir)
+    import reference_spectrum_c
+    return reference_spectrum_c.convolve_spectrum
+
+
+def best_of(function, repeat=3):
+    timings = []
+    for i in range(repeat):
+        tcheck = time.time()
+        result = function()
+        timings.append(time.time() - tcheck)
+    return np.min(timings), result
+
+
+if __name__ == '__main__':
+    number_of_points = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    revision = sys.argv[2] if len(sys.argv) > 2 else None
+    waveobs = np.linspace(370., 1050., number_of_points)
+    flux = np.random.uniform(0.5, 1.0, number_of_points)
+    err = flux / 100.
+    resolution = 47000.
+    current, (_, current_flux, current_err) = best_of(lambda: spectrum_c.convolve_spectrum(waveobs, flux, err, resolution))
+    print("Current kernel: {} points at R={:.0f} in {:.3f} s".format(number_of_points, resolution, current))
+    if revision is not None:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            reference_convolve_spectrum = load_kernel(revision, tmp_dir)
+            reference, (_, reference_flux, reference_err) = best_of(lambda: reference_convolve_spectrum(waveobs, flux, err, resolution))
+            print("Kernel at {}: {:.3f} s | speedup x{:.1f} | max abs. flux difference {:.2e}".format(revision, reference, reference/current, np.max(np.abs(reference_flux - current_flux))))
+        finally:
+            shutil.rmtree(tmp_dir)
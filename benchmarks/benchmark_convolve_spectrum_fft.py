@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+#
+#    This file is part of iSpec.
+#    Copyright Sergi Blanco-Cuaresma - http://www.blancocuaresma.com/s/
+#
+#    iSpec is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    iSpec is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with iSpec. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Accuracy and timing report of ispec.convolve_spectrum(..., method="fft") with
+respect to the direct kernel, for a synthetic spectrum with random absorption
+lines sampled every 'wave_step' nm.
+
+    python benchmarks/benchmark_convolve_spectrum_fft.py [wave_step]
+"""
+import os
+import sys
+import time
+import numpy as np
+
+ispec_dir = os.path.dirname(os.path.realpath(__file__)) + "/../"
+sys.path.insert(0, os.path.abspath(ispec_dir))
+import ispec
+
+
+def synthetic_spectrum(wave_base, wave_top, wave_step, number_of_lines=20000, seed=42):
+    random_state = np.random.RandomState(seed)
+    waveobs = np.arange(wave_base, wave_top, wave_step)
+    flux = np.ones(len(waveobs))
+    line_sigma = 0.004 # nm
+    half_window = int(10*line_sigma/wave_step)
+    for line_center in random_state.uniform(wave_base, wave_top, number_of_lines):
+        center = int((line_center - wave_base)/wave_step)
+        window = slice(max(center-half_window, 0), center+half_window)
+        flux[window] -= random_state.uniform(0.05, 0.8) * np.exp(-(waveobs[window]-line_center)**2/(2*line_sigma**2))
+    flux[flux < 0.01] = 0.01
+    return ispec.create_spectrum_structure(waveobs, flux, flux/100.)
+
+
+if __name__ == '__main__':
+    wave_step = float(sys.argv[1]) if len(sys.argv) > 1 else 0.001
+    spectrum = synthetic_spectrum(370., 1050., wave_step)
+    # Ignore the borders (the behaviour of both methods differs there)
+    inner = slice(100, -100)
+    print("{} points sampled every {} nm".format(len(spectrum), wave_step))
+    print("{:>8} {:>12} {:>12} {:>14} {:>14}".format("R", "direct (s)", "fft (s)", "max |diff|", "rms diff"))
+    for resolution in (5000, 20000, 47000, 80000, 115000):
+        tcheck = time.time()
+        direct = ispec.convolve_spectrum(spectrum, resolution, method="direct")
+        direct_elapsed = time.time() - tcheck
+        tcheck = time.time()
+        fft = ispec.convolve_spectrum(spectrum, resolution, method="fft")
+        fft_elapsed = time.time() - tcheck
+        diff = np.abs(direct['flux'] - fft['flux'])[inner]
+        print("{:>8} {:>12.3f} {:>12.3f} {:>14.2e} {:>14.2e}".format(resolution, direct_elapsed, fft_elapsed, np.max(diff), np.sqrt(np.mean(diff**2))))
@@ -0,0 +1,98 @@
+#!/usr/bin/env python
+#
+#    This file is part of iSpec.
+#    Copyright Sergi Blanco-Cuaresma - http://www.blancocuaresma.com/s/
+#
+#    iSpec is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    iSpec is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with iSpec. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Benchmark of the construction of the convolved reference grid by
+precompute_synthetic_grid for grids of increasing size (up to 5000 nodes by
+default). The radiative transfer code is replaced by an analytical spectrum
+so that only the grid bookkeeping, the broadening and the writing of the
+convolved grid are measured. The time per node should stay constant.
+For comparison, the previous assembly of the rows with np.vstack is also
+timed (it grows quadratically).
+
+    python benchmarks/benchmark_convolved_grid.py [max_number_of_nodes] [number_of_processes]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import logging
+import numpy as np
+from unittest import mock
+
+ispec_dir = os.path.dirname(os.path.realpath(__file__)) + "/../"
+sys.path.insert(0, os.path.abspath(ispec_dir))
+sys.path.insert(0, os.path.join(os.path.abspath(ispec_dir), "ispec", "tests"))
+import ispec
+from test_atmospheres import _create_model_atmospheres
+
+def fake_generate_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, *args, **kwargs):
+    return 1. - (teff/10000.) * np.exp(-(waveobs - 517.5)**2 / (2*(0.01*(1.+logg))**2))
+
+def grid_ranges(number_of_nodes, random_state):
+    # Unique reference points inside the fake model atmospheres grid
+    points = set()
+    while len(points) < number_of_nodes:
+        points.add((random_state.randint(4000, 5500), round(random_state.uniform(1., 3.), 2), round(random_state.uniform(-1., 0.), 2), round(random_state.uniform(0., 0.4), 2)))
+    ranges = np.recarray((number_of_nodes,),  dtype=[('teff', int), ('logg', float), ('MH', float), ('alpha', float), ('vmic', float)])
+    for i, (teff, logg, MH, alpha) in enumerate(sorted(points)):
+        ranges[i] = (teff, logg, MH, alpha, 1.0)
+    return ranges
+
+def vstack_assembly(number_of_nodes, number_of_pixels):
+    reference_grid = None
+    flux = np.ones(number_of_pixels)
+    for i in range(number_of_nodes):
+        if reference_grid is None:
+            reference_grid = flux
+        else:
+            reference_grid = np.vstack((reference_grid, flux))
+    return reference_grid
+
+if __name__ == '__main__':
+    max_number_of_nodes = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    number_of_processes = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    logging.getLogger().setLevel(logging.WARNING)
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        model = os.path.join(tmp_dir, "ATLAS9.Test")
+        _create_model_atmospheres(model)
+        modeled_layers_pack = ispec.load_modeled_layers_pack(model)
+        wavelengths = np.arange(515., 520., 0.005)
+        random_state = np.random.RandomState(42)
+        print("{:>8} {:>14} {:>14} {:>16} {:>16}".format("nodes", "precompute (s)", "per node (ms)", "vstack only (s)", "per node (ms)"))
+        for number_of_nodes in (max_number_of_nodes//4, max_number_of_nodes//2, max_number_of_nodes):
+            ranges = grid_ranges(number_of_nodes, random_state)
+            output_dirname = os.path.join(tmp_dir, "grid_{}".format(number_of_nodes))
+            with open(os.devnull, "w") as devnull:
+                stdout, sys.stdout = sys.stdout, devnull
+                try:
+                    with mock.patch('ispec.synth.common.generate_spectrum', side_effect=fake_generate_spectrum):
+                        tcheck = time.time()
+                        ispec.precompute_synthetic_grid(output_dirname, ranges, wavelengths, 20000, modeled_layers_pack, None, None, None, number_of_processes=number_of_processes)
+                        elapsed = time.time() - tcheck
+                finally:
+                    sys.stdout = stdout
+            tcheck = time.time()
+            vstack_assembly(number_of_nodes, len(wavelengths))
+            vstack_elapsed = time.time() - tcheck
+            print("{:>8} {:>14.2f} {:>14.3f} {:>16.2f} {:>16.3f}".format(number_of_nodes, elapsed, 1000.*elapsed/number_of_nodes, vstack_elapsed, 1000.*vstack_elapsed/number_of_nodes))
+            shutil.rmtree(output_dirname)
+    finally:
+        shutil.rmtree(tmp_dir)
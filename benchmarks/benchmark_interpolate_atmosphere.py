@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+#
+#    This file is part of iSpec.
+#    Copyright Sergi Blanco-Cuaresma - http://www.blancocuaresma.com/s/
+#
+#    iSpec is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    iSpec is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with iSpec. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Micro-benchmark of the interpolation of model atmospheres: previous
+implementation (one LinearNDInterpolator per field built from the simplex
+vertices) versus the barycentric weights from the Delaunay triangulation,
+reading the nodes from disk and from memory (preload=True). A small grid of
+fake model atmospheres is created in a temporary directory.
+
+    python benchmarks/benchmark_interpolate_atmosphere.py [number_of_targets]
+"""
+import os
+import sys
+import time
+import shutil
+import tempfile
+import numpy as np
+
+ispec_dir = os.path.dirname(os.path.realpath(__file__)) + "/../"
+sys.path.insert(0, os.path.abspath(ispec_dir))
+sys.path.insert(0, os.path.join(os.path.abspath(ispec_dir), "ispec", "tests"))
+import ispec
+from ispec.atmospheres import _interpolate
+from test_atmospheres import _create_model_atmospheres, _reference_interpolate
+
+
+def time_targets(function, targets):
+    tcheck = time.time()
+    results = [function(target) for target in targets]
+    return (time.time() - tcheck) / len(targets), results
+
+
+if __name__ == '__main__':
+    number_of_targets = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        model = os.path.join(tmp_dir, "ATLAS9.Benchmark")
+        _create_model_atmospheres(model, teffs=np.arange(3500., 7001., 250.), loggs=np.arange(0., 5.1, 0.5), MHs=(-2., -1.5, -1., -0.5, 0., 0.5), alphas=(0., 0.2, 0.4))
+        random_state = np.random.RandomState(42)
+        targets = [[random_state.uniform(3500., 7000.), random_state.uniform(0., 5.), random_state.uniform(-2., 0.5), random_state.uniform(0., 0.4)] for i in range(number_of_targets)]
+
+        existing_points, free_parameters, filenames, read_point_value, value_fields, delaunay_triangulations, kdtree, ranges, base_dirname = ispec.load_modeled_layers_pack(model)
+        reference, reference_results = time_targets(lambda target: _reference_interpolate(delaunay_triangulations, existing_points, filenames, read_point_value, value_fields, target), targets)
+        current, current_results = time_targets(lambda target: _interpolate(delaunay_triangulations, kdtree, existing_points, filenames, read_point_value, value_fields, target), targets)
+        store = ispec.load_modeled_layers_pack(model, preload=True)[3]
+        preloaded, preloaded_results = time_targets(lambda target: _interpolate(delaunay_triangulations, kdtree, existing_points, filenames, store, value_fields, target), targets)
+
+        max_difference = 0.
+        for expected, interpolated, preloaded_interpolated in zip(reference_results, current_results, preloaded_results):
+            for field in value_fields:
+                max_difference = max(max_difference, np.max(np.abs(interpolated[field] - expected[field]) / np.abs(expected[field])))
+                max_difference = max(max_difference, np.max(np.abs(preloaded_interpolated[field] - expected[field]) / np.abs(expected[field])))
+        print("{} models, {} targets".format(len(existing_points), number_of_targets))
+        print("LinearNDInterpolator per field: {:.2f} ms/target".format(reference*1000))
+        print("Barycentric weights (disk):     {:.2f} ms/target".format(current*1000))
+        print("Barycentric weights (memory):   {:.2f} ms/target".format(preloaded*1000))
+        print("Max relative difference: {:.2e}".format(max_difference))
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+#
+#    This file is part of iSpec.
+#    Copyright Sergi Blanco-Cuaresma - http://www.blancocuaresma.com/s/
+#
+#    iSpec is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    iSpec is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with iSpec. If not, see <http://www.gnu.org/licenses/>.
+#
+"""
+Compare the chunked plain text reader used by ispec.read_spectrum with the
+previous implementation (list comprehension + temporary file for gzip).
+
+    python benchmarks/benchmark_read_spectrum.py [number_of_points]
+"""
+import os
+import sys
+import gzip
+import time
+import shutil
+import tempfile
+import numpy as np
+
+ispec_dir = os.path.dirname(os.path.realpath(__file__)) + "/../"
+sys.path.insert(0, os.path.abspath(ispec_dir))
+import ispec
+
+
+def legacy_read_spectrum(spectrum_filename):
+    if spectrum_filename[-3:].lower() == ".gz":
+        tmp_spec = tempfile.mktemp()
+        f_out = open(tmp_spec, 'wb')
+        f_in = gzip.open(spectrum_filename, 'rb')
+        f_out.writelines(f_in)
+        f_out.close()
+        f_in.close()
+        spectrum = legacy_read_spectrum(tmp_spec)
+        os.remove(tmp_spec)
+        return spectrum
+    return np.array([tuple(line.rstrip('\r\n').split("\t")) for line in open(spectrum_filename,)][1:], dtype=[('waveobs', float),('flux', float),('err', float)])
+
+
+def best_of(function, filename, repeat=3):
+    timings = []
+    for i in range(repeat):
+        tcheck = time.time()
+        function(filename)
+        timings.append(time.time() - tcheck)
+    return np.min(timings)
+
+
+if __name__ == '__main__':
+    number_of_points = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        waveobs = np.linspace(370., 1050., number_of_points)
+        flux = np.random.uniform(0.5, 1.5, number_of_points)
+        err = flux / 100.
+        spectrum = ispec.create_spectrum_structure(waveobs, flux, err)
+        for filename in ("spectrum.txt", "spectrum.txt.gz"):
+            filename = os.path.join(tmp_dir, filename)
+            ispec.write_spectrum(spectrum, filename)
+            legacy = best_of(legacy_read_spectrum, filename)
+            current = best_of(lambda f: ispec.read_spectrum(f, apply_filters=False, sort=False), filename)
+            print("{}: {} points | legacy {:.3f} s | current {:.3f} s | speedup x{:.1f}".format(os.path.basename(filename), number_of_points, legacy, current, legacy/current))
+    finally:
+        shutil.rmtree(tmp_dir)
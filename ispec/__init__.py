@@ -37,6 +37,7 @@ from .abundances import enhance_solar_abundances
 from .abundances import determine_abundance_enchancements
 from .abundances import create_free_abundances_structure
 from .atmospheres import interpolate_atmosphere_layers
+from .atmospheres import interpolate_atmosphere_layers_batch
 from .atmospheres import load_modeled_layers_pack
 from .atmospheres import valid_atmosphere_target
 from .atmospheres import write_atmosphere
@@ -57,12 +58,14 @@ from .common import save_results
 from .common import restore_results
 from .common import mkdir_p
 from .spectrum import read_spectrum
+from .spectrum import read_spectra
 from .spectrum import write_spectrum
 from .spectrum import normalize_spectrum
 from .spectrum import estimate_snr
 from .spectrum import convolve_spectrum
 from .spectrum import create_spectrum_structure
 from .spectrum import resample_spectrum
+from .spectrum import resample_spectra
 from .spectrum import correct_velocity
 from .spectrum import correct_velocity_regions
 from .spectrum import add_noise
@@ -106,11 +109,15 @@ from .modeling.ew import model_spectrum_from_ew
 from .modeling.ssf import model_spectrum
 from .synth.common import generate_fundamental_spectrum
 from .synth.common import generate_spectrum
+from .synth.cache import SynthesisCache
 from .synth.effects import apply_post_fundamental_effects
+from .synth.effects import post_fundamental_effects_derivatives
 from .synth.spectrum import calculate_theoretical_ew_and_depth
 from .synth.grid import load_spectral_grid
 from .synth.grid import valid_interpolated_spectrum_target
 from .synth.grid import precompute_synthetic_grid
 from .synth.grid import estimate_initial_ap
+from .synth.grid import estimate_initial_ap_candidates
+from .synth.grid import build_convolved_grid_index
 from . import log
 import logging
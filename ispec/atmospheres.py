@@ -29,10 +29,14 @@ import subprocess
 import shutil
 import pandas as pd
 from astropy.io import fits
+import scipy
 from scipy import spatial
-from scipy.interpolate import LinearNDInterpolator
 import glob
-from .common import is_turbospectrum_support_enabled, is_spectrum_support_enabled
+import json
+import itertools
+import hashlib
+from collections import OrderedDict
+from .common import is_turbospectrum_support_enabled, is_spectrum_support_enabled, mkdir_p
 
 # SPECTRUM is compatible only with the plane-parallel atmospheres.
 # The first layer represents the surface.
@@ -47,6 +51,128 @@ class ConstantValue(object):
     def __call__(self, x, y):
         return self.value
 
+class ModelNodeStore(object):
+    """ Values of the grid nodes (i.e. model atmospheres) kept in memory to
+        avoid reading the same files every time an interpolation is done.
+
+        - preload=True: all the nodes are read at once into a contiguous
+          (n_models, n_layers, n_fields) float64 array (all the models should
+          have the same number of layers).
+        - preload=False: nodes are read when they are needed and the last
+          'cache_size' used nodes are kept in memory.
+
+        It can be called with a filename (like the original 'read_point_value')
+        and it returns a record array with the value fields. """
+    def __init__(self, filenames, read_point_value, value_fields, preload=False, cache_size=256):
+        self.filenames = np.asarray(filenames)
+        self.read_point_value = read_point_value
+        self.value_fields = list(value_fields)
+        self.cache_size = cache_size
+        self.indices = dict((filename, i) for i, filename in enumerate(self.filenames))
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self.data = None
+        if preload:
+            nodes = [self.__read(i) for i in range(len(self.filenames))]
+            if len(set([node.shape for node in nodes])) > 1:
+                raise Exception("Models do not have the same number of layers, they cannot be preloaded")
+            self.data = np.ascontiguousarray(nodes, dtype=float)
+
+    def __read(self, i):
+        return _node_value(self.read_point_value(self.filenames[i]), self.value_fields)
+
+    def node(self, i):
+        """ (n_layers, n_fields) array for the node in position 'i' """
+        if self.data is not None:
+            return self.data[i]
+        if i in self._cache:
+            self.hits += 1
+            self._cache.move_to_end(i)
+            return self._cache[i]
+        self.misses += 1
+        value = self.__read(i)
+        self._cache[i] = value
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+        return value
+
+    def values(self, indices):
+        """ (len(indices), n_layers, n_fields) array for the nodes in the given positions """
+        if self.data is not None:
+            return self.data[indices]
+        return np.asarray([self.node(i) for i in indices])
+
+    def __call__(self, filename):
+        return _value_to_records(self.node(self.indices[filename]), self.value_fields)
+
+def _node_value(value, value_fields):
+    """
+    Value of a grid node (i.e. FITS table or record array) as a
+    (n_layers, n_fields) float array.
+    """
+    return np.column_stack([np.asarray(value[field], dtype=float) for field in value_fields])
+
+def _value_to_records(value, value_fields):
+    return np.rec.fromarrays(np.asarray(value).T, names=value_fields)
+
+class RegularGrid(object):
+    """ Multilinear interpolation for grids whose nodes are placed in a
+        rectilinear mesh (i.e. all the combinations of the unique values of
+        every parameter), possibly with some missing nodes (holes).
+
+        The cell that contains a target is found with a searchsorted per
+        parameter and the 2**ndim corners are combined with multilinear weights.
+        Cells with missing corners (that have a non-zero weight) are not
+        resolved, Delaunay triangulations should be used for them. """
+    def __init__(self, existing_points):
+        existing_points = np.asarray(existing_points, dtype=float)
+        self.axes = [np.unique(existing_points[:, i]) for i in range(existing_points.shape[1])]
+        self.shape = np.array([len(axis) for axis in self.axes])
+        # Position of every node in the existing points (-1 for holes)
+        self.nodes = -np.ones(tuple(self.shape), dtype=int)
+        positions = tuple(np.searchsorted(axis, existing_points[:, i]) for i, axis in enumerate(self.axes))
+        self.nodes[positions] = np.arange(len(existing_points))
+        self.filling = np.sum(self.nodes >= 0) / float(self.nodes.size)
+        # Offsets of the corners of a cell
+        self.offsets = np.array(list(itertools.product((0, 1), repeat=len(self.axes))))
+
+    def is_complete(self):
+        return self.filling == 1.
+
+    def is_rectilinear(self, min_filling=0.5):
+        """ True if most of the mesh has existing nodes """
+        return self.filling >= min_filling
+
+    def cells(self, target_points):
+        """
+        For every target, positions in the existing points of the corners of the
+        cell that contains it (2**ndim) and their weights. The last returned
+        array indicates the targets that can be interpolated (in range and
+        without missing corners), otherwise weights are zero.
+        """
+        target_points = np.atleast_2d(np.asarray(target_points, dtype=float))
+        ntargets = len(target_points)
+        lower = np.zeros(target_points.shape, dtype=int)
+        fraction = np.zeros(target_points.shape)
+        inside = np.ones(ntargets, dtype=bool)
+        for i, axis in enumerate(self.axes):
+            values = target_points[:, i]
+            if len(axis) == 1:
+                inside = np.logical_and(inside, values == axis[0])
+                continue
+            inside = np.logical_and(inside, np.logical_and(values >= axis[0], values <= axis[-1]))
+            lower[:, i] = np.clip(np.searchsorted(axis, values, side='right') - 1, 0, len(axis)-2)
+            fraction[:, i] = (values - axis[lower[:, i]]) / (axis[lower[:, i]+1] - axis[lower[:, i]])
+        corners = np.minimum(lower[:, np.newaxis, :] + self.offsets[np.newaxis, :, :], self.shape - 1)
+        weights = np.prod(np.where(self.offsets[np.newaxis, :, :] == 1, fraction[:, np.newaxis, :], 1. - fraction[:, np.newaxis, :]), axis=2)
+        node_indices = self.nodes[tuple(np.moveaxis(corners, 2, 0))]
+        missing = np.logical_and(node_indices < 0, weights > 0)
+        found = np.logical_and(inside, ~np.any(missing, axis=1))
+        node_indices[node_indices < 0] = 0
+        weights[~found] = 0.
+        return node_indices, weights, found
+
 def valid_atmosphere_target(modeled_layers_pack, target):
     """
     Checks if the objectif teff, logg and metallicity can be obtained by using the loaded model
@@ -73,31 +199,23 @@ def valid_atmosphere_target(modeled_layers_pack, target):
             return False
     return True
 
-def __closest(kdtree, existing_points, filenames, read_point_value, target_point):
+def _interpolation_nodes(delaunay_triangulations, kdtree, existing_points, target_point):
     """
-    If there is no model in the extreme points, copy the closest one.
     input:
     - existing_points: points in the parameters space such as [( 3000.,  3.5,  0.  ,  0. ), ( 3000.,  3.5,  0.25,  0. ), ...]
     - target_point: parameters for the target model
     output:
-    - created extreme points such as [(3000, 0.0, -5.0, 0.0), (3000, 0.0, -5.0, 0.40000000000000002),]
-    """
-    distance, index = kdtree.query(target_point, k=1)
-    closest_existing_point = existing_points[index]
-    closest_existing_point_filename = filenames[index]
-    value = read_point_value(closest_existing_point_filename)
-    logging.info("Closest to target point '{}' is '{}'".format(" ".join(map(str, target_point)), " ".join(map(str, closest_existing_point))))
-    return value
-
-def _interpolate(delaunay_triangulations, kdtree, existing_points, filenames, read_point_value, value_fields, target_point):
-    """
-    input:
-    - existing_points: points in the parameters space such as [( 3000.,  3.5,  0.  ,  0. ), ( 3000.,  3.5,  0.25,  0. ), ...]
-    - read_point_value: function to read the value from the model filename
-    - target_point: parameters for the target model
-    output:
-    - interpolated value
+    - positions in the existing points of the nodes to be combined and their weights
+    - closest: True if the target point cannot be interpolated, then only the
+      closest node is returned (if there is no model in the extreme points,
+      the closest one is copied)
     """
+    regular_grid = delaunay_triangulations.get('regular_grid')
+    if regular_grid is not None:
+        node_indices, weights, found = regular_grid.cells(target_point)
+        if found[0]:
+            # Multilinear interpolation with the corners of the cell (only the ones that contribute)
+            return node_indices[0][weights[0] > 0], weights[0][weights[0] > 0], False
     target_point_cannot_be_interpolated = True
     for subset, delaunay_triangulation in zip(delaunay_triangulations['subsets'], delaunay_triangulations['precomputed']):
         if delaunay_triangulation is None:
@@ -108,30 +226,53 @@ def _interpolate(delaunay_triangulations, kdtree, existing_points, filenames, re
             break
     if target_point_cannot_be_interpolated:
         logging.warning("Target point '{}' is out of bound, using the closest".format(" ".join(map(str, target_point))))
-        return __closest(kdtree, existing_points, filenames, read_point_value, target_point)
-    index = delaunay_triangulation.simplices[simplex]
-    points = []
-    values = {}
-    for point, filename in zip(existing_points[subset][index], filenames[subset][index]):
-        value = read_point_value(filename)
-        points.append(point.tolist())
-        for field in value_fields:
-            if field not in values:
-                values[field] = value[field]
-            else:
-                values[field] = np.vstack((values[field], value[field]))
-    #
-    interpolated_values = None
-    for field in value_fields:
-        interpolator = LinearNDInterpolator(points, values[field])
-        interpolated_value = interpolator((target_point))[0]
-        if interpolated_values is None:
-            interpolated_values = pd.DataFrame(interpolated_value, columns=[field])
-        else:
-            interpolated_values[field] = interpolated_value
-    return interpolated_values.to_records(index=False)
+        distance, index = kdtree.query(target_point, k=1)
+        logging.info("Closest to target point '{}' is '{}'".format(" ".join(map(str, target_point)), " ".join(map(str, existing_points[index]))))
+        return np.array([index]), np.ones(1), True
+    # Linear interpolation: weighted sum of the values of the simplex vertices
+    index = np.ravel(delaunay_triangulation.simplices[simplex])
+    weights = _barycentric_weights(delaunay_triangulation, np.ravel(simplex)[0], target_point)
+    return np.where(subset)[0][index], weights, False
+
+def _interpolate(delaunay_triangulations, kdtree, existing_points, filenames, read_point_value, value_fields, target_point):
+    """
+    input:
+    - existing_points: points in the parameters space such as [( 3000.,  3.5,  0.  ,  0. ), ( 3000.,  3.5,  0.25,  0. ), ...]
+    - read_point_value: function to read the value from the model filename
+    - target_point: parameters for the target model
+    output:
+    - interpolated value
+    """
+    node_indices, weights, closest = _interpolation_nodes(delaunay_triangulations, kdtree, existing_points, target_point)
+    if closest:
+        return read_point_value(filenames[node_indices[0]])
+    # All the fields at once
+    return __weighted_sum(node_indices, weights, filenames, read_point_value, value_fields)
+
+def __weighted_sum(node_indices, weights, filenames, read_point_value, value_fields):
+    """
+    Combine the values of the given nodes (positions in the existing points).
+    """
+    if isinstance(read_point_value, ModelNodeStore):
+        # Nodes are already in memory
+        values = read_point_value.values(node_indices)
+    else:
+        values = [_node_value(read_point_value(filename), value_fields) for filename in filenames[node_indices]]
+    interpolated_value = np.tensordot(weights, values, axes=1)
+    return _value_to_records(interpolated_value, value_fields)
+
 
 
+def _barycentric_weights(delaunay_triangulation, simplex, target_point):
+    """
+    Weights of the vertices of a simplex (same order as in 'simplices') to
+    linearly interpolate the target point, from the affine transformation
+    precomputed by the Delaunay triangulation.
+    """
+    ndim = delaunay_triangulation.ndim
+    transform = delaunay_triangulation.transform[simplex]
+    barycentric = transform[:ndim].dot(np.asarray(target_point, dtype=float) - transform[ndim])
+    return np.append(barycentric, 1. - np.sum(barycentric))
 
 def interpolate_atmosphere_layers(modeled_layers_pack, target, code="spectrum"):
     """
@@ -158,9 +299,7 @@ def interpolate_atmosphere_layers(modeled_layers_pack, target, code="spectrum"):
         target_point.append(target[param])
     interpolated_atm = _interpolate(delaunay_triangulations, kdtree, existing_points, filenames, read_point_value, value_fields, target_point)
 
-    compatible_fields = ["rhox", "temperature", "pgas", "xne", "abross", "accrad", "vturb", "logtau5", "depth", "pelectron"]
-    if "MARCS" in base_dirname:
-        compatible_fields.append("radius")
+    compatible_fields = __compatible_fields(base_dirname)
     #interpolated_atm_compatible_format = interpolated_atm[compatible_fields]
     try:
         interpolated_atm_compatible_format = pd.DataFrame(interpolated_atm)[compatible_fields].to_records(index=False)
@@ -168,7 +307,7 @@ def interpolate_atmosphere_layers(modeled_layers_pack, target, code="spectrum"):
         # Pandas raises exception when interpolated_atm is a FITS table read with astropy (case where there wasn't an interpolation but just the closest point was read)
         #  - ValueError: Big-endian buffer not supported on little-endian compiler
         # Bytes should be swapped and FITS converted to numpy array:
-        interpolated_atm_compatible_format = pd.DataFrame(np.array(interpolated_atm.byteswap().newbyteorder()))[compatible_fields].to_records(index=False)
+        interpolated_atm_compatible_format = pd.DataFrame(np.array(interpolated_atm.byteswap().view(interpolated_atm.dtype.newbyteorder())))[compatible_fields].to_records(index=False)
     interpolated_atm_compatible_format = interpolated_atm_compatible_format.view(float).reshape(interpolated_atm_compatible_format.shape + (-1,))
     # SME fails if it is not a np.ndarray (it does not accept views either)
     # built like this:
@@ -176,6 +315,102 @@ def interpolate_atmosphere_layers(modeled_layers_pack, target, code="spectrum"):
     return interpolated_atm_compatible_format_ndarray
 
 
+def interpolate_atmosphere_layers_batch(modeled_layers_pack, targets, code="spectrum", chunk_size=1000):
+    """
+    Generates interpolated atmospheres for many teff, logg, metallicity (and
+    alpha) targets at once. The simplices of all the targets are found together
+    and the model atmospheres are combined with their barycentric weights in bulk.
+    Targets that are in range but out of the convex hull of the existing models
+    (i.e. holes in the grid) get a copy of the closest model.
+
+    :param modeled_layers_pack:
+        Output from load_modeled_layers_pack (all the models should have the same number of layers)
+    :type modeled_layers_pack: array
+
+    :param targets:
+        List of dictionaries (same format as for interpolate_atmosphere_layers)
+        or 2D array with one target per row and one column per free parameter
+        (in the same order as in the pack)
+
+    :returns:
+        Interpolated model atmospheres in a (n_targets, n_layers, n_fields) array,
+        each one in the same format as interpolate_atmosphere_layers
+    """
+    code = code.lower()
+    if code not in ['spectrum', 'turbospectrum', 'moog', 'width', 'synthe', 'sme']:
+        raise Exception("Unknown radiative transfer code: %s" % (code))
+
+    existing_points, free_parameters, filenames, read_point_value, value_fields, delaunay_triangulations, kdtree, ranges, base_dirname = modeled_layers_pack
+
+    if len(targets) > 0 and isinstance(targets[0], dict):
+        target_points = np.array([[target[param] for param in free_parameters] for target in targets], dtype=float)
+    else:
+        target_points = np.atleast_2d(np.asarray(targets, dtype=float))
+    if target_points.shape[1] != len(free_parameters):
+        raise Exception("Targets should have {} parameters: {}".format(len(free_parameters), ", ".join(free_parameters)))
+    for target_point in target_points:
+        target = dict(zip(free_parameters, target_point))
+        if not valid_atmosphere_target(modeled_layers_pack, target):
+            raise Exception("Target parameters '{}' are out of range.".format(target))
+
+    if not isinstance(read_point_value, ModelNodeStore):
+        # Read every needed model only once
+        read_point_value = ModelNodeStore(filenames, read_point_value, value_fields, cache_size=len(filenames))
+
+    # Global position of the simplex vertices (or cell corners) and their weights for every target
+    ntargets = len(target_points)
+    ndim = len(free_parameters)
+    regular_grid = delaunay_triangulations.get('regular_grid')
+    nvertices = ndim+1 if regular_grid is None else max(ndim+1, 2**ndim)
+    node_indices = np.zeros((ntargets, nvertices), dtype=int)
+    weights = np.zeros((ntargets, nvertices))
+    pending = np.ones(ntargets, dtype=bool)
+    if regular_grid is not None:
+        cell_node_indices, cell_weights, found = regular_grid.cells(target_points)
+        node_indices[found, :cell_weights.shape[1]] = cell_node_indices[found]
+        weights[found, :cell_weights.shape[1]] = cell_weights[found]
+        pending[found] = False
+    for subset, delaunay_triangulation in zip(delaunay_triangulations['subsets'], delaunay_triangulations['precomputed']):
+        if delaunay_triangulation is None or not np.any(pending):
+            continue
+        pending_indices = np.where(pending)[0]
+        simplices = delaunay_triangulation.find_simplex(target_points[pending_indices])
+        found = simplices != -1
+        pending_indices = pending_indices[found]
+        simplices = simplices[found]
+        transform = delaunay_triangulation.transform[simplices]
+        barycentric = np.einsum('nij,nj->ni', transform[:, :ndim, :], target_points[pending_indices] - transform[:, ndim, :])
+        weights[pending_indices, :ndim+1] = np.hstack((barycentric, 1. - np.sum(barycentric, axis=1)[:, np.newaxis]))
+        node_indices[pending_indices, :ndim+1] = np.where(subset)[0][delaunay_triangulation.simplices[simplices]]
+        pending[pending_indices] = False
+
+    if np.any(pending):
+        # Out of the convex hull: copy the closest model
+        logging.warning("{} target points are out of bound, using the closest".format(np.sum(pending)))
+        distances, closest = kdtree.query(target_points[pending], k=1)
+        node_indices[pending, 0] = closest
+        weights[pending] = 0.
+        weights[pending, 0] = 1.
+
+    compatible_fields = __compatible_fields(base_dirname)
+    compatible_columns = [value_fields.index(field) for field in compatible_fields]
+    nlayers = read_point_value.node(node_indices[0, 0]).shape[0]
+    interpolated_atms = np.zeros((ntargets, nlayers, len(compatible_columns)))
+    for start in range(0, ntargets, chunk_size):
+        chunk = slice(start, start+chunk_size)
+        try:
+            values = np.asarray([read_point_value.values(indices)[:, :, compatible_columns] for indices in node_indices[chunk]])
+        except ValueError:
+            raise Exception("Models do not have the same number of layers, use interpolate_atmosphere_layers")
+        interpolated_atms[chunk] = np.einsum('nk,nklf->nlf', weights[chunk], values)
+    return interpolated_atms
+
+def __compatible_fields(base_dirname):
+    compatible_fields = ["rhox", "temperature", "pgas", "xne", "abross", "accrad", "vturb", "logtau5", "depth", "pelectron"]
+    if "MARCS" in base_dirname:
+        compatible_fields.append("radius")
+    return compatible_fields
+
 def write_atmosphere(atmosphere_layers, teff, logg, MH, atmosphere_filename=None, code='spectrum', tmp_dir=None):
     """
     Write a model atmosphere to file
@@ -286,6 +521,9 @@ def model_atmosphere_is_closest_copy(modeled_layers_pack, target):
     target_point = []
     for param in free_parameters:
         target_point.append(target[param])
+    regular_grid = delaunay_triangulations.get('regular_grid')
+    if regular_grid is not None and regular_grid.cells(target_point)[2][0]:
+        return False
     target_point_cannot_be_interpolated = None
     for delaunay_triangulation in delaunay_triangulations['precomputed']:
         if delaunay_triangulation is None:
@@ -299,7 +537,174 @@ def model_atmosphere_is_closest_copy(modeled_layers_pack, target):
 
 
 
-def load_modeled_layers_pack(input_path):
+# Version of the format used to cache Delaunay triangulations (change it if
+# the stored arrays change, old caches will be recomputed)
+_TRIANGULATION_CACHE_VERSION = 2
+_TRIANGULATION_CACHE_DIRNAME = "triangulation_cache"
+# Arrays that define a scipy Delaunay triangulation (attributes)
+_DELAUNAY_ARRAYS = ["_points", "simplices", "neighbors", "equations", "coplanar", "good", "_transform"]
+_DELAUNAY_SCALARS = ["paraboloid_scale", "paraboloid_shift", "nsimplex", "ndim", "npoints", "furthest_site"]
+
+def __file_hash(filename):
+    sha1 = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024*1024), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+def __library_versions():
+    return {'scipy': scipy.__version__, 'numpy': np.__version__}
+
+def __save_triangulations(cache_dirname, key, delaunay_triangulations):
+    """
+    Save the arrays of the Delaunay triangulations as .npy files in a new
+    directory (files that other processes may have memory mapped are never
+    overwritten) and then replace the index (with the key and that directory)
+    so that an interrupted or concurrent save is ignored.
+    """
+    mkdir_p(cache_dirname)
+    index_filename = os.path.join(cache_dirname, "index.json")
+    previous_index = __read_triangulations_index(index_filename)
+    arrays_dirname = tempfile.mkdtemp(prefix="arrays_", dir=cache_dirname)
+    os.chmod(arrays_dirname, 0o755) # Readable by other users as the rest of the grid
+    index = {'version': _TRIANGULATION_CACHE_VERSION, 'key': key, 'arrays': os.path.basename(arrays_dirname), 'triangulations': []}
+    # The arrays are scipy internals (they may change between versions)
+    index.update(__library_versions())
+    try:
+        for i, delaunay_triangulation in enumerate(delaunay_triangulations['precomputed']):
+            if delaunay_triangulation is None:
+                index['triangulations'].append(None)
+                continue
+            delaunay_triangulation.transform # Make sure it is computed
+            for name in _DELAUNAY_ARRAYS:
+                np.save(os.path.join(arrays_dirname, "delaunay_{}{}.npy".format(i, name)), getattr(delaunay_triangulation, name))
+            index['triangulations'].append(dict((name, np.asarray(getattr(delaunay_triangulation, name)).item()) for name in _DELAUNAY_SCALARS))
+        tmp_index_filename = index_filename + ".{}.tmp".format(os.getpid())
+        with open(tmp_index_filename, "w") as f:
+            json.dump(index, f)
+        # Atomic: readers see the previous or the new index
+        os.replace(tmp_index_filename, index_filename)
+    except:
+        shutil.rmtree(arrays_dirname, ignore_errors=True)
+        raise
+    # Processes that memory mapped the previous arrays keep their content
+    # (on Windows they cannot be removed while they are in use)
+    if previous_index is not None and previous_index.get('arrays') not in (None, index['arrays']):
+        shutil.rmtree(os.path.join(cache_dirname, os.path.basename(previous_index['arrays'])), ignore_errors=True)
+
+def __read_triangulations_index(index_filename):
+    try:
+        with open(index_filename, "r") as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+
+def __restore_triangulations(cache_dirname, key, existing_points, parameters_subsets):
+    """
+    Rebuild the Delaunay triangulations from the cache (arrays are memory mapped).
+    Returns None if there is no cache, it does not correspond to the current
+    parameters (key) or library versions, or it cannot be rebuilt.
+    """
+    index = __read_triangulations_index(os.path.join(cache_dirname, "index.json"))
+    if index is None:
+        return None
+    if index.get('version') != _TRIANGULATION_CACHE_VERSION or index.get('key') != key or len(index['triangulations']) != len(parameters_subsets):
+        return None
+    for name, version in __library_versions().items():
+        if index.get(name) != version:
+            logging.info("Triangulations cached with {} {} (current {}), they will be recomputed".format(name, index.get(name), version))
+            return None
+    try:
+        return __rebuild_triangulations(cache_dirname, index, existing_points, parameters_subsets)
+    except Exception as e:
+        logging.warning("Triangulations cached in '{}' cannot be restored ({}), they will be recomputed".format(cache_dirname, e))
+        return None
+
+def __rebuild_triangulations(cache_dirname, index, existing_points, parameters_subsets):
+    arrays_dirname = os.path.join(cache_dirname, os.path.basename(index['arrays']))
+    delaunay_triangulations = {'subsets': parameters_subsets, 'precomputed': []}
+    for i, (scalars, parameters_subset) in enumerate(zip(index['triangulations'], parameters_subsets)):
+        if scalars is None:
+            delaunay_triangulations['precomputed'].append(None)
+            continue
+        delaunay_triangulation = spatial.Delaunay.__new__(spatial.Delaunay)
+        delaunay_triangulation.__dict__.update(scalars)
+        for name in _DELAUNAY_ARRAYS:
+            setattr(delaunay_triangulation, name, np.load(os.path.join(arrays_dirname, "delaunay_{}{}.npy".format(i, name)), mmap_mode='r'))
+        delaunay_triangulation._qhull = None
+        delaunay_triangulation._vertex_to_simplex = None
+        delaunay_triangulation._vertex_neighbor_vertices = None
+        delaunay_triangulation.min_bound = np.min(delaunay_triangulation._points, axis=0)
+        delaunay_triangulation.max_bound = np.max(delaunay_triangulation._points, axis=0)
+        points = existing_points[parameters_subset]
+        ndim, nsimplex = delaunay_triangulation.ndim, delaunay_triangulation.nsimplex
+        if not (ndim == existing_points.shape[1] and delaunay_triangulation.npoints == len(points)):
+            return None
+        if delaunay_triangulation.simplices.shape != (nsimplex, ndim+1) or delaunay_triangulation._transform.shape != (nsimplex, ndim+1, ndim):
+            return None
+        # Sanity check: some existing points should be found in the
+        # triangulation and recovered from their barycentric coordinates
+        sample = points[:10]
+        simplex = delaunay_triangulation.find_simplex(sample)
+        if np.any(simplex < 0):
+            return None
+        transform = delaunay_triangulation.transform[simplex]
+        barycentric = np.einsum('ijk,ik->ij', transform[:, :ndim, :], sample - transform[:, ndim, :])
+        barycentric = np.column_stack((barycentric, 1. - np.sum(barycentric, axis=1)))
+        recovered = np.einsum('ij,ijk->ik', barycentric, points[delaunay_triangulation.simplices[simplex]])
+        if not np.allclose(recovered, sample):
+            return None
+        delaunay_triangulations['precomputed'].append(delaunay_triangulation)
+    return delaunay_triangulations
+
+def _load_triangulations(base_dirname, params_filename, existing_points, parameters_subsets, triangulate=spatial.Delaunay, regular_grid=False):
+    """
+    Delaunay triangulations (one per subset of points) and kdtree for the
+    existing points. Triangulations are computed only if there is no cache in
+    the base directory for the current content of the parameters file,
+    otherwise they are rebuilt from memory mapped arrays.
+
+    If regular_grid is True and the existing points are (mostly) placed in a
+    rectilinear mesh, a RegularGrid is included (key 'regular_grid') to
+    interpolate with the corners of the cell that contains the target, and
+    triangulations are only used for the cells with missing corners (they are
+    not computed at all if the mesh is complete).
+    """
+    if regular_grid:
+        regular_grid = RegularGrid(existing_points)
+        if not regular_grid.is_rectilinear():
+            logging.info("Grid is not rectilinear, using Delaunay triangulations")
+            regular_grid = None
+        elif regular_grid.is_complete():
+            delaunay_triangulations = {'subsets': parameters_subsets, 'precomputed': [None]*len(parameters_subsets), 'regular_grid': regular_grid}
+            return delaunay_triangulations, spatial.cKDTree(existing_points)
+    else:
+        regular_grid = None
+    cache_dirname = os.path.join(base_dirname, _TRIANGULATION_CACHE_DIRNAME)
+    key = __file_hash(params_filename)
+    delaunay_triangulations = __restore_triangulations(cache_dirname, key, existing_points, parameters_subsets)
+    if delaunay_triangulations is None:
+        delaunay_triangulations = {'subsets': parameters_subsets, 'precomputed': []}
+        for i, parameters_subset in enumerate(parameters_subsets):
+            logging.info("Pre-computing [{}/{}]...".format(i+1, len(parameters_subsets)))
+            if len(existing_points[parameters_subset]) > 0:
+                delaunay_triangulations['precomputed'].append(triangulate(existing_points[parameters_subset]))
+            else:
+                delaunay_triangulations['precomputed'].append(None)
+        try:
+            __save_triangulations(cache_dirname, key, delaunay_triangulations)
+        except (IOError, OSError) as e:
+            logging.warning("Triangulations could not be cached in '{}': {}".format(cache_dirname, e))
+    delaunay_triangulations['regular_grid'] = regular_grid
+    # Building the kdtree is fast
+    kdtree = spatial.cKDTree(existing_points)
+    return delaunay_triangulations, kdtree
+
+def _read_model_atmosphere(filename):
+    # Module level function (instead of a lambda) to allow pickling the pack
+    return fits.open(filename)[1].data
+
+def load_modeled_layers_pack(input_path, preload=False, cache_size=0, regular_grid=False):
     """
     Restore modeled atmospheric layers and statistics, previously processed by
     iSpec (i.e. save_modeled_layers_pack). By default, iSpec is distributed with
@@ -309,6 +714,23 @@ def load_modeled_layers_pack(input_path):
         Name of the input file (i.e. models.dump) or directory (new interpolator)
     :type input_path: string
 
+    :param preload:
+        Read all the model atmospheres into memory (one contiguous array) so that
+        interpolations do not need to read any file.
+    :type preload: bool
+
+    :param cache_size:
+        If not preloaded, keep in memory the last 'cache_size' used model
+        atmospheres (0 to read them from disk every time).
+    :type cache_size: int
+
+    :param regular_grid:
+        If the models are (mostly) placed in a rectilinear mesh of parameters,
+        use multilinear interpolation with the corners of the cell that
+        contains the target (Delaunay triangulations are only used for cells
+        with missing models).
+    :type regular_grid: bool
+
     :returns:
         List of modeled_layers, used_values_for_layers, proximity, teff_range, logg_range, MH_range, alpha_range and nlayers
     """
@@ -318,7 +740,6 @@ def load_modeled_layers_pack(input_path):
     base_dirname = input_path
     atm_dirname = os.path.join(base_dirname, "grid")
     params_filename = os.path.join(base_dirname, "parameters.tsv")
-    cache_filename = os.path.join(base_dirname, "cache.dump")
 
     if not os.path.exists(atm_dirname):
         raise Exception("Grid path '{}' does not exist".format(atm_dirname))
@@ -341,36 +762,17 @@ def load_modeled_layers_pack(input_path):
     existing_points = np.array(existing_points)
 
     # The delaunay triangulation and kdtree can be computationally expensive,
-    # do it once and save a pickle dump
-    # But first verify that the computed one (if exists) matches what is expected
-    use_dump = False
-    if os.path.exists(cache_filename):
-        use_dump = True
-        delaunay_triangulations, kdtree = pickle.load(open(cache_filename, 'rb'))
-        for delaunay_triangulation, parameters_subset in zip(delaunay_triangulations['precomputed'], parameters_subsets):
-            if delaunay_triangulation is None:
-                continue
-            if not (delaunay_triangulation.ndim == len(free_parameters) and delaunay_triangulation.npoints == len(existing_points[parameters_subset])):
-                use_dump = False
-                break
-
-    if not os.path.exists(cache_filename) or not use_dump:
-        delaunay_triangulations = {'subsets': parameters_subsets, 'precomputed': []}
-        for i, parameters_subset in enumerate(parameters_subsets):
-            logging.info("Pre-computing [{}/{}]...".format(i+1, len(parameters_subsets)))
-            if len(existing_points[parameters_subset]) > 0:
-                delaunay_triangulations['precomputed'].append(spatial.Delaunay(existing_points[parameters_subset]))
-            else:
-                delaunay_triangulations['precomputed'].append(None)
-        kdtree = spatial.cKDTree(existing_points)
-        pickle.dump((delaunay_triangulations, kdtree), open(cache_filename, 'wb'), protocol=2)
+    # do it once and save it in a cache (identified by the content of parameters.tsv)
+    delaunay_triangulations, kdtree = _load_triangulations(base_dirname, params_filename, existing_points, parameters_subsets, regular_grid=regular_grid)
 
     # Functions will receive the parameters in the same order
-    read_point_value = lambda f: fits.open(f)[1].data
+    read_point_value = _read_model_atmosphere
 
     value_fields = ["rhox", "temperature", "pgas", "xne", "abross", "accrad", "vturb", "logtau5", "depth", "pelectron"]
     value_fields += ["alpha_enhancement", "c_enhancement", "n_enhancement", "o_enhancement", "rapid_neutron_capture_enhancement", "slow_neutron_capture_enhancement"]
     value_fields += ["radius", "mass", "vmic"]
+    if preload or cache_size > 0:
+        read_point_value = ModelNodeStore(filenames, read_point_value, value_fields, preload=preload, cache_size=cache_size)
     return existing_points, free_parameters, filenames, read_point_value, value_fields, delaunay_triangulations, kdtree, ranges, base_dirname
 
 
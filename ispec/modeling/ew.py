@@ -170,6 +170,9 @@ class EquivalentWidthModel(MPFitModel):
 
 
 
+    # Modified by the model function (see MPFitModel._merge_evaluation_state)
+    _evaluation_attributes = ('last_final_values', 'fe1_filter', 'fe2_filter', 'm1', 'c1', 'm2', 'c2', 'fe1', 'fe2', 'fe1_std', 'fe2_std')
+
     def _model_function(self, x, p=None):
         # The model function with parameters p required by mpfit library
         if p is not None:
@@ -533,7 +536,7 @@ class EquivalentWidthModel(MPFitModel):
 
 
 
-    def fitData(self, linemasks, outliers_detection='robust', sigma_level=3, outliers_weight_limit=0.90, parinfo=None, max_iterations=20, quiet=True, code="spectrum", tmp_dir=None):
+    def fitData(self, linemasks, outliers_detection='robust', sigma_level=3, outliers_weight_limit=0.90, parinfo=None, max_iterations=20, quiet=True, code="spectrum", tmp_dir=None, jacobian_executor=None):
         base = 5
         if len(parinfo) < base:
             raise Exception("Wrong number of parameters!")
@@ -582,7 +585,7 @@ class EquivalentWidthModel(MPFitModel):
         #weights = np.asarray([1000,1,100])
         #weights = np.asarray([100,1,1000])
         #weights = np.asarray([1,1000,1])
-        super(EquivalentWidthModel, self).fitData(index, target_values, weights=weights, parinfo=parinfo, chisq_limit=chisq_limit, ftol=ftol, xtol=xtol, gtol=gtol, damp=damp, maxiter=max_iterations, quiet=quiet, iterfunct=self.defiter)
+        super(EquivalentWidthModel, self).fitData(index, target_values, weights=weights, parinfo=parinfo, chisq_limit=chisq_limit, ftol=ftol, xtol=xtol, gtol=gtol, damp=damp, maxiter=max_iterations, quiet=quiet, iterfunct=self.defiter, jacobian_executor=jacobian_executor)
 
         values_to_evaluate, x_over_h, selected_x_over_h, fitted_lines_params = self.last_final_values
         residuals = values_to_evaluate - target_values
@@ -653,13 +656,15 @@ class EquivalentWidthModel(MPFitModel):
         print("Return code:", self.m.status)
 
 
-def model_spectrum_from_ew(linemasks, modeled_layers_pack, abundances, initial_teff, initial_logg, initial_MH, initial_alpha, initial_vmic, free_params=["teff", "logg", "vmic"], adjust_model_metalicity=False, enhance_abundances=True, scale=None, max_iterations=20, outliers_detection='robust', sigma_level=3, outliers_weight_limit=0.90, code="spectrum", tmp_dir=None):
+def model_spectrum_from_ew(linemasks, modeled_layers_pack, abundances, initial_teff, initial_logg, initial_MH, initial_alpha, initial_vmic, free_params=["teff", "logg", "vmic"], adjust_model_metalicity=False, enhance_abundances=True, scale=None, max_iterations=20, outliers_detection='robust', sigma_level=3, outliers_weight_limit=0.90, code="spectrum", tmp_dir=None, jacobian_executor=None):
     """
     - outlier_detection:
         - 'robust': Fit a robust least square linear model, outliers_weight_limit will be use as a threshold. If it is set to zero, no outliers are filtered.
         - 'sigma_clipping': Fit a tradition least square linear model and filter X times the standard deviation (sigma_level)
     - If enhance_abundances is True, alpha elements and CNO abundances will be scaled
       depending on the metallicity.
+    - jacobian_executor (e.g. multiprocessing.Pool) evaluates in parallel the
+      perturbed parameters needed in every iteration (same results as without it).
     """
     code = code.lower()
     if code not in ['spectrum', 'turbospectrum', 'moog', 'width']:
@@ -693,7 +698,7 @@ def model_spectrum_from_ew(linemasks, modeled_layers_pack, abundances, initial_t
     lfilter = linemasks['element'] == "Fe 1"
     lfilter = np.logical_or(lfilter, linemasks['element'] == "Fe 2")
     linemasks = linemasks[lfilter]
-    EW_model.fitData(linemasks, parinfo=parinfo, max_iterations=max_iterations, quiet=False, outliers_detection=outliers_detection, sigma_level=sigma_level, outliers_weight_limit=outliers_weight_limit, code=code, tmp_dir=tmp_dir)
+    EW_model.fitData(linemasks, parinfo=parinfo, max_iterations=max_iterations, quiet=False, outliers_detection=outliers_detection, sigma_level=sigma_level, outliers_weight_limit=outliers_weight_limit, code=code, tmp_dir=tmp_dir, jacobian_executor=jacobian_executor)
     print("\n")
     EW_model.print_solution()
 
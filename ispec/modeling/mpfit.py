@@ -222,6 +222,7 @@ Perform Levenberg-Marquardt least-squares minimization, based on MINPACK-1.
                  1 - one-sided derivative (f(x+h) - f(x)  )/h
                 -1 - one-sided derivative (f(x)   - f(x-h))/h
                  2 - two-sided derivative (f(x+h) - f(x-h))/(2*h)
+                 3 - explicit derivative computed by the user function
 
              Where H is the STEP parameter described above.  The
              "automatic" one-sided derivative method will chose a
@@ -229,7 +230,12 @@ Perform Levenberg-Marquardt least-squares minimization, based on MINPACK-1.
              violate any constraints.  The other methods do not
              perform this check.  The two-sided method is in
              principle more precise, but requires twice as many
-             function evaluations.  Default: 0.
+             function evaluations.  For explicit derivatives, FCN
+             is called with FJAC set to an array with 1 for the
+             parameters that need them (and 0 for the rest) and it
+             should return [status, f, pderiv] where pderiv is the
+             [m, npar] array of derivatives of the (weighted) model,
+             the other parameters use finite differences.  Default: 0.
 
     'mpmaxstep' - the maximum change to be made in the parameter
                  value.  During the fitting process, the parameter
@@ -410,6 +416,11 @@ Perform Levenberg-Marquardt least-squares minimization, based on MINPACK-1.
 
 import numpy
 import types
+import os
+import pickle
+import shutil
+import tempfile
+import multiprocessing
 import scipy.linalg.blas
 from ispec.common import estimate_vmic, estimate_vmac
 
@@ -595,6 +606,91 @@ from ispec.common import estimate_vmic, estimate_vmac
 #
 #     **********
 
+def _parallel_call(args):
+    # Evaluation of the user function in a jacobian executor (see mpfit.parallel_fdjac2)
+    directory, version, x, damp = args
+    # Workers of a multiprocessing Pool are daemonic but some radiative
+    # transfer codes run in their own child process
+    multiprocessing.current_process().daemon = False
+    fcn, functkw = _load_jacobian_snapshot(directory, version)
+    model = getattr(fcn, '__self__', None)
+    cache = getattr(model, 'cache', None)
+    if cache is not None:
+        # Only the results of this evaluation are part of its state
+        model._initial_cache_keys = set(cache)
+    [status, f] = fcn(x, fjac=None, **functkw)
+    if damp > 0:
+        f = numpy.tanh(f/damp)
+    if hasattr(model, '_evaluation_state'):
+        state = model._evaluation_state()
+    else:
+        state = None
+    if cache is not None:
+        # The next evaluations in this worker should not see them (the main
+        # process decides what is shared after merging the states)
+        for key in list(cache.keys()):
+            if key not in model._initial_cache_keys:
+                del cache[key]
+    return status, f, state
+
+# Snapshot loaded by this worker: [directory, version, fcn, functkw]
+_jacobian_snapshot = None
+
+def _load_jacobian_snapshot(directory, version):
+    global _jacobian_snapshot
+    if _jacobian_snapshot is None or _jacobian_snapshot[0] != directory:
+        # New fit
+        with open(os.path.join(directory, "0.pkl"), "rb") as f:
+            fcn, functkw = pickle.load(f)
+        _jacobian_snapshot = [directory, 0, fcn, functkw]
+    model = getattr(_jacobian_snapshot[2], '__self__', None)
+    while _jacobian_snapshot[1] < version:
+        _jacobian_snapshot[1] += 1
+        with open(os.path.join(directory, "%i.pkl" % _jacobian_snapshot[1]), "rb") as f:
+            added = pickle.load(f)
+        for key, value in added:
+            model.cache[key] = value
+    return _jacobian_snapshot[2], _jacobian_snapshot[3]
+
+class _JacobianSnapshots(object):
+    """
+    The user function (and the model it belongs to) is saved to a temporary
+    directory once per fit and every worker of the jacobian executor loads it
+    only once. Afterwards, only the results added to the cache of the model
+    are saved (one file per version) and the workers load the versions they
+    have not seen yet, thus the tasks contain just the parameters.
+    """
+    def __init__(self, fcn, functkw):
+        self.directory = tempfile.mkdtemp(prefix="mpfit_jacobian_")
+        self.version = 0
+        self._save((fcn, functkw))
+        cache = getattr(getattr(fcn, '__self__', None), 'cache', None)
+        self._cache_keys = set(cache) if cache is not None else set()
+
+    def update(self, fcn):
+        """
+        Save the results added to the cache since the last version and
+        return the version that the workers should load.
+        """
+        cache = getattr(getattr(fcn, '__self__', None), 'cache', None)
+        if cache is not None:
+            added = [(key, value) for key, value in cache.items() if key not in self._cache_keys]
+            if len(added) > 0:
+                self.version += 1
+                self._save(added)
+                self._cache_keys.update([key for key, value in added])
+        return self.version
+
+    def _save(self, content):
+        filename = os.path.join(self.directory, "%i.pkl" % self.version)
+        with open(filename + ".tmp", "wb") as f:
+            pickle.dump(content, f, protocol=pickle.HIGHEST_PROTOCOL)
+        # Atomic: workers never read incomplete files
+        os.replace(filename + ".tmp", filename)
+
+    def remove(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+
 class mpfit(object):
 
     blas_enorm32, = scipy.linalg.blas.get_blas_funcs(['nrm2'],numpy.array([0],dtype=numpy.float32))
@@ -606,7 +702,7 @@ class mpfit(object):
                  damp=0., maxiter=200, factor=100., nprint=1,
                  iterfunct='default', iterkw={}, nocovar=0,
                  rescale=0, autoderivative=1, quiet=0,
-                 diag=None, epsfcn=None, debug=0):
+                 diag=None, epsfcn=None, debug=0, jacobian_executor=None):
         """
   Inputs:
     fcn:
@@ -667,6 +763,25 @@ class mpfit(object):
         operation to FUNCTKW.
            Default: {}  No arguments are passed.
 
+     jacobian_executor:
+        An object with a map(function, iterable, chunksize=1) method that
+        runs the function in other processes (e.g. a multiprocessing Pool or
+        a concurrent.futures.ProcessPoolExecutor) used to evaluate
+        concurrently the perturbed parameters when the derivatives are
+        computed by finite differences.  FCN and the content of FUNCTKW
+        should be picklable: they are saved to a temporary directory once
+        per fit and loaded once by every worker, which can start its own
+        child processes (the daemon flag of Pool workers is cleared).
+
+        If FCN is a method of an object that implements
+        _evaluation_state() and _merge_evaluation_state(state) (e.g.
+        MPFitModel), the state produced in the workers (such as caches) is
+        merged back in the same order as the serial evaluation, which is
+        repeated for the few evaluations that would have depended on the
+        state produced by a previous one.  Thus, the results are the same as
+        without executor.
+           Default: None  Evaluations are serial.
+
      iterfunct:
         The name of a function to be called upon each NPRINT iteration of the
         MPFIT routine.  It should be declared in the following way:
@@ -842,6 +957,22 @@ class mpfit(object):
            pcerror = mpfit.perror * sqrt(mpfit.fnorm / dof)
 
         """
+        # Files shared with the workers of the jacobian executor
+        self._jacobian_snapshots = None
+        try:
+            self._fit(fcn, xall, functkw, parinfo, chisq_limit, ftol, xtol, gtol,
+                      damp, maxiter, factor, nprint, iterfunct, iterkw, nocovar,
+                      rescale, autoderivative, quiet, diag, epsfcn, debug,
+                      jacobian_executor)
+        finally:
+            if self._jacobian_snapshots is not None:
+                self._jacobian_snapshots.remove()
+                self._jacobian_snapshots = None
+
+    def _fit(self, fcn, xall, functkw, parinfo, chisq_limit, ftol, xtol, gtol,
+             damp, maxiter, factor, nprint, iterfunct, iterkw, nocovar,
+             rescale, autoderivative, quiet, diag, epsfcn, debug,
+             jacobian_executor):
         self.niter = 0
         self.params = None
         self.covar = None
@@ -851,6 +982,7 @@ class mpfit(object):
         self.errmsg = ''
         self.nfev = 0
         self.damp = damp
+        self.jacobian_executor = jacobian_executor
         self.dof=0
 
         if fcn==None:
@@ -935,6 +1067,11 @@ class mpfit(object):
         wh = (numpy.nonzero((qmin!=0.) | (qmax!=0.)))[0]
         qminmax = len(wh > 0)
 
+        # Explicit derivatives for some parameters (see AUTODERIVATIVE=0)
+        if (self.damp != 0) and numpy.any(numpy.abs(dside) == 3):
+            self.errmsg =  'ERROR: keywords DAMP and MPSIDE=3 are mutually exclusive'
+            return
+
         # Finish up the free parameters
         ifree = (numpy.nonzero(pfixed != 1))[0]
         nfree = len(ifree)
@@ -1580,8 +1717,25 @@ class mpfit(object):
             wh = (numpy.nonzero(mask))[0]
             if len(wh) > 0:
                 h[wh] = - h[wh]
+
+        # Derivatives computed by the user function
+        explicit = numpy.abs(dside[ifree]) == 3
+        if numpy.any(explicit):
+            dflags = numpy.zeros(nall, dtype=float)
+            dflags[ifree[explicit]] = 1.0
+            [status, fp, pderiv] = self.call(fcn, xall, functkw, fjac=dflags)
+            if status < 0:
+                return None
+            pderiv = numpy.reshape(pderiv, [m, nall])
+            fjac[0:,explicit] = -pderiv[:,ifree[explicit]]
+
+        if self.jacobian_executor is not None and not numpy.all(explicit):
+            return self.parallel_fdjac2(fcn, xall, fvec, h, ifree, dside, functkw, fjac)
+
         # Loop through parameters, computing the derivative for each
         for j in range(n):
+            if explicit[j]:
+                continue
             xp = xall.copy()
             xp[ifree[j]] = xp[ifree[j]] + h[j]
             [status, fp] = self.call(fcn, xp, functkw)
@@ -1607,6 +1761,62 @@ class mpfit(object):
         return fjac
 
 
+    # Same as the loop in fdjac2 but all the perturbed parameters are
+    # evaluated with the jacobian executor
+    def parallel_fdjac2(self, fcn, xall, fvec, h, ifree, dside, functkw, fjac):
+        n = len(ifree)
+        columns = [j for j in range(n) if numpy.abs(dside[ifree[j]]) != 3]
+        points = []
+        for j in columns:
+            xp = xall.copy()
+            xp[ifree[j]] = xp[ifree[j]] + h[j]
+            points.append(xp)
+            if numpy.abs(dside[ifree[j]]) > 1:
+                xm = xall.copy()
+                xm[ifree[j]] = xall[ifree[j]] - h[j]
+                points.append(xm)
+        if self.qanytied:
+            points = [self.tie(xp, self.ptied) for xp in points]
+        self.nfev = self.nfev + len(points)
+        if self._jacobian_snapshots is None:
+            self._jacobian_snapshots = _JacobianSnapshots(fcn, functkw)
+        version = self._jacobian_snapshots.update(fcn)
+        directory = self._jacobian_snapshots.directory
+        results = self.jacobian_executor.map(_parallel_call, [(directory, version, xp, self.damp) for xp in points], chunksize=1)
+
+        # Reproduce the state that the serial evaluation would have produced
+        model = getattr(fcn, '__self__', None)
+        stateful = hasattr(model, '_merge_evaluation_state')
+        added_keys = set()
+        values = []
+        for xp, (status, f, state) in zip(points, results):
+            if stateful and state is not None:
+                keys = [key for key, value in state.get('cache', [])]
+                if any(key in added_keys for key in keys):
+                    # Serially, it would have been affected by a previous evaluation
+                    status, f = fcn(xp, fjac=None, **functkw)
+                    if self.damp > 0:
+                        f = numpy.tanh(f/self.damp)
+                else:
+                    model._merge_evaluation_state(state)
+                    added_keys.update(keys)
+            if status < 0:
+                return None
+            values.append(f)
+
+        k = 0
+        for j in columns:
+            fp = values[k]
+            k += 1
+            if numpy.abs(dside[ifree[j]]) <= 1:
+                # COMPUTE THE ONE-SIDED DERIVATIVE
+                fjac[0:,j] = (fp-fvec)/h[j]
+            else:
+                # COMPUTE THE TWO-SIDED DERIVATIVE
+                fm = values[k]
+                k += 1
+                fjac[0:,j] = (fp-fm)/(2*h[j])
+        return fjac
 
     #     Original FORTRAN documentation
     #     **********
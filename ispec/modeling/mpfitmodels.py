@@ -32,6 +32,45 @@ class MPFitModel(object):
         self.rms = None
         self.m = None # MPFIT object
 
+    # Attributes modified by the model function (besides the parameters and the
+    # cache) that are merged back when it is evaluated in other processes
+    _evaluation_attributes = ()
+
+    def __getstate__(self):
+        # The MPFIT object is not needed to evaluate the model
+        state = self.__dict__.copy()
+        state['m'] = None
+        state.pop('blas_enorm', None)
+        state.pop('_initial_cache_keys', None)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # To identify the results added to the cache by the evaluations in this copy
+        self._initial_cache_keys = set(getattr(self, 'cache', {}))
+
+    def _evaluation_state(self):
+        """
+        State produced by the evaluations of the model in this copy (i.e. in a
+        worker process) for '_merge_evaluation_state'.
+        """
+        state = {'values': [parameter['value'] for parameter in self._parinfo]}
+        if getattr(self, 'cache', None) is not None:
+            initial_cache_keys = getattr(self, '_initial_cache_keys', set())
+            state['cache'] = [(key, value) for key, value in self.cache.items() if key not in initial_cache_keys]
+        for name in self._evaluation_attributes:
+            state[name] = getattr(self, name, None)
+        return state
+
+    def _merge_evaluation_state(self, state):
+        for parameter, value in zip(self._parinfo, state['values']):
+            parameter['value'] = value
+        for key, value in state.get('cache', []):
+            if key not in self.cache:
+                self.cache[key] = value
+        for name in self._evaluation_attributes:
+            setattr(self, name, state[name])
+
     def __call__(self, x):
         return self._model_function(x)
 
@@ -49,12 +88,27 @@ class MPFitModel(object):
         # Non-negative status value means MPFIT should continue, negative means
         # stop the calculation.
         status = 0
+        if fjac is not None:
+            # Parameters with explicit derivatives (mpside=3)
+            pderiv = self._model_derivatives(self.x, fjac)
+            if self.weights is not None:
+                return([status, (self.y - model)*self.weights, pderiv*self.weights[:,np.newaxis]])
+            else:
+                return([status, (self.y - model), pderiv])
         if self.weights is not None:
             return([status, (self.y - model)*self.weights])
         else:
             return([status, (self.y - model)])
 
-    def fitData(self, x, y, weights=None, parinfo=None, chisq_limit=None, ftol=1.e-10, xtol=1.e-10, gtol=1.e-10, damp=0, maxiter=200, iterfunct='default', epsfcn=None, quiet=True):
+    def _model_derivatives(self, x, requested):
+        """
+        Derivatives of the model (last evaluated by _model_function) with
+        respect to the parameters with a non-zero value in 'requested', as an
+        array of len(x) rows and one column per parameter.
+        """
+        raise NotImplementedError()
+
+    def fitData(self, x, y, weights=None, parinfo=None, chisq_limit=None, ftol=1.e-10, xtol=1.e-10, gtol=1.e-10, damp=0, maxiter=200, iterfunct='default', epsfcn=None, quiet=True, jacobian_executor=None):
         """
         - ftol: Termination occurs when both the actual
                 and predicted relative reductions in the sum of squares are at most
@@ -66,6 +120,8 @@ class MPFitModel(object):
                 in absolute value
         - damp: Residuals bigger than "damp" are not considered (damped)
         - maxiter: Maximum number of iterations
+        - jacobian_executor: Pool of processes to evaluate the model with the
+                perturbed parameters in parallel (see mpfit)
         """
         self.x = x
         self.y = y
@@ -76,7 +132,7 @@ class MPFitModel(object):
         if parinfo is not None:
             self._parinfo = parinfo
 
-        m = mpfit.mpfit(self._model_evaluation_function, parinfo=self._parinfo, chisq_limit=chisq_limit, ftol=ftol, xtol=xtol, gtol=gtol, damp=damp, maxiter=maxiter, epsfcn=epsfcn, iterfunct=iterfunct, quiet=quiet)
+        m = mpfit.mpfit(self._model_evaluation_function, parinfo=self._parinfo, chisq_limit=chisq_limit, ftol=ftol, xtol=xtol, gtol=gtol, damp=damp, maxiter=maxiter, epsfcn=epsfcn, iterfunct=iterfunct, quiet=quiet, jacobian_executor=jacobian_executor)
 
         if (m.status <= 0):
            raise Exception(m.errmsg)
@@ -119,10 +175,10 @@ class GaussianModel(MPFitModel):
             #return self.baseline() + ((self.A()*1.)/np.sqrt(2*np.pi*self.sig()**2))*np.exp(-(x-self.mu())**2/(2*self.sig()**2))
             return self.baseline() + self.A()*np.exp(-(x-self.mu())**2/(2*self.sig()**2))
 
-    def fitData(self, x, y, weights=None, parinfo=None):
+    def fitData(self, x, y, weights=None, parinfo=None, jacobian_executor=None):
         if len(parinfo) != 4:
             raise Exception("Wrong number of parameters!")
-        super(GaussianModel, self).fitData(x, y, weights, parinfo)
+        super(GaussianModel, self).fitData(x, y, weights, parinfo, jacobian_executor=jacobian_executor)
 
     def baseline(self): return self._parinfo[0]['value']
     def A(self): return self._parinfo[1]['value']
@@ -207,10 +263,10 @@ class VoigtModel(MPFitModel):
             voigt_result = self.baseline() + (self.A() * w.real*(2*np.pi)**-0.5/self.sig())
         return voigt_result
 
-    def fitData(self, x, y, weights=None, parinfo=None):
+    def fitData(self, x, y, weights=None, parinfo=None, jacobian_executor=None):
         if len(parinfo) != 5:
             raise Exception("Wrong number of parameters!")
-        super(VoigtModel, self).fitData(x, y, weights, parinfo)
+        super(VoigtModel, self).fitData(x, y, weights, parinfo, jacobian_executor=jacobian_executor)
 
 
     def baseline(self): return self._parinfo[0]['value']
@@ -29,7 +29,7 @@ from ispec.atmospheres import write_atmosphere, interpolate_atmosphere_layers, m
 from ispec.lines import write_atomic_linelist, write_isotope_data, _get_atomic_linelist_definition
 from ispec.common import estimate_vmic, estimate_vmac
 from ispec.spectrum import create_spectrum_structure, convolve_spectrum, resample_spectrum, read_spectrum, create_wavelength_filter, read_spectrum, normalize_spectrum
-from ispec.synth.effects import _filter_linelist, apply_post_fundamental_effects
+from ispec.synth.effects import _filter_linelist, apply_post_fundamental_effects, post_fundamental_effects_derivatives
 from .common import Constants, _filter_linemasks_not_in_segments, _create_comparing_mask, _get_stats_per_linemask
 from ispec.synth.spectrum import _create_waveobs_mask
 from ispec.synth.common import generate_fundamental_spectrum
@@ -158,6 +158,8 @@ class SynthModel(MPFitModel):
         self.segments = None
         self.waveobs_mask = None
         self.cache = {}
+        self.synthesis_cache = None
+        self.synthesis_workers = 1
         p = [teff, logg, MH, alpha, vmic, vmac, vsini, limb_darkening_coeff, R ]
         #
         self.abundances_file = None
@@ -167,6 +169,9 @@ class SynthModel(MPFitModel):
         self.atmosphere_layers_file = None
         super(SynthModel, self).__init__(p)
 
+    # Modified by the model function (see MPFitModel._merge_evaluation_state)
+    _evaluation_attributes = ('last_fluxes', 'last_final_fluxes')
+
     def _model_function(self, x, p=None):
         # The model function with parameters p required by mpfit library
         if p is not None:
@@ -252,18 +257,18 @@ class SynthModel(MPFitModel):
                     atmosphere_layers = interpolate_atmosphere_layers(self.modeled_layers_pack, {'teff':self.teff(), 'logg':self.logg(), 'MH':self.MH(), 'alpha':self.alpha()}, code=self.code)
                     # Fundamental synthetic fluxes
                     if self.code == "turbospectrum":
-                        self.last_fluxes = generate_fundamental_spectrum(self.waveobs, atmosphere_layers, self.teff(), self.logg(), self.MH(), self.alpha(), linelist, self.isotopes, self.abundances, fixed_abundances, self.vmic(), atmosphere_layers_file=self.atmosphere_layers_file, abundances_file=self.abundances_file, linelist_file=self.linelist_file, isotope_file=self.isotope_file, regions=self.segments, verbose=0, code=self.code, use_molecules=self.use_molecules, tmp_dir=self.tmp_dir, timeout=self.timeout)
+                        self.last_fluxes = generate_fundamental_spectrum(self.waveobs, atmosphere_layers, self.teff(), self.logg(), self.MH(), self.alpha(), linelist, self.isotopes, self.abundances, fixed_abundances, self.vmic(), atmosphere_layers_file=self.atmosphere_layers_file, abundances_file=self.abundances_file, linelist_file=self.linelist_file, isotope_file=self.isotope_file, regions=self.segments, verbose=0, code=self.code, use_molecules=self.use_molecules, tmp_dir=self.tmp_dir, timeout=self.timeout, cache=self.synthesis_cache, workers=self.synthesis_workers)
                     elif self.code == "moog":
-                        self.last_fluxes = generate_fundamental_spectrum(self.waveobs, atmosphere_layers, self.teff(), self.logg(), self.MH(), self.alpha(), linelist, self.isotopes, self.abundances, fixed_abundances, self.vmic(), atmosphere_layers_file=self.atmosphere_layers_file, abundances_file=self.abundances_file, linelist_file=self.linelist_file, isotope_file=self.isotope_file, regions=self.segments, verbose=0, code=self.code, tmp_dir=self.tmp_dir, timeout=self.timeout)
+                        self.last_fluxes = generate_fundamental_spectrum(self.waveobs, atmosphere_layers, self.teff(), self.logg(), self.MH(), self.alpha(), linelist, self.isotopes, self.abundances, fixed_abundances, self.vmic(), atmosphere_layers_file=self.atmosphere_layers_file, abundances_file=self.abundances_file, linelist_file=self.linelist_file, isotope_file=self.isotope_file, regions=self.segments, verbose=0, code=self.code, tmp_dir=self.tmp_dir, timeout=self.timeout, cache=self.synthesis_cache, workers=self.synthesis_workers)
                     elif self.code == "synthe":
-                        self.last_fluxes = generate_fundamental_spectrum(self.waveobs, atmosphere_layers, self.teff(), self.logg(), self.MH(), self.alpha(), linelist, self.isotopes, self.abundances, fixed_abundances, self.vmic(), atmosphere_layers_file=self.atmosphere_layers_file, abundances_file=self.abundances_file, linelist_file=self.linelist_file, molecules_files=self.molecules_files, isotope_file=self.isotope_file, regions=self.segments, verbose=0, code=self.code, tmp_dir=self.tmp_dir, timeout=self.timeout)
+                        self.last_fluxes = generate_fundamental_spectrum(self.waveobs, atmosphere_layers, self.teff(), self.logg(), self.MH(), self.alpha(), linelist, self.isotopes, self.abundances, fixed_abundances, self.vmic(), atmosphere_layers_file=self.atmosphere_layers_file, abundances_file=self.abundances_file, linelist_file=self.linelist_file, molecules_files=self.molecules_files, isotope_file=self.isotope_file, regions=self.segments, verbose=0, code=self.code, tmp_dir=self.tmp_dir, timeout=self.timeout, cache=self.synthesis_cache, workers=self.synthesis_workers)
                     elif self.code == "sme":
-                        self.last_fluxes = generate_fundamental_spectrum(self.waveobs, atmosphere_layers, self.teff(), self.logg(), self.MH(), self.alpha(), linelist, self.isotopes, self.abundances, fixed_abundances, self.vmic(), regions=self.segments, verbose=0, code=self.code, timeout=self.timeout)
+                        self.last_fluxes = generate_fundamental_spectrum(self.waveobs, atmosphere_layers, self.teff(), self.logg(), self.MH(), self.alpha(), linelist, self.isotopes, self.abundances, fixed_abundances, self.vmic(), regions=self.segments, verbose=0, code=self.code, timeout=self.timeout, cache=self.synthesis_cache, workers=self.synthesis_workers)
                         ## Do not abort failed synthesis, the minimization algorithm will just consider this point as a bad one
                         #if np.all(self.last_fluxes == 0):
                             #raise Exception("SME has failed.")
                     elif self.code == "spectrum":
-                        self.last_fluxes = generate_fundamental_spectrum(self.waveobs, atmosphere_layers, self.teff(), self.logg(), self.MH(), self.alpha(), linelist, self.isotopes, self.abundances, fixed_abundances, self.vmic(),  atmosphere_layers_file=self.atmosphere_layers_file, abundances_file=self.abundances_file, linelist_file=self.linelist_file, isotope_file=self.isotope_file, regions=self.segments, verbose=0, code=self.code, tmp_dir=self.tmp_dir, timeout=self.timeout)
+                        self.last_fluxes = generate_fundamental_spectrum(self.waveobs, atmosphere_layers, self.teff(), self.logg(), self.MH(), self.alpha(), linelist, self.isotopes, self.abundances, fixed_abundances, self.vmic(),  atmosphere_layers_file=self.atmosphere_layers_file, abundances_file=self.abundances_file, linelist_file=self.linelist_file, isotope_file=self.isotope_file, regions=self.segments, verbose=0, code=self.code, tmp_dir=self.tmp_dir, timeout=self.timeout, cache=self.synthesis_cache, workers=self.synthesis_workers)
 
                         ## Do not abort failed synthesis, the minimization algorithm will just consider this point as a bad one
                         #if np.all(self.last_fluxes == 0):
@@ -295,12 +300,37 @@ class SynthModel(MPFitModel):
 
         return self.last_final_fluxes[self.comparing_mask]
 
-    def fitData(self, waveobs, segments, comparing_mask, fluxes, weights=None, parinfo=None, use_errors=False, max_iterations=20, quiet=True, code="spectrum", use_molecules=False, vmic_from_empirical_relation=True, vmac_from_empirical_relation=True, tmp_dir=None, timeout=1800):
+    # Parameters applied after the fundamental spectrum is synthesized and
+    # that have analytical derivatives (see post_fundamental_effects_derivatives)
+    _broadening_parameters = {5: "macroturbulence", 6: "vsini", 8: "R"}
+
+    def _model_derivatives(self, x, requested):
+        derivatives = np.zeros((len(x), len(requested)))
+        columns = np.where(np.asarray(requested) != 0)[0]
+        for i in columns:
+            if i not in self._broadening_parameters:
+                raise Exception("Analytical derivatives are not available for '{}'".format(self._parinfo[i].get('parname', i)))
+        if np.all(self.last_fluxes == 0) or np.all(self.last_final_fluxes == 0):
+            # Failed synthesis or atmosphere out of the grid
+            return derivatives
+        results = post_fundamental_effects_derivatives(self.waveobs, self.last_fluxes, self.segments, macroturbulence=self.vmac(), vsini=self.vsini(), limb_darkening_coeff=self.limb_darkening_coeff(), R=self.R(), vrad=self.vrad(), parameters=[self._broadening_parameters[i] for i in columns])
+        for i in columns:
+            derivative = results[self._broadening_parameters[i]]
+            derivative[self.waveobs_mask == 0] = 0.
+            derivatives[:, i] = derivative[self.comparing_mask]
+        return derivatives
+
+    def fitData(self, waveobs, segments, comparing_mask, fluxes, weights=None, parinfo=None, use_errors=False, max_iterations=20, quiet=True, code="spectrum", use_molecules=False, vmic_from_empirical_relation=True, vmac_from_empirical_relation=True, tmp_dir=None, timeout=1800, jacobian_executor=None, synthesis_cache=None, analytical_derivatives=True, synthesis_workers=1):
         code = code.lower()
         if code not in ['spectrum', 'turbospectrum', 'moog', 'synthe', 'sme', 'grid']:
             raise Exception("Unknown radiative transfer code: %s" % (code))
 
+        # Do not modify the caller's parameters
+        parinfo = [dict(parameter) for parameter in parinfo]
+
         self.timeout = timeout
+        self.synthesis_cache = synthesis_cache
+        self.synthesis_workers = synthesis_workers
         self.use_errors = use_errors
         base = 9
         if len(parinfo) < base:
@@ -361,12 +391,27 @@ class SynthModel(MPFitModel):
             atmosphere_layers = interpolate_atmosphere_layers(self.modeled_layers_pack, {'teff':parinfo[0]['value'], 'logg':parinfo[1]['value'], 'MH':parinfo[2]['value'], 'alpha':parinfo[3]['value']})
             self.atmosphere_layers_file = write_atmosphere(atmosphere_layers, parinfo[0]['value'], parinfo[1]['value'], parinfo[2]['value'], code=self.code, atmosphere_filename=None, tmp_dir=tmp_dir)
 
+        # Derivatives for vmac, vsini and R are computed from the fundamental
+        # spectrum instead of evaluating the model once more for each of them
+        # (not possible if the spectrum is normalized or read already broadened
+        # from a precomputed grid). At zero (or at the lower limit) the
+        # analytical derivatives vanish and the parameter would never move,
+        # thus finite differences (with an absolute step) are used instead.
+        if analytical_derivatives and self.normalize_func is None and self.precomputed_grid_dir is None:
+            for i in self._broadening_parameters:
+                value = parinfo[i]['value']
+                lower_limited = parinfo[i].get('limited', [False, False])[0]
+                lower_limit = parinfo[i].get('limits', [0., 0.])[0]
+                if value == 0 or (lower_limited and value <= lower_limit):
+                    continue
+                parinfo[i].setdefault('mpside', 3)
+
         if self.use_errors:
-            super(SynthModel, self).fitData(waveobs[self.comparing_mask], fluxes[self.comparing_mask], weights=weights[self.comparing_mask], parinfo=parinfo, ftol=ftol, xtol=xtol, gtol=gtol, damp=damp, maxiter=max_iterations, quiet=quiet)
+            super(SynthModel, self).fitData(waveobs[self.comparing_mask], fluxes[self.comparing_mask], weights=weights[self.comparing_mask], parinfo=parinfo, ftol=ftol, xtol=xtol, gtol=gtol, damp=damp, maxiter=max_iterations, quiet=quiet, jacobian_executor=jacobian_executor)
         else:
             # Do not consider errors for minimization (all weights set to one)
             ones = np.ones(len(fluxes))
-            super(SynthModel, self).fitData(waveobs[self.comparing_mask], fluxes[self.comparing_mask], weights=ones[self.comparing_mask], parinfo=parinfo, ftol=ftol, xtol=xtol, gtol=gtol, damp=damp, maxiter=max_iterations, quiet=quiet)
+            super(SynthModel, self).fitData(waveobs[self.comparing_mask], fluxes[self.comparing_mask], weights=ones[self.comparing_mask], parinfo=parinfo, ftol=ftol, xtol=xtol, gtol=gtol, damp=damp, maxiter=max_iterations, quiet=quiet, jacobian_executor=jacobian_executor)
 
         residuals = self.last_final_fluxes[self.comparing_mask] - fluxes[self.comparing_mask]
         self.rms = np.sqrt(np.sum(np.power(residuals,2))/len(residuals))
@@ -783,7 +828,7 @@ def __create_param_structure(initial_teff, initial_logg, initial_MH, initial_alp
 
     return parinfo
 
-def model_spectrum(spectrum, continuum_model, modeled_layers_pack, linelist, isotopes, abundances, free_abundances, linelist_free_loggf, initial_teff, initial_logg, initial_MH, initial_alpha, initial_vmic, initial_vmac, initial_vsini, initial_limb_darkening_coeff, initial_R, initial_vrad, free_params, segments=None, linemasks=None, enhance_abundances=False, scale=None, precomputed_grid_dir=None, use_errors=True, max_iterations=20, verbose=1, code="spectrum", grid=None, use_molecules=False, vmic_from_empirical_relation=False, vmac_from_empirical_relation=False, normalize_func=None, tmp_dir=None, timeout=1800):
+def model_spectrum(spectrum, continuum_model, modeled_layers_pack, linelist, isotopes, abundances, free_abundances, linelist_free_loggf, initial_teff, initial_logg, initial_MH, initial_alpha, initial_vmic, initial_vmac, initial_vsini, initial_limb_darkening_coeff, initial_R, initial_vrad, free_params, segments=None, linemasks=None, enhance_abundances=False, scale=None, precomputed_grid_dir=None, use_errors=True, max_iterations=20, verbose=1, code="spectrum", grid=None, use_molecules=False, vmic_from_empirical_relation=False, vmac_from_empirical_relation=False, normalize_func=None, tmp_dir=None, timeout=1800, jacobian_executor=None, synthesis_cache=None, synthesis_workers=1):
     """
     It matches synthetic spectrum to observed spectrum by applying a least
     square algorithm.
@@ -800,6 +845,13 @@ def model_spectrum(spectrum, continuum_model, modeled_layers_pack, linelist, iso
       MARCS composition will be used (recommended).
 
     * timeout is for single synthesis execution and not for the whole minimization.
+    * jacobian_executor (e.g. multiprocessing.Pool) evaluates in parallel the syntheses
+      with perturbed parameters that are needed in every iteration (the results are
+      the same as without it, normalize_func should be picklable).
+    * synthesis_cache (SynthesisCache or directory) keeps the fundamental spectra
+      on disk so that they can be reused by other runs (e.g. similar stars).
+    * synthesis_workers is the number of processes used to synthesize the segments
+      concurrently.
     """
 
     if verbose or verbose == 1:
@@ -971,7 +1023,7 @@ def model_spectrum(spectrum, continuum_model, modeled_layers_pack, linelist, iso
     synth_model = SynthModel(modeled_layers_pack, linelist, isotopes, linelist_free_loggf, abundances, enhance_abundances=enhance_abundances, scale=scale, precomputed_grid_dir=precomputed_grid_dir, grid=grid, normalize_func=normalize_func)
 
     #segments = None
-    synth_model.fitData(waveobs, segments, comparing_mask, flux, weights=weights, parinfo=parinfo, use_errors=use_errors, max_iterations=max_iterations, quiet=quiet, code=code, use_molecules=use_molecules, vmic_from_empirical_relation=vmic_from_empirical_relation, vmac_from_empirical_relation=vmac_from_empirical_relation, tmp_dir=tmp_dir, timeout=timeout)
+    synth_model.fitData(waveobs, segments, comparing_mask, flux, weights=weights, parinfo=parinfo, use_errors=use_errors, max_iterations=max_iterations, quiet=quiet, code=code, use_molecules=use_molecules, vmic_from_empirical_relation=vmic_from_empirical_relation, vmac_from_empirical_relation=vmac_from_empirical_relation, tmp_dir=tmp_dir, timeout=timeout, jacobian_executor=jacobian_executor, synthesis_cache=synthesis_cache, synthesis_workers=synthesis_workers)
 
     if verbose:
         print("\n")
@@ -23,6 +23,8 @@ from .spectrum import *
 from .common import *
 from scipy import interpolate
 import time
+import struct
+import warnings
 from . import log
 import logging
 try:
@@ -31,7 +33,106 @@ except:
     logging.warning("Plotting could not be loaded!")
     pass
 
-def __read_fits_spectrum(spectrum_filename):
+# iSpec binary spectrum format: header (magic, version, bytes per flux/error
+# value, flags and number of measurements) padded to a fixed size, followed by
+# the wavelength, flux and error columns
+_BINARY_SPECTRUM_MAGIC = b"ISPECBIN"
+_BINARY_SPECTRUM_VERSION = 1
+_BINARY_SPECTRUM_HEADER_FORMAT = "<8sHHIQ"
+_BINARY_SPECTRUM_HEADER_SIZE = 64
+_BINARY_SPECTRUM_SORTED = 1
+
+def __read_fits_spectrum_regions(hdulist, regions, compressed=False):
+    """
+    Read only the pixels of the 'PRIMARY' HDU (and its error extension) that
+    cover the given regions, using the linear World Coordinate System (WCS) to
+    find the pixel ranges and astropy sections to avoid loading the whole
+    image (memory-mapped for uncompressed files). A margin of one pixel is kept
+    on each side, the exact wavelength filtering is done later by read_spectrum.
+
+    It returns None if the file is not a 1D regularly sampled spectrum, in
+    which case the complete file should be read.
+    """
+    primary = hdulist['PRIMARY']
+    hdr = primary.header
+    if not (type(primary) is pyfits.hdu.image.PrimaryHDU or type(primary) is pyfits.hdu.image.ImageHDU):
+        return None
+    if hdr.get('NAXIS') != 1 or hdr.get('WFITTYPE') == 'LOG-LINEAR':
+        return None
+    if hdr.get('CD1_1') is not None:
+        wave_step = hdr['CD1_1']
+    elif hdr.get('CDELT1') is not None:
+        wave_step = hdr['CDELT1']
+    else:
+        return None
+    if wave_step == 0:
+        return None
+    wave_base = hdr['CRVAL1']
+    reference_pixel = hdr['CRPIX1']
+    num_measures = hdr['NAXIS1']
+    if str(hdr.get('CUNIT1')).upper() not in ['NM']:
+        # Angstrom to nm
+        wave_base /= 10
+        wave_step /= 10
+
+    # Find the errors in the extensions (HDU different than the PRIMARY) without reading them
+    err_hdu = None
+    err_conversion = None
+    for i in range(len(hdulist)):
+        name = hdulist[i].name.upper()
+        if name == str('PRIMARY') or not isinstance(hdulist[i], pyfits.hdu.image.ImageHDU) or hdulist[i].header.get('NAXIS', 0) == 0 \
+                or np.prod(hdulist[i].shape) != num_measures:
+            continue
+        if 'IVAR' in name or 'IVARIANCE' in name:
+            err_conversion = lambda values: np.sqrt(1. / values)
+        elif 'VAR' in name or 'VARIANCE' in name:
+            err_conversion = np.sqrt
+        elif 'NOISE' in name or 'ERR' in name or 'SIGMA' in name:
+            err_conversion = lambda values: values
+        else:
+            continue
+        if hdulist[i].header.get('NAXIS') != 1:
+            return None
+        err_hdu = hdulist[i]
+        break
+
+    # Pixel ranges covering each region, overlapping ranges are merged
+    pixel = lambda w: (w - wave_base)/wave_step + reference_pixel - 1
+    ranges = []
+    for region in regions:
+        pixel_base, pixel_top = sorted((pixel(region['wave_base']), pixel(region['wave_top'])))
+        base = int(max(0, np.floor(pixel_base) - 1))
+        top = int(min(num_measures, np.ceil(pixel_top) + 2))
+        if top > base:
+            ranges.append([base, top])
+    ranges.sort()
+    merged_ranges = []
+    for base, top in ranges:
+        if len(merged_ranges) > 0 and base <= merged_ranges[-1][1]:
+            merged_ranges[-1][1] = max(merged_ranges[-1][1], top)
+        else:
+            merged_ranges.append([base, top])
+
+    if len(merged_ranges) == 0:
+        return create_spectrum_structure(np.zeros(0))
+    def read_sections(hdu):
+        if compressed:
+            # Compressed files can only be read sequentially, read a single
+            # block from the first to the last pixel needed
+            first_base = merged_ranges[0][0]
+            block = hdu.section[first_base:merged_ranges[-1][1]]
+            return np.hstack([block[base-first_base:top-first_base] for base, top in merged_ranges])
+        else:
+            return np.hstack([hdu.section[base:top] for base, top in merged_ranges])
+
+    indices = np.hstack([np.arange(base, top) for base, top in merged_ranges])
+    waveobs = (indices - reference_pixel + 1)*wave_step + wave_base
+    spectrum = create_spectrum_structure(waveobs, read_sections(primary))
+    if err_hdu is not None:
+        spectrum['err'] = err_conversion(read_sections(err_hdu))
+    return spectrum
+
+def __read_fits_spectrum(spectrum_filename, regions=None):
     """
     Reads the 'PRIMARY' HDU of the FITS file, considering that it contains the fluxes.
 
@@ -47,9 +148,19 @@ def __read_fits_spectrum(spectrum_filename):
 
     Finally, if nothing has worked, it searches for a binary table with 3 columns
     'AWAV', 'FLUXES' and 'SIGMA'.
+
+    If regions are provided and the spectrum is regularly sampled, only the
+    pixels covering the regions are read.
     """
     hdulist = pyfits.open(spectrum_filename)
 
+    if regions is not None:
+        compressed = spectrum_filename[-3:].lower() == ".gz"
+        spectrum = __read_fits_spectrum_regions(hdulist, regions, compressed=compressed)
+        if spectrum is not None:
+            hdulist.close()
+            return spectrum
+
     data = hdulist['PRIMARY'].data
     hdr = hdulist['PRIMARY'].header
 
@@ -184,31 +295,137 @@ def __read_fits_spectrum(spectrum_filename):
 
     return spectrum
 
-def __read_spectrum(spectrum_filename):
+def __read_spectrum(spectrum_filename, chunk_size=16*1024*1024):
+    """
+    Read a plain text spectrum (compressed in gzip format if the filename ends
+    with '.gz', which is decompressed in memory) with three columns: wavelength,
+    flux and error.
+
+    The dialect is detected only once from the header:
+
+    - iSpec format: the first line contains the tab separated column names
+    - NARVAL/ESPaDOnS format: two header lines, lines separated by '\\r' or
+      '\\n' and columns separated by spaces
+
+    The file is parsed in chunks of 'chunk_size' bytes directly into numeric
+    arrays, without building intermediate Python objects per line.
+    """
+    if spectrum_filename[-3:].lower() == ".gz":
+        spectrum_file = gzip.open(spectrum_filename, 'rb')
+    else:
+        spectrum_file = open(spectrum_filename, 'rb')
+
+    values = []
+    pending = b""
+    header_lines = None
     try:
-        spectrum = np.array([tuple(line.rstrip('\r\n').split("\t")) for line in open(spectrum_filename,)][1:], dtype=[('waveobs', float),('flux', float),('err', float)])
-        if len(spectrum) == 0:
-            raise Exception("Empty spectrum or incompatible format")
-    except Exception as err:
-        # try narval plain text format:
-        # - ignores 2 first lines (header)
-        # - ignores last line (empty)
-        # - lines separated by \r
-        # - columns separated by space
-        try:
-            narval = open(spectrum_filename,).readlines()[0].split('\r')
-            spectrum = np.array([tuple(line.rstrip('\r').split()) for line in narval[2:-1]], dtype=[('waveobs', float),('flux', float),('err', float)])
-            if len(spectrum) == 0:
-                raise Exception("Empty spectrum or incompatible format")
-        except:
-            # try espadons plain text format:
-            # - ignores 2 first lines (header)
-            # - columns separated by space
-            espadons = open(spectrum_filename,).readlines()
-            spectrum = np.array([tuple(line.rstrip('\r').split()) for line in espadons[2:]], dtype=[('waveobs', float),('flux', float),('err', float)])
-
-    if len(spectrum) == 0:
+        while True:
+            chunk = spectrum_file.read(chunk_size)
+            eof = len(chunk) == 0
+            if b'\r' in chunk:
+                # NARVAL spectra use '\r' as line separator
+                chunk = chunk.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+            chunk = pending + chunk
+            if header_lines is None:
+                if chunk.count(b'\n') < 2 and not eof:
+                    # Wait until the full header is available
+                    pending = chunk
+                    continue
+                first_line = chunk.split(b'\n', 1)[0]
+                if len(first_line.split(b'\t')) == 3:
+                    # iSpec format: one line with the column names
+                    header_lines = 1
+                else:
+                    # NARVAL/ESPaDOnS format: two header lines
+                    header_lines = 2
+                for i in range(header_lines):
+                    position = chunk.find(b'\n')
+                    chunk = chunk[position+1:] if position >= 0 else b""
+            if eof:
+                pending = b""
+            else:
+                # Only parse complete lines, the rest is kept for the next chunk
+                position = chunk.rfind(b'\n')
+                pending = chunk[position+1:]
+                chunk = chunk[:position+1]
+            if len(chunk) > 0:
+                try:
+                    with warnings.catch_warnings():
+                        # Older numpy versions only warn when the text cannot be fully parsed
+                        warnings.simplefilter("error", DeprecationWarning)
+                        chunk_values = np.fromstring(chunk.decode('latin-1'), dtype=float, sep=' ')
+                except (ValueError, DeprecationWarning):
+                    raise Exception("Empty spectrum or incompatible format")
+                if len(chunk_values) % 3 != 0:
+                    raise Exception("Empty spectrum or incompatible format")
+                values.append(chunk_values)
+            if eof:
+                break
+    finally:
+        spectrum_file.close()
+
+    if len(values) == 0:
+        raise Exception("Empty spectrum or incompatible format")
+    values = np.concatenate(values) if len(values) > 1 else values[0]
+    if len(values) == 0:
         raise Exception("Empty spectrum or incompatible format")
+    # Zero-copy view of the (N, 3) values as the spectrum structure
+    spectrum = values.reshape(-1, 3).view(dtype=[('waveobs', float),('flux', float),('err', float)])[:, 0]
+    return spectrum.view(np.recarray)
+
+def __is_binary_spectrum_filename(spectrum_filename):
+    return spectrum_filename[-6:].lower() == ".ispec"
+
+def __read_binary_spectrum(spectrum_filename, regions=None):
+    """
+    Read a spectrum in iSpec binary format (see write_spectrum). The file is
+    memory-mapped and, if regions are provided and the wavelengths are sorted,
+    the ranges to be read are located by a binary search over the wavelength
+    column so that only the needed flux/error pages are read from disk.
+    """
+    with open(spectrum_filename, 'rb') as spectrum_file:
+        header = spectrum_file.read(_BINARY_SPECTRUM_HEADER_SIZE)
+    if len(header) < _BINARY_SPECTRUM_HEADER_SIZE:
+        raise Exception("Empty spectrum or incompatible format")
+    magic, version, itemsize, flags, num_measures = struct.unpack(_BINARY_SPECTRUM_HEADER_FORMAT, header[:struct.calcsize(_BINARY_SPECTRUM_HEADER_FORMAT)])
+    if magic != _BINARY_SPECTRUM_MAGIC or itemsize not in (4, 8):
+        raise Exception("Empty spectrum or incompatible format")
+    if version > _BINARY_SPECTRUM_VERSION:
+        raise Exception("Unsupported binary spectrum version %i" % (version))
+    if num_measures == 0:
+        return create_spectrum_structure(np.zeros(0))
+
+    values_dtype = np.dtype('<f%i' % (itemsize))
+    waveobs = np.memmap(spectrum_filename, dtype='<f8', mode='r', offset=_BINARY_SPECTRUM_HEADER_SIZE, shape=(num_measures,))
+    flux_offset = _BINARY_SPECTRUM_HEADER_SIZE + 8*num_measures
+    flux = np.memmap(spectrum_filename, dtype=values_dtype, mode='r', offset=flux_offset, shape=(num_measures,))
+    err = np.memmap(spectrum_filename, dtype=values_dtype, mode='r', offset=flux_offset + itemsize*num_measures, shape=(num_measures,))
+
+    is_sorted = flags & _BINARY_SPECTRUM_SORTED
+    if regions is not None and is_sorted:
+        # Index ranges for each region, overlapping ranges are merged
+        # to avoid duplicated measurements
+        ranges = []
+        for region in np.sort(regions, order='wave_base'):
+            base = waveobs.searchsorted(region['wave_base'], side='left')
+            top = waveobs.searchsorted(region['wave_top'], side='right')
+            if top <= base:
+                continue
+            if len(ranges) > 0 and base <= ranges[-1][1]:
+                ranges[-1][1] = max(ranges[-1][1], top)
+            else:
+                ranges.append([base, top])
+        num_selected = np.sum([top - base for base, top in ranges], dtype=int)
+        spectrum = create_spectrum_structure(np.zeros(num_selected))
+        position = 0
+        for base, top in ranges:
+            spectrum['waveobs'][position:position+top-base] = waveobs[base:top]
+            spectrum['flux'][position:position+top-base] = flux[base:top]
+            spectrum['err'][position:position+top-base] = err[base:top]
+            position += top - base
+    else:
+        spectrum = create_spectrum_structure(waveobs, flux, err)
+    del waveobs, flux, err
     return spectrum
 
 def read_spectrum(spectrum_filename, apply_filters=True, sort=True, regions=None):
@@ -235,27 +452,23 @@ def read_spectrum(spectrum_filename, apply_filters=True, sort=True, regions=None
     the case, then it tries to load the PRIMARY spectra by default and tries to search the errors
     in the extensions of the FITS file. In case the PRIMARY is empty, it searches for binary tables
     with wavelengths, fluxes and errors.
+
+    ** Files with the extension .ISPEC are read as iSpec binary spectra (see write_spectrum),
+    which are memory-mapped. If regions are specified, only the measurements inside them
+    are read from disk.
     """
     # If it is not compressed
-    if os.path.exists(spectrum_filename) and (spectrum_filename[-4:].lower() == ".fit" or spectrum_filename[-5:].lower() == ".fits" or \
+    if os.path.exists(spectrum_filename) and __is_binary_spectrum_filename(spectrum_filename):
+        spectrum = __read_binary_spectrum(spectrum_filename, regions=regions)
+    elif os.path.exists(spectrum_filename) and (spectrum_filename[-4:].lower() == ".fit" or spectrum_filename[-5:].lower() == ".fits" or \
             spectrum_filename[-7:].lower() == ".fit.gz" or spectrum_filename[-8:].lower() == ".fits.gz"):
-        spectrum = __read_fits_spectrum(spectrum_filename)
+        spectrum = __read_fits_spectrum(spectrum_filename, regions=regions)
     elif os.path.exists(spectrum_filename) and spectrum_filename[-3:].lower() != ".gz":
         spectrum = __read_spectrum(spectrum_filename)
     elif (os.path.exists(spectrum_filename) and spectrum_filename[-3:].lower() == ".gz") or (os.path.exists(spectrum_filename.lower() + ".gz")):
         if spectrum_filename[-3:] != ".gz":
             spectrum_filename = spectrum_filename + ".gz"
-
-        tmp_spec = tempfile.mktemp() + str(int(random.random() * 100000000))
-        # Uncompress to a temporary file
-        f_out = open(tmp_spec, 'wb')
-        f_in = gzip.open(spectrum_filename, 'rb')
-        f_out.writelines(f_in)
-        f_out.close()
-        f_in.close()
-
-        spectrum = __read_spectrum(tmp_spec)
-        os.remove(tmp_spec)
+        spectrum = __read_spectrum(spectrum_filename)
     else:
         raise Exception("Spectrum file does not exists: %s" %(spectrum_filename))
 
@@ -293,7 +506,99 @@ def read_spectrum(spectrum_filename, apply_filters=True, sort=True, regions=None
 
     return spectrum
 
-def write_spectrum(spectrum, spectrum_filename):
+def _timed_read_spectrum(spectrum_filename, apply_filters=True, sort=True, regions=None):
+    """
+    Read a spectrum and measure the elapsed time. Exceptions are returned
+    instead of raised so that a failing file does not abort a batch.
+    """
+    tcheck = time.time()
+    try:
+        spectrum = read_spectrum(spectrum_filename, apply_filters=apply_filters, sort=sort, regions=regions)
+        error = None
+    except Exception as e:
+        spectrum = None
+        error = e
+    return spectrum, time.time() - tcheck, error
+
+def read_spectra(spectrum_filenames, workers=1, regions=None, apply_filters=True, sort=True, use_processes=False):
+    """
+    Read several spectra concurrently with a pool of 'workers' threads (or
+    processes if 'use_processes' is True). Decompression and parsing release
+    the GIL in large parts, thus threads are usually enough.
+
+    It is a generator that yields a tuple (spectrum_filename, spectrum, elapsed, error)
+    for each file as soon as it is ready (not necessarily in the same order
+    as 'spectrum_filenames'). If a file could not be read, 'spectrum' is None
+    and 'error' contains the exception, the rest of the batch is not aborted.
+    The arguments 'regions', 'apply_filters' and 'sort' are passed to read_spectrum.
+    """
+    import concurrent.futures
+    if use_processes:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers)
+    else:
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    try:
+        futures = {}
+        for spectrum_filename in spectrum_filenames:
+            future = executor.submit(_timed_read_spectrum, spectrum_filename, apply_filters=apply_filters, sort=sort, regions=regions)
+            futures[future] = spectrum_filename
+        for future in concurrent.futures.as_completed(futures):
+            spectrum_filename = futures[future]
+            try:
+                spectrum, elapsed, error = future.result()
+            except Exception as e:
+                # i.e., a worker process died
+                spectrum, elapsed, error = None, 0., e
+            if error is not None:
+                logging.warning("Spectrum '{}' could not be read: {}".format(spectrum_filename, error))
+            else:
+                logging.info("Spectrum '{}' read in {:.3f} seconds".format(spectrum_filename, elapsed))
+            yield spectrum_filename, spectrum, elapsed, error
+    finally:
+        # Pending reads are cancelled if the generator is not exhausted
+        for future in futures:
+            future.cancel()
+        executor.shutdown(wait=True)
+
+def __write_binary_spectrum(spectrum, spectrum_filename, flux_dtype=float):
+    values_dtype = np.dtype(flux_dtype)
+    if values_dtype.kind != 'f' or values_dtype.itemsize not in (4, 8):
+        raise Exception("Binary spectra only support float32 or float64 fluxes")
+    values_dtype = values_dtype.newbyteorder('<')
+    num_measures = len(spectrum)
+    flags = 0
+    if np.all(spectrum['waveobs'][1:] >= spectrum['waveobs'][:-1]):
+        flags |= _BINARY_SPECTRUM_SORTED
+    header = struct.pack(_BINARY_SPECTRUM_HEADER_FORMAT, _BINARY_SPECTRUM_MAGIC, _BINARY_SPECTRUM_VERSION, values_dtype.itemsize, flags, num_measures)
+    with open(spectrum_filename, 'wb') as spectrum_file:
+        spectrum_file.write(header.ljust(_BINARY_SPECTRUM_HEADER_SIZE, b'\0'))
+        spectrum_file.write(np.ascontiguousarray(spectrum['waveobs'], dtype='<f8').tobytes())
+        spectrum_file.write(np.ascontiguousarray(spectrum['flux'], dtype=values_dtype).tobytes())
+        spectrum_file.write(np.ascontiguousarray(spectrum['err'], dtype=values_dtype).tobytes())
+
+def __write_plain_text_spectrum(spectrum, out, precision=None, chunk_size=100000):
+    """
+    Write the spectrum as tab separated text into an already opened binary file
+    object. Rows are formatted in chunks with a single string formatting
+    operation per chunk.
+    """
+    if precision is None:
+        # Shortest representation that can be read back without losing precision
+        value_format = "%r"
+    else:
+        value_format = "%%.%ig" % (precision)
+    line_format = "\t".join([value_format]*3) + "\n"
+    out.write(b"waveobs\tflux\terr\n")
+    values = np.empty((min(chunk_size, len(spectrum)), 3))
+    for i in range(0, len(spectrum), chunk_size):
+        num_values = min(chunk_size, len(spectrum) - i)
+        values[:num_values, 0] = spectrum['waveobs'][i:i+num_values]
+        values[:num_values, 1] = spectrum['flux'][i:i+num_values]
+        values[:num_values, 2] = spectrum['err'][i:i+num_values]
+        text = (line_format * num_values) % tuple(values[:num_values].ravel().tolist())
+        out.write(text.encode('ascii'))
+
+def write_spectrum(spectrum, spectrum_filename, flux_dtype=float, precision=None, compresslevel=6):
     """
     Write spectrum to a file with the following file format:
     ::
@@ -308,8 +613,22 @@ def write_spectrum(spectrum, spectrum_filename):
     in FITS format. If the spectrum is not regularly sampled, then it will save
     the flux and the wavelengths as a matrix in the primary HDU. If the errors
     are different from zero, they will be saved as an extension.
+
+    ** If the filename has the extension ".ISPEC", then the file is saved in
+    iSpec uncompressed binary format: a fixed size header followed by the
+    wavelengths (float64), fluxes and errors (float64 or float32 depending on
+    'flux_dtype') stored as contiguous columns. It can be memory-mapped by
+    read_spectrum, which reads only the regions that are requested.
+
+    Plain text files are written with the shortest representation that keeps
+    the full float precision, unless 'precision' (number of significant digits)
+    is specified. If the filename has the extension ".gz", the text is directly
+    compressed in gzip format with the given 'compresslevel' (1 is the fastest,
+    9 the smallest file).
     """
-    if spectrum_filename[-4:].lower() == ".fit" or spectrum_filename[-5:].lower() == ".fits" or \
+    if __is_binary_spectrum_filename(spectrum_filename):
+        __write_binary_spectrum(spectrum, spectrum_filename, flux_dtype=flux_dtype)
+    elif spectrum_filename[-4:].lower() == ".fit" or spectrum_filename[-5:].lower() == ".fits" or \
             spectrum_filename[-7:].lower() == ".fit.gz" or spectrum_filename[-8:].lower() == ".fits.gz":
         header = pyfits.Header()
         header.set('ORIGIN', "iSpec")
@@ -373,24 +692,17 @@ def write_spectrum(spectrum, spectrum_filename):
 
         fits_format.writeto(spectrum_filename, overwrite=True)
     elif spectrum_filename[-3:].lower() == ".gz":
-        tmp_spec = tempfile.mktemp() + str(int(random.random() * 100000000))
-        out = open(tmp_spec, "w")
-        out.write("waveobs\tflux\terr\n")
-        out.write("\n".join(["\t".join(map(str, (line['waveobs'], line['flux'], line['err']))) for line in spectrum]))
-        out.close()
-
-        # Compress the temporary file
-        f_in = open(tmp_spec, 'rb')
-        f_out = gzip.open(spectrum_filename, 'wb')
-        f_out.writelines(f_in)
-        f_out.close()
-        f_in.close()
-        os.remove(tmp_spec)
+        out = gzip.open(spectrum_filename, "wb", compresslevel=compresslevel)
+        try:
+            __write_plain_text_spectrum(spectrum, out, precision=precision)
+        finally:
+            out.close()
     else:
-        out = open(spectrum_filename, "w")
-        out.write("waveobs\tflux\terr\n")
-        out.write("\n".join(["\t".join(map(str, (line['waveobs'], line['flux'], line['err']))) for line in spectrum]))
-        out.close()
+        out = open(spectrum_filename, "wb")
+        try:
+            __write_plain_text_spectrum(spectrum, out, precision=precision)
+        finally:
+            out.close()
 
 
 def normalize_spectrum(spectrum, continuum_model, consider_continuum_errors=True):
@@ -478,6 +790,100 @@ def __fwhm_to_sigma(fwhm):
     sigma = fwhm/ (2*np.sqrt(2*np.log(2)))
     return sigma
 
+def _interpolation(waveobs, fluxes, err, resampled_waveobs, bessel=False, zero_edges=True, frame=None):
+    """
+    Interpolate flux for a given wavelength by using Bessel's Central-Difference Interpolation.
+    It considers:
+
+    - 4 points in general
+    - 2 when there are not more (i.e. at the beginning of the array or outside)
+
+    * It does not interpolate if any of the fluxes used for interpolation is zero or negative
+      this way it can respect gaps in the spectrum
+
+    Vectorized version (used when the optimized one cannot be compiled): the
+    positions of all the target wavelengths are found at once (searchsorted)
+    and 'fluxes'/'err' can be 2D arrays (one spectrum per row) sharing the same
+    'waveobs', in which case the resampled fluxes and errors are also 2D.
+    """
+    if frame is not None:
+        frame.update_progress(0)
+
+    single_spectrum = np.ndim(fluxes) == 1
+    waveobs = np.asarray(waveobs, dtype=float)
+    resampled_waveobs = np.asarray(resampled_waveobs)
+    fluxes = np.atleast_2d(np.asarray(fluxes, dtype=float))
+    err = np.atleast_2d(np.asarray(err, dtype=float))
+    if fluxes.shape[1] != len(waveobs) or err.shape != fluxes.shape:
+        raise Exception("Fluxes and errors should have the same number of points as wavelengths")
+
+    total_points = len(waveobs)
+    n_spectra = fluxes.shape[0]
+    resampled_flux = np.zeros((n_spectra, len(resampled_waveobs)))
+    resampled_err = np.zeros((n_spectra, len(resampled_waveobs)))
+
+    # Index position of the first wavelength equal or higher than each objective
+    index = np.searchsorted(waveobs, resampled_waveobs)
+    before = index == 0
+    after = index == total_points
+    if not zero_edges:
+        # JUST DUPLICATE the first/last value (otherwise JUST ZERO)
+        resampled_flux[:, before] = fluxes[:, :1]
+        resampled_err[:, before] = err[:, :1]
+        resampled_flux[:, after] = fluxes[:, -1:]
+        resampled_err[:, after] = err[:, -1:]
+    inside = ~np.logical_or(before, after)
+    if bessel:
+        use_bessel = np.logical_and(inside, np.logical_and(index > 1, index < total_points-1))
+    else:
+        use_bessel = np.zeros(len(index), dtype=bool)
+    use_linear = np.logical_and(inside, ~use_bessel)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Linear interpolation between index and index-1
+        i = index[use_linear]
+        d1 = np.round(resampled_waveobs[use_linear] - waveobs[i-1], 5)
+        d2 = np.round(waveobs[i] - waveobs[i-1], 5)
+        flux_x0 = fluxes[:, i-1]
+        flux_x1 = fluxes[:, i]
+        new_flux = flux_x0 + d1 * ((flux_x1 - flux_x0) / d2)
+        new_err = (err[:, i-1] * (d2 - d1) + (err[:, i] * d1)) / d2
+        gaps = np.logical_or(flux_x0 <= 1e-10, flux_x1 <= 1e-10)
+        resampled_flux[:, use_linear], resampled_err[:, use_linear] = __validate_interpolation(new_flux, new_err, gaps)
+
+        # Bessel's Central-Difference Interpolation with 4 points
+        #   p = [(x - x0) / (x1 - x0)]
+        #   f(x) = f(x0) + p ( f(x1) - f(x0) ) + [ p ( p - 1 ) / 4 ] ( f(x2) - f(x1) - f(x0) + f(x-1) )
+        i = index[use_bessel]
+        p = (resampled_waveobs[use_bessel] - waveobs[i-1]) / (waveobs[i] - waveobs[i-1])
+        factor = (p * (p - 1) / 4)
+        flux_x_1 = fluxes[:, i-2]
+        flux_x0 = fluxes[:, i-1]
+        flux_x1 = fluxes[:, i]
+        flux_x2 = fluxes[:, i+1]
+        new_flux = flux_x0 + p * (flux_x1 - flux_x0) + factor * (flux_x2 - flux_x1 - flux_x0 + flux_x_1)
+        new_err = err[:, i-2] * factor + err[:, i-1] * (1 - p - factor) + err[:, i] * (p - factor) + err[:, i+1] * factor
+        gaps = np.any([flux_x_1 <= 1e-10, flux_x0 <= 1e-10, flux_x1 <= 1e-10, flux_x2 <= 1e-10], axis=0)
+        resampled_flux[:, use_bessel], resampled_err[:, use_bessel] = __validate_interpolation(new_flux, new_err, gaps)
+
+    if frame is not None:
+        frame.update_progress(100)
+
+    if single_spectrum:
+        return resampled_waveobs, resampled_flux[0], resampled_err[0]
+    return resampled_waveobs, resampled_flux, resampled_err
+
+def __validate_interpolation(flux, err, gaps):
+    """
+    Do not allow negative fluxes or errors and do not interpolate if any of the
+    fluxes is zero or negative (gaps).
+    """
+    err[err < 0] = 1e-10
+    invalid = np.logical_or(flux < 0, gaps)
+    flux[invalid] = 0
+    err[invalid] = 0
+    return flux, err
+
 try:
     import pyximport
     import numpy as np
@@ -489,138 +895,7 @@ except:
     print("Not optimized version loaded!")
     print("*********************************************************************")
 
-    def __interpolation(waveobs, fluxes, err, resampled_waveobs, bessel=False, zero_edges=True, frame=None):
-        """
-        Interpolate flux for a given wavelength by using Bessel's Central-Difference Interpolation.
-        It considers:
-
-        - 4 points in general
-        - 2 when there are not more (i.e. at the beginning of the array or outside)
-
-        * It does not interpolate if any of the fluxes used for interpolation is zero or negative
-        this way it can respect gaps in the spectrum
-        """
-        last_reported_progress = -1
-        current_work_progress = 10.0
-
-        total_points = len(waveobs)
-        new_total_points = len(resampled_waveobs)
-        resampled_flux = np.zeros(new_total_points)
-        resampled_err = np.zeros(new_total_points)
-        from_index = 0 # Optimization: discard regions already processed
-        for i in np.arange(new_total_points):
-            # Target wavelength
-            objective_wavelength = resampled_waveobs[i]
-
-            # Find the index position of the first wave length equal or higher than the objective
-            index = waveobs[from_index:].searchsorted(objective_wavelength)
-            index += from_index
-
-            if index == total_points:
-                # DISCARD: Linear extrapolation using index-1 and index-2
-                # flux = fluxes[index-1] + (objective_wavelength - waveobs[index-1]) * ((fluxes[index-1]-fluxes[index-2])/(waveobs[index-1]-waveobs[index-2]))
-                if zero_edges:
-                    # JUST ZERO:
-                    resampled_flux[i] = 0.0
-                    resampled_err[i] = 0.0
-                else:
-                    # JUST DUPLICATE:
-                    resampled_flux[i] = fluxes[index-1]
-                    resampled_err[i] = err[index-1]
-            #elif index == 0 and waveobs[index] != objective_wavelength:
-            elif index == 0:
-                # DISCARD: Linear extrapolation using index+1 and index
-                # flux = fluxes[index] + (objective_wavelength - waveobs[index]) * ((fluxes[index+1]-fluxes[index])/(waveobs[index+1]-waveobs[index]))
-                if zero_edges:
-                    # JUST ZERO:
-                    resampled_flux[i] = 0.0
-                    resampled_err[i] = 0.0
-                else:
-                    # JUST DUPLICATE:
-                    resampled_flux[i] = fluxes[index]
-                    resampled_err[i] = err[index]
-            # Do not do this optimization because it can produce a value surounded
-            # by zeros because of the condition "Do not interpolate if any of the
-            # fluxes is zero or negative" implemented in the rest of the cases
-            #elif waveobs[index] == objective_wavelength:
-                #resampled_flux[i] = fluxes[index]
-                #resampled_err[i] = err[index]
-            else:
-                if not bessel or index == 1 or index == total_points-1:
-                    # Do not interpolate if any of the fluxes is zero or negative
-                    if fluxes[index-1] <= 1e-10 or fluxes[index] <= 1e-10:
-                        resampled_flux[i] = 0.0
-                        resampled_err[i] = 0.0
-                    else:
-                        # Linear interpolation between index and index-1
-                        # http://en.wikipedia.org/wiki/Linear_interpolation#Linear_interpolation_between_two_known_points
-                        d1 = (objective_wavelength - waveobs[index-1])
-                        d2 = (waveobs[index]-waveobs[index-1])
-                        resampled_flux[i] = fluxes[index-1] + d1 * ((fluxes[index]-fluxes[index-1])/d2)
-                        # Same formula as for interpolation but I have re-arranged the terms to make
-                        # clear that it is valid for error propagation (sum of errors multiplied by constant values)
-                        resampled_err[i] = (err[index-1] * (d2 - d1)  + (err[index] * d1)) / d2
-                        # Do not allow negative fluxes or errors
-                        if resampled_err[i] < 0:
-                            resampled_err[i] = 1e-10
-                        if resampled_flux[i] < 0:
-                            resampled_flux[i] = 0
-                            resampled_err[i] = 0
-                else:
-                    # Bessel's Central-Difference Interpolation with 4 points
-                    #   p = [(x - x0) / (x1 - x0)]
-                    #   f(x) = f(x0) + p ( f(x1) - f(x0) ) + [ p ( p - 1 ) / 4 ] ( f(x2) - f(x1) - f(x0) + f(x-1) )
-                    # where x-1 < x0 < objective_wavelength = x < x1 < x2 and f() is the flux
-                    #   http://physics.gmu.edu/~amin/phys251/Topics/NumAnalysis/Approximation/polynomialInterp.html
-
-                    #  x-1= index - 2
-                    #  x0 = index - 1
-                    #  x  = objective_wavelength
-                    #  x1 = index
-                    #  x2 = index + 1
-
-                    ## Array access optimization
-                    flux_x_1 = fluxes[index - 2]
-                    wave_x0 = waveobs[index-1]
-                    flux_x0 = fluxes[index - 1]
-                    wave_x1 = waveobs[index]
-                    flux_x1 = fluxes[index]
-                    flux_x2 = fluxes[index + 1]
-
-                    err_x_1 = err[index - 2]
-                    err_x0 = err[index - 1]
-                    err_x1 = err[index]
-                    err_x2 = err[index + 1]
-
-                    # Do not interpolate if any of the fluxes is zero or negative
-                    if flux_x_1 <= 1e-10 or flux_x0 <= 1e-10 or flux_x1 <= 1e-10 or flux_x2 <= 1e-10:
-                        resampled_flux[i] = 0.0
-                        resampled_err[i] = 0.0
-                    else:
-                        p = (objective_wavelength - wave_x0)/ (wave_x1 - wave_x0)
-                        factor = (p * (p - 1)/ 4)
-                        resampled_flux[i] = flux_x0 + p * (flux_x1 - flux_x0) + factor * (flux_x2 - flux_x1 - flux_x0 + flux_x_1)
-                        # Same formula as for interpolation but I have re-arranged the terms to make
-                        # clear that it is valid for error propagation (sum of errors multiplied by constant values)
-                        resampled_err[i] = err_x_1 * factor + err_x0 * (1 - p - factor) + err_x1 * (p - factor) + err_x2 * factor
-                        # Do not allow negative fluxes or errors
-                        if resampled_err[i] < 0:
-                            resampled_err[i] = 1e-10
-                        if resampled_flux[i] < 0:
-                            resampled_flux[i] = 0
-                            resampled_err[i] = 0
-
-            if index > 4:
-                from_index = index - 4
-
-            current_work_progress = np.min([(i*1.0/ new_total_points) * 100, 90.0])
-            if report_progress(current_work_progress, last_reported_progress):
-                last_reported_progress = current_work_progress
-                #logging.info("%.2f%%" % current_work_progress)
-                if frame is not None:
-                    frame.update_progress(current_work_progress)
-
-        return resampled_waveobs, resampled_flux, resampled_err
+    __interpolation = _interpolation
 
     def __convolve_spectrum_slow(waveobs, flux, err, to_resolution, from_resolution=None, frame=None):
         """
@@ -790,7 +1065,75 @@ except:
 
         return waveobs, convolved_flux, convolved_err
 
-def convolve_spectrum(spectrum, to_resolution, from_resolution=None, frame=None):
+def _velocity_sampling(waveobs):
+    """
+    Smallest velocity step (km/s) between consecutive wavelengths, limited to
+    0.05 km/s (1% the width of solar line profiles) to avoid huge grids.
+    """
+    c = 299792.4580 # km/s
+    velocity_steps = c * (waveobs[1:] - waveobs[:-1]) / waveobs[:-1]
+    return np.max((np.min(velocity_steps[velocity_steps > 0]), 0.05))
+
+def _instrumental_fwhm_in_velocity(to_resolution, from_resolution=None):
+    """
+    FWHM in km/s of the gaussian needed to convolve a spectrum to a given
+    resolution (or to degrade it from 'from_resolution'), which is constant in
+    velocity space.
+    """
+    c = 299792.4580 # km/s
+    if from_resolution is None or from_resolution == 0:
+        return c / to_resolution
+    else:
+        return c * np.sqrt(1. / to_resolution**2 - 1. / from_resolution**2)
+
+def _gaussian_kernel(fwhm, velocity_step):
+    """
+    Gaussian kernel sampled every velocity_step (km/s) and truncated at 2 times
+    the FWHM in each side (same window as the direct convolution).
+    """
+    sigma = __fwhm_to_sigma(fwhm) / velocity_step
+    half_width = max(int(np.ceil(2 * fwhm / velocity_step)), 1)
+    x = np.arange(-half_width, half_width+1)
+    kernel = np.exp(- (x**2) / (2*sigma**2))
+    return kernel / np.sum(kernel)
+
+def __convolve_spectrum_fft(waveobs, flux, err, to_resolution, from_resolution=None, velocity_step=None):
+    """
+    Convolution for a constant resolving power. The instrumental profile is a
+    gaussian with a fixed width in velocity space, thus the spectrum is resampled
+    to a grid uniform in velocity, convolved only once by using FFT and
+    resampled back to the original wavelengths.
+
+    Zero or negative fluxes are considered as gaps (like in the direct
+    convolution): they are excluded by normalizing the convolution with the
+    convolution of the mask of valid fluxes, and they are not convolved.
+    """
+    from scipy.signal import fftconvolve
+    from .lines import _sampling_uniform_in_velocity
+    if velocity_step is None:
+        velocity_step = _velocity_sampling(waveobs)
+    # Include the first wavelength, the grid remains uniform in velocity
+    waveobs_uniform_in_velocity = np.hstack((waveobs[0], _sampling_uniform_in_velocity(waveobs[0], waveobs[-1], velocity_step)))
+
+    valid = flux > 1e-10
+    mask = np.interp(waveobs_uniform_in_velocity, waveobs, np.asarray(valid, dtype=float))
+    masked_flux = np.interp(waveobs_uniform_in_velocity, waveobs, np.where(valid, flux, 0.))
+    masked_err = np.interp(waveobs_uniform_in_velocity, waveobs, np.where(valid, err, 0.))
+
+    kernel = _gaussian_kernel(_instrumental_fwhm_in_velocity(to_resolution, from_resolution), velocity_step)
+    convolved_mask = fftconvolve(mask, kernel, mode='same')
+    convolved_mask[convolved_mask < 1e-10] = np.inf # Avoid zero division (results will be zero)
+    convolved_flux = fftconvolve(masked_flux, kernel, mode='same') / convolved_mask
+    convolved_err = fftconvolve(masked_err, kernel, mode='same') / convolved_mask
+
+    # Resample to origin wavelength grid
+    convolved_flux = np.interp(waveobs, waveobs_uniform_in_velocity, convolved_flux)
+    convolved_err = np.interp(waveobs, waveobs_uniform_in_velocity, convolved_err)
+    convolved_flux[~valid] = 0.
+    convolved_err[np.logical_or(~valid, err <= 0)] = 0.
+    return waveobs, convolved_flux, convolved_err
+
+def convolve_spectrum(spectrum, to_resolution, from_resolution=None, frame=None, method="direct"):
     """
     Spectra resolution smoothness/degradation.
 
@@ -799,11 +1142,24 @@ def convolve_spectrum(spectrum, to_resolution, from_resolution=None, frame=None)
 
     If "from_resolution" is specified, the convolution is made with the difference of
     both resolutions in order to degrade the spectrum.
+
+    The method can be:
+
+    - method = "direct": a gaussian is built and applied for every wavelength point.
+    - method = "fft": the spectrum is resampled to a grid uniform in velocity (where
+      the gaussian has a constant width), convolved with FFT and resampled back.
+      It is much faster for large spectra at the cost of the small errors introduced
+      by the two resamplings.
     """
     if from_resolution is not None and from_resolution <= to_resolution:
         raise Exception("This method cannot deal with final resolutions that are bigger than original")
 
-    waveobs, flux, err = __convolve_spectrum(spectrum['waveobs'], spectrum['flux'], spectrum['err'], to_resolution, from_resolution=from_resolution, frame=frame)
+    if method.lower() == "direct":
+        waveobs, flux, err = __convolve_spectrum(spectrum['waveobs'], spectrum['flux'], spectrum['err'], to_resolution, from_resolution=from_resolution, frame=frame)
+    elif method.lower() == "fft":
+        waveobs, flux, err = __convolve_spectrum_fft(spectrum['waveobs'], spectrum['flux'], spectrum['err'], to_resolution, from_resolution=from_resolution)
+    else:
+        raise Exception("Unknown method")
     convolved_spectrum = create_spectrum_structure(waveobs, flux, err)
     return convolved_spectrum
 
@@ -893,6 +1249,24 @@ def resample_spectrum(spectrum, xaxis, method="linear", zero_edges=True, frame=N
     resampled_spectrum = create_spectrum_structure(xaxis, flux, err)
     return resampled_spectrum
 
+def resample_spectra(waveobs, fluxes, xaxis, err=None, method="linear", zero_edges=True):
+    """
+    Resample several spectra that share the same wavelengths (i.e. synthetic
+    spectra from a grid) to the given xaxis in one pass.
+
+    'fluxes' (and 'err' if given) are 2D arrays with one spectrum per row and
+    as many columns as 'waveobs'. The interpolation methods are the same as in
+    resample_spectrum ("linear" or "bessel") and the returned resampled fluxes
+    and errors are 2D arrays with one row per spectrum and len(xaxis) columns.
+    """
+    fluxes = np.atleast_2d(fluxes)
+    if err is None:
+        err = np.zeros(fluxes.shape)
+    if method.lower() not in ("linear", "bessel"):
+        raise Exception("Unknown method")
+    waveobs, resampled_fluxes, resampled_err = __interpolation(np.asarray(waveobs, dtype=float), fluxes, np.atleast_2d(err), np.asarray(xaxis, dtype=float), bessel=method.lower() == "bessel", zero_edges=zero_edges)
+    return resampled_fluxes, resampled_err
+
 def correct_velocity(spectrum, velocity, segments=None):
     """
     Correct velocity in km/s.
@@ -23,6 +23,7 @@ cdef extern from "math.h":
     double sqrt(double x)
     double exp(double x)
     double log(double x)
+    double rint(double x)
 
 cdef inline int int_max(int a, int b): return a if a >= b else b
 cdef inline int int_min(int a, int b): return a if a <= b else b
@@ -34,105 +35,122 @@ from cpython cimport bool
 cimport cython
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def convolve_spectrum(np.ndarray[np.double_t,ndim=1] waveobs, np.ndarray[np.double_t,ndim=1] flux, np.ndarray[np.double_t,ndim=1] err, double to_resolution, from_resolution=None, frame=None):
+@cython.cdivision(True)
+def convolve_spectrum(double[:] waveobs, double[:] flux, double[:] err, double to_resolution, from_resolution=None, frame=None):
+    """
+    Convolve each point with a gaussian defined by the resolution (or by the
+    difference of resolutions when 'from_resolution' is specified) considering
+    a window of 2 times the FWHM in each side.
+
+    Both window limits only move forward, thus they are found with two
+    pointers (O(N*k) cost with k the window size) and no arrays are allocated
+    per point.
+
+    * Zero or negative fluxes (<= 1e-10) are considered as gaps in the spectrum:
+      they are not convolved and they do not contribute to the convolution
+      of the surrounding points.
+    """
     if from_resolution != None and from_resolution <= to_resolution:
         raise Exception("This method cannot deal with final resolutions that are bigger than original")
-    cdef int total_points = len(waveobs)
-    cdef np.ndarray[np.double_t,ndim=1] convolved_flux = np.zeros(total_points)
-    cdef np.ndarray[np.double_t,ndim=1] convolved_err = np.zeros(total_points)
+    cdef Py_ssize_t total_points = waveobs.shape[0]
+    convolved_flux_array = np.zeros(total_points)
+    convolved_err_array = np.zeros(total_points)
+    cdef double[:] convolved_flux = convolved_flux_array
+    cdef double[:] convolved_err = convolved_err_array
+
+    cdef bint degrade = from_resolution != None and from_resolution != 0
+    cdef double from_res = from_resolution if degrade else 0.
+    cdef double pi = np.pi
     cdef double fwhm
     cdef double sigma
-
-    cdef int i
-
-    cdef double current_work_progress
-    cdef double last_reported_progress = -1
+    cdef double two_sigma_square
+    cdef double norm
+    cdef double lambda_peak
+    cdef double wave_base_limit
+    cdef double wave_top_limit
+    cdef double distance
+    cdef double gaussian
+    cdef double total_gaussian
+    cdef double current_flux
+    cdef double current_err
+    cdef bint propagate_err
+
+    cdef Py_ssize_t i
+    cdef Py_ssize_t x
+    cdef Py_ssize_t wave_filter_base = 0
+    # Window upper limit (excluded), it is only updated when a point beyond
+    # lambda_peak + 2*fwhm exists, otherwise the previous one is kept
+    cdef Py_ssize_t wave_filter_top = total_points
+    cdef Py_ssize_t top_pointer = 0
+
+    # Report progress only every 10%
+    cdef Py_ssize_t progress_step = total_points // 10 if total_points >= 10 else 1
     if frame != None:
         frame.update_progress(0)
 
-    cdef double lambda_peak
-    cdef int wave_filter_base
-    cdef int wave_filter_top
-    cdef np.ndarray[np.double_t,ndim=1] waveobs_window
-    cdef np.ndarray[np.double_t,ndim=1] flux_window
-    cdef np.ndarray[np.double_t,ndim=1] err_window
-    cdef np.ndarray[np.double_t,ndim=1] gaussian
-    cdef double total_gaussian
-    cdef int last_x = 0
-    cdef int x
-    cdef int y
-    for i in np.arange(total_points):
-    #for i from 0 <= i < total_points by 1:
+    for i in range(total_points):
         if flux[i] <= 1e-10:
             continue
 
+        lambda_peak = waveobs[i] # Current lambda (wavelength) to be modified
         # FWHM of the gaussian for the given resolution
-        if from_resolution == None or from_resolution == 0:
-            # Convolve using instrumental resolution (smooth but not degrade)
-            fwhm = waveobs[i] / to_resolution
-            sigma = fwhm / 2.3548200450309493 #(2*sqrt(2*log(2)))
-        else:
+        if degrade:
             # Degrade resolution
-            fwhm = sqrt(((1.0*waveobs[i]) / to_resolution)**2 - ((1.0*waveobs[i]) / from_resolution)**2)
-            sigma = fwhm / 2.3548200450309493 #(2*sqrt(2*log(2)))
-
-        lambda_peak = waveobs[i] # Current lambda (wavelength) to be modified
+            fwhm = sqrt(((1.0*lambda_peak) / to_resolution)**2 - ((1.0*lambda_peak) / from_res)**2)
+        else:
+            # Convolve using instrumental resolution (smooth but not degrade)
+            fwhm = lambda_peak / to_resolution
+        sigma = fwhm / 2.3548200450309493 #(2*sqrt(2*log(2)))
+        two_sigma_square = 2*sigma**2
+        norm = sqrt(2*pi*sigma)
 
         # Only work with a limited window considering 2 times the fwhm in each side of the current
         # position to be modified and saved in the convolved spectra
-        wave_filter_base = 0
-        for x from last_x <= x < len(waveobs) by 1:
-            if waveobs[x] >= lambda_peak - 2*fwhm:
-                wave_filter_base = x
-                break
-        last_x = x
-        for y from last_x <= y < len(waveobs) by 1:
-            if waveobs[y] >= lambda_peak + 2*fwhm:
-                wave_filter_top = y
-                break
-        waveobs_window = waveobs[wave_filter_base:wave_filter_top]
-        flux_window = flux[wave_filter_base:wave_filter_top]
-        if err[i] > 0:
-            # * Propagate error Only if the current value has a valid error value assigned
-            #
-            # Error propagation considering that measures are dependent (more conservative approach)
-            # because it is common to find spectra with errors calculated from a SNR which
-            # at the same time has been estimated from all the measurements in the same spectra
-            #
-            err_window = err[wave_filter_base:wave_filter_top]
-
-        # Construct the gaussian
-        gaussian = np.zeros(len(flux_window))
+        wave_base_limit = lambda_peak - 2*fwhm
+        wave_top_limit = lambda_peak + 2*fwhm
+        while wave_filter_base < total_points and waveobs[wave_filter_base] < wave_base_limit:
+            wave_filter_base += 1
+        if top_pointer < wave_filter_base:
+            top_pointer = wave_filter_base
+        while top_pointer < total_points and waveobs[top_pointer] < wave_top_limit:
+            top_pointer += 1
+        if top_pointer < total_points:
+            wave_filter_top = top_pointer
+
+        # * Propagate error Only if the current value has a valid error value assigned
+        #
+        # Error propagation considering that measures are dependent (more conservative approach)
+        # because it is common to find spectra with errors calculated from a SNR which
+        # at the same time has been estimated from all the measurements in the same spectra
+        propagate_err = err[i] > 0
+        current_flux = 0.0
+        current_err = 0.0
         total_gaussian = 0.0
-        for x from 0 <= x < len(flux_window) by 1:
-            gaussian[x] = exp(- ((waveobs_window[x] - lambda_peak)**2) / (2*sigma**2)) / sqrt(2*np.pi*sigma)
-            if flux_window[x] > 0.0: # Zero or negative values are considered as gaps in the spectrum
-                convolved_flux[i] += flux_window[x] * gaussian[x]
-                total_gaussian += gaussian[x]
-                if err[i] > 0:
-                    convolved_err[i] += err_window[x] * gaussian[x]
-                    #convolved_err[i] += (err_window[x] * gaussian[x]) * (err_window[x] * gaussian[x]) # Independent measurements
+        for x in range(wave_filter_base, wave_filter_top):
+            if flux[x] > 0.0: # Zero or negative values are considered as gaps in the spectrum
+                distance = waveobs[x] - lambda_peak
+                gaussian = exp(- (distance**2) / two_sigma_square) / norm
+                current_flux += flux[x] * gaussian
+                total_gaussian += gaussian
+                if propagate_err:
+                    current_err += err[x] * gaussian
         # Validate that the gaussian has been efective applied (in the borders it could lead to a zero division)
         if total_gaussian > 0:
-            convolved_flux[i] /= total_gaussian
-            #convolved_err[i] = sqrt(convolved_err[i]) # Independent measurements
-            convolved_err[i] /= total_gaussian
+            convolved_flux[i] = current_flux / total_gaussian
+            convolved_err[i] = current_err / total_gaussian
 
-        current_work_progress = (i*1.0 / total_points) * 100
-        if (int(current_work_progress) % 10 == 0 and current_work_progress - last_reported_progress > 10) or last_reported_progress < 0 or current_work_progress == 100:
-            last_reported_progress = current_work_progress
-            #logging.info("%.2f%%" % current_work_progress)
-            if frame != None:
-                frame.update_progress(current_work_progress)
+        if frame != None and i % progress_step == 0:
+            frame.update_progress((i*100.0) / total_points)
 
-    return waveobs, convolved_flux, convolved_err
+    return np.asarray(waveobs), convolved_flux_array, convolved_err_array
 
 
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def interpolation(np.ndarray[np.double_t,ndim=1] waveobs, np.ndarray[np.double_t,ndim=1] fluxes, np.ndarray[np.double_t,ndim=1] err, np.ndarray[np.double_t,ndim=1] resampled_waveobs, bessel=False, zero_edges=True, frame=None):
+@cython.cdivision(True)
+def interpolation(waveobs, fluxes, err, resampled_waveobs, bessel=False, zero_edges=True, frame=None):
     """
     Interpolate flux for a given wavelength by using Bessel's Central-Difference Interpolation.
     It considers:
@@ -142,143 +160,133 @@ def interpolation(np.ndarray[np.double_t,ndim=1] waveobs, np.ndarray[np.double_t
 
     * It does not interpolate if any of the fluxes used for interpolation is zero or negative
       this way it can respect gaps in the spectrum
+
+    The positions of all the target wavelengths are found at once (searchsorted)
+    and 'fluxes'/'err' can be 2D arrays (one spectrum per row) sharing the same
+    'waveobs', in which case the resampled fluxes and errors are also 2D.
     """
-    cdef double current_work_progress
-    cdef double last_reported_progress = -1
     if frame != None:
         frame.update_progress(0)
 
-    cdef int total_points = len(waveobs)
-    cdef int new_total_points = len(resampled_waveobs)
-    cdef np.ndarray[np.double_t,ndim=1] resampled_flux = np.zeros(new_total_points)
-    cdef np.ndarray[np.double_t,ndim=1] resampled_err = np.zeros(new_total_points)
-    cdef int index = 0
-    cdef int last_x = 0
-    cdef int x
-    cdef int i
+    single_spectrum = np.ndim(fluxes) == 1
+    waveobs = np.ascontiguousarray(waveobs, dtype=float)
+    flux_array = np.ascontiguousarray(np.atleast_2d(fluxes), dtype=float)
+    err_array = np.ascontiguousarray(np.atleast_2d(err), dtype=float)
+    if flux_array.shape[1] != len(waveobs) or err_array.shape != flux_array.shape:
+        raise Exception("Fluxes and errors should have the same number of points as wavelengths")
+
+    cdef double[:] wave = waveobs
+    cdef double[:] target = np.ascontiguousarray(resampled_waveobs, dtype=float)
+    cdef double[:, :] flux = flux_array
+    cdef double[:, :] error = err_array
+    # Index position of the first wavelength equal or higher than each objective
+    cdef np.intp_t[:] indices = np.searchsorted(waveobs, target).astype(np.intp)
+
+    cdef Py_ssize_t total_points = wave.shape[0]
+    cdef Py_ssize_t new_total_points = target.shape[0]
+    cdef Py_ssize_t n_spectra = flux.shape[0]
+    resampled_flux_array = np.zeros((n_spectra, new_total_points))
+    resampled_err_array = np.zeros((n_spectra, new_total_points))
+    cdef double[:, :] resampled_flux = resampled_flux_array
+    cdef double[:, :] resampled_err = resampled_err_array
+
+    cdef bint use_bessel = bessel
+    cdef bint zero = zero_edges
+    cdef Py_ssize_t i
+    cdef Py_ssize_t s
+    cdef Py_ssize_t index
+    cdef Py_ssize_t edge
+    cdef double objective_wavelength
+    cdef double d1
+    cdef double d2
+    cdef double p
+    cdef double factor
     cdef double flux_x_1
-    cdef double wave_x0
     cdef double flux_x0
-    cdef double wave_x1
     cdef double flux_x1
     cdef double flux_x2
-    cdef double p
-
-    for i from 0 <= i < new_total_points by 1:
-        # Target wavelength
-        objective_wavelength = resampled_waveobs[i]
-
-        # Find the index position of the first wave length equal or higher than the objective
-        # index = np.where(waveobs >= objective_wavelength)[0][0]
-        index = 0
-        for x from last_x <= x < total_points by 1:
-            if waveobs[x] >= objective_wavelength:
-                index = x
-                break
-        last_x = x
-
-        if index == total_points:
-            # DISCARD: Linear extrapolation using index-1 and index-2
-            # flux = fluxes[index-1] + (objective_wavelength - waveobs[index-1]) * ((fluxes[index-1]-fluxes[index-2])/(waveobs[index-1]-waveobs[index-2]))
-            if zero_edges:
-                # JUST ZERO:
-                resampled_flux[i] = 0.0
-                resampled_err[i] = 0.0
-            else:
-                # JUST DUPLICATE:
-                resampled_flux[i] = fluxes[index-1]
-                resampled_err[i] = err[index-1]
-        #elif index == 0 and waveobs[index] != objective_wavelength:
-        elif index == 0:
-            # DISCARD: Linear extrapolation using index+1 and index
-            # flux = fluxes[index] + (objective_wavelength - waveobs[index]) * ((fluxes[index+1]-fluxes[index])/(waveobs[index+1]-waveobs[index]))
-            if zero_edges:
-                # JUST ZERO:
-                resampled_flux[i] = 0.0
-                resampled_err[i] = 0.0
-            else:
-                # JUST DUPLICATE:
-                resampled_flux[i] = fluxes[index]
-                resampled_err[i] = err[index]
+    cdef double new_flux
+    cdef double new_err
+
+    for i in range(new_total_points):
+        objective_wavelength = target[i]
+        index = indices[i]
+
+        if index == total_points or index == 0:
+            # DISCARD: Linear extrapolation
+            if not zero:
+                # JUST DUPLICATE the first/last value (otherwise JUST ZERO)
+                edge = total_points - 1 if index == total_points else 0
+                for s in range(n_spectra):
+                    resampled_flux[s, i] = flux[s, edge]
+                    resampled_err[s, i] = error[s, edge]
         # Do not do this optimization because it can produce a value surounded
         # by zeros because of the condition "Do not interpolate if any of the
         # fluxes is zero or negative" implemented in the rest of the cases
         #elif waveobs[index] == objective_wavelength:
-            #resampled_flux[i] = fluxes[index]
-            #resampled_err[i] = err[index]
-        else:
-            # Linear if indicated by bessel=False or if we are at the beginning or end of the spectrum
-            if not bessel or index == 1 or index == total_points-1:
+        elif not use_bessel or index == 1 or index == total_points-1:
+            # Linear interpolation between index and index-1
+            # http://en.wikipedia.org/wiki/Linear_interpolation#Linear_interpolation_between_two_known_points
+            # (distances rounded to 5 decimals, same as np.round(d, 5))
+            d1 = rint((objective_wavelength - wave[index-1]) * 1e5) / 1e5
+            d2 = rint((wave[index] - wave[index-1]) * 1e5) / 1e5
+            for s in range(n_spectra):
+                flux_x0 = flux[s, index-1]
+                flux_x1 = flux[s, index]
                 # Do not interpolate if any of the fluxes is zero or negative
-                if fluxes[index-1] <= 1e-10 or fluxes[index] <= 1e-10:
-                    resampled_flux[i] = 0.0
-                    resampled_err[i] = 0.0
-                else:
-                    # Linear interpolation between index and index-1
-                    # http://en.wikipedia.org/wiki/Linear_interpolation#Linear_interpolation_between_two_known_points
-                    d1 = np.round(objective_wavelength - waveobs[index-1], 5)
-                    d2 = np.round(waveobs[index]-waveobs[index-1], 5)
-                    resampled_flux[i] = fluxes[index-1] + d1 * ((fluxes[index]-fluxes[index-1])/d2)
-                    # Same formula as for interpolation but I have re-arranged the terms to make
-                    # clear that it is valid for error propagation (sum of errors multiplied by constant values)
-                    resampled_err[i] = (err[index-1] * (d2 - d1)  + (err[index] * d1)) / d2
-                    # Do not allow negative fluxes or errors
-                    if resampled_err[i] < 0:
-                        resampled_err[i] = 1e-10
-                    if resampled_flux[i] < 0:
-                        resampled_flux[i] = 0
-                        resampled_err[i] = 0
-            else:
-                # Bessel's Central-Difference Interpolation with 4 points
-                #   p = [(x - x0) / (x1 - x0)]
-                #   f(x) = f(x0) + p ( f(x1) - f(x0) ) + [ p ( p - 1 ) / 4 ] ( f(x2) - f(x1) - f(x0) + f(x-1) )
-                # where x-1 < x0 < objective_wavelength = x < x1 < x2 and f() is the flux
-                #   http://physics.gmu.edu/~amin/phys251/Topics/NumAnalysis/Approximation/polynomialInterp.html
-
-                #  x-1= index - 2
-                #  x0 = index - 1
-                #  x  = objective_wavelength
-                #  x1 = index
-                #  x2 = index + 1
-
-                ## Array access optimization
-                flux_x_1 = fluxes[index - 2]
-                wave_x0 = waveobs[index-1]
-                flux_x0 = fluxes[index - 1]
-                wave_x1 = waveobs[index]
-                flux_x1 = fluxes[index]
-                flux_x2 = fluxes[index + 1]
-
-                err_x_1 = err[index - 2]
-                err_x0 = err[index - 1]
-                err_x1 = err[index]
-                err_x2 = err[index + 1]
-
+                if flux_x0 <= 1e-10 or flux_x1 <= 1e-10:
+                    continue
+                new_flux = flux_x0 + d1 * ((flux_x1 - flux_x0) / d2)
+                # Same formula as for interpolation but I have re-arranged the terms to make
+                # clear that it is valid for error propagation (sum of errors multiplied by constant values)
+                new_err = (error[s, index-1] * (d2 - d1) + (error[s, index] * d1)) / d2
+                # Do not allow negative fluxes or errors
+                if new_err < 0:
+                    new_err = 1e-10
+                if new_flux < 0:
+                    new_flux = 0
+                    new_err = 0
+                resampled_flux[s, i] = new_flux
+                resampled_err[s, i] = new_err
+        else:
+            # Bessel's Central-Difference Interpolation with 4 points
+            #   p = [(x - x0) / (x1 - x0)]
+            #   f(x) = f(x0) + p ( f(x1) - f(x0) ) + [ p ( p - 1 ) / 4 ] ( f(x2) - f(x1) - f(x0) + f(x-1) )
+            # where x-1 < x0 < objective_wavelength = x < x1 < x2 and f() is the flux
+            #   http://physics.gmu.edu/~amin/phys251/Topics/NumAnalysis/Approximation/polynomialInterp.html
+
+            #  x-1= index - 2
+            #  x0 = index - 1
+            #  x  = objective_wavelength
+            #  x1 = index
+            #  x2 = index + 1
+            p = (objective_wavelength - wave[index-1]) / (wave[index] - wave[index-1])
+            factor = (p * (p - 1) / 4)
+            for s in range(n_spectra):
+                flux_x_1 = flux[s, index-2]
+                flux_x0 = flux[s, index-1]
+                flux_x1 = flux[s, index]
+                flux_x2 = flux[s, index+1]
                 # Do not interpolate if any of the fluxes is zero or negative
                 if flux_x_1 <= 1e-10 or flux_x0 <= 1e-10 or flux_x1 <= 1e-10 or flux_x2 <= 1e-10:
-                    resampled_flux[i] = 0.0
-                    resampled_err[i] = 0.0
-                else:
-                    p = (objective_wavelength - wave_x0) / (wave_x1 - wave_x0)
-                    factor = (p * (p - 1) / 4)
-                    resampled_flux[i] = flux_x0 + p * (flux_x1 - flux_x0) + factor * (flux_x2 - flux_x1 - flux_x0 + flux_x_1)
-                    # Same formula as for interpolation but I have re-arranged the terms to make
-                    # clear that it is valid for error propagation (sum of errors multiplied by constant values)
-                    resampled_err[i] = err_x_1 * factor + err_x0 * (1 - p - factor) + err_x1 * (p - factor) + err_x2 * factor
-                    # Do not allow negative fluxes or errors
-                    if resampled_err[i] < 0:
-                        resampled_err[i] = 1e-10
-                    if resampled_flux[i] < 0:
-                        resampled_flux[i] = 0
-                        resampled_err[i] = 0
-
-        current_work_progress = (i*1.0 / new_total_points) * 100
-        if (int(current_work_progress) % 10 == 0 and current_work_progress - last_reported_progress > 10) or last_reported_progress < 0 or current_work_progress == 100:
-            last_reported_progress = current_work_progress
-            #logging.info("%.2f%%" % current_work_progress)
-            if frame != None:
-                frame.update_progress(current_work_progress)
-
-
-    return resampled_waveobs, resampled_flux, resampled_err
+                    continue
+                new_flux = flux_x0 + p * (flux_x1 - flux_x0) + factor * (flux_x2 - flux_x1 - flux_x0 + flux_x_1)
+                # Same formula as for interpolation but I have re-arranged the terms to make
+                # clear that it is valid for error propagation (sum of errors multiplied by constant values)
+                new_err = error[s, index-2] * factor + error[s, index-1] * (1 - p - factor) + error[s, index] * (p - factor) + error[s, index+1] * factor
+                # Do not allow negative fluxes or errors
+                if new_err < 0:
+                    new_err = 1e-10
+                if new_flux < 0:
+                    new_flux = 0
+                    new_err = 0
+                resampled_flux[s, i] = new_flux
+                resampled_err[s, i] = new_err
+
+    if frame != None:
+        frame.update_progress(100)
+
+    if single_spectrum:
+        return resampled_waveobs, resampled_flux_array[0], resampled_err_array[0]
+    return resampled_waveobs, resampled_flux_array, resampled_err_array
 
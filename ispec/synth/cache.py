@@ -0,0 +1,184 @@
+#
+#    This file is part of iSpec.
+#    Copyright Sergi Blanco-Cuaresma - http://www.blancocuaresma.com/s/
+#
+#    iSpec is free software: you can redistribute it and/or modify
+#    it under the terms of the GNU Affero General Public License as published by
+#    the Free Software Foundation, either version 3 of the License, or
+#    (at your option) any later version.
+#
+#    iSpec is distributed in the hope that it will be useful,
+#    but WITHOUT ANY WARRANTY; without even the implied warranty of
+#    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#    GNU Affero General Public License for more details.
+#
+#    You should have received a copy of the GNU Affero General Public License
+#    along with iSpec. If not, see <http://www.gnu.org/licenses/>.
+#
+import os
+import json
+import hashlib
+import numpy as np
+from lockfile import FileLock, LockTimeout
+import logging
+
+from ispec.common import mkdir_p
+
+# Increase it if the inputs or the format of the stored spectra change
+_SYNTHESIS_CACHE_VERSION = 1
+
+class SynthesisCache(object):
+    """
+    Persistent cache of fundamental synthetic spectra that can be shared
+    between runs and processes.
+
+    Every spectrum is stored in 'cache_dir' as a '.npy' file (read back
+    memory mapped) named after a hash of all the inputs of the synthesis, and
+    'index.json' keeps their sizes. Reading does not require any lock: the
+    modification time of the files records when they were last used and, when
+    the total size goes over 'max_size' (in bytes), the least recently used
+    spectra are removed.
+    """
+    def __init__(self, cache_dir, max_size=1024**3):
+        self.cache_dir = os.path.abspath(cache_dir)
+        self.max_size = max_size
+        self.index_filename = os.path.join(self.cache_dir, "index.json")
+        mkdir_p(self.cache_dir)
+
+    def key(self, waveobs, atmosphere_layers, teff, logg, MH, alpha, linelist, isotopes, abundances, fixed_abundances, microturbulence_vel, regions=None, code="spectrum", use_molecules=False):
+        """
+        Hash identifying a fundamental spectrum.
+        """
+        h = hashlib.sha1()
+        for value in (_SYNTHESIS_CACHE_VERSION, code.lower(), use_molecules, teff, logg, MH, alpha, microturbulence_vel, \
+                        waveobs, regions, atmosphere_layers, linelist, isotopes, abundances, fixed_abundances):
+            _hash_update(h, value)
+        return h.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def get(self, key):
+        """
+        Fluxes stored for the key or None if they are not in the cache.
+        """
+        filename = self._filename(key)
+        try:
+            fluxes = np.load(filename, mmap_mode='r')
+            fluxes = np.array(fluxes)
+        except (IOError, OSError, ValueError):
+            return None
+        try:
+            # Mark as recently used
+            os.utime(filename, None)
+        except OSError:
+            # Removed by another process after reading it
+            pass
+        return fluxes
+
+    def put(self, key, fluxes):
+        """
+        Store the fluxes and remove the least recently used spectra if the
+        cache is bigger than 'max_size'.
+        """
+        filename = self._filename(key)
+        # The file is stored only if it can be registered in the index
+        # (otherwise it would never be evicted)
+        lock = FileLock(self.index_filename)
+        try:
+            lock.acquire(timeout=60)
+        except LockTimeout:
+            logging.warning("Synthesis cache index locked, not storing {}".format(filename))
+            return
+        try:
+            tmp_filename = os.path.join(self.cache_dir, ".{}.{}.npy".format(key, os.getpid()))
+            np.save(tmp_filename, np.asarray(fluxes, dtype=float))
+            size = os.path.getsize(tmp_filename)
+            # Atomic: readers see the complete file or nothing
+            os.replace(tmp_filename, filename)
+            index = self._read_index()
+            index[key] = size
+            self._evict(index)
+            self._write_index(index)
+        finally:
+            lock.release()
+
+    def size(self):
+        """
+        Total size in bytes of the registered spectra.
+        """
+        return sum(self._read_index().values())
+
+    def clear(self):
+        lock = FileLock(self.index_filename)
+        lock.acquire(timeout=60)
+        try:
+            for key in self._read_index():
+                try:
+                    os.remove(self._filename(key))
+                except OSError:
+                    pass
+            self._write_index({})
+        finally:
+            lock.release()
+
+    def _evict(self, index):
+        last_used = {}
+        for key in list(index.keys()):
+            try:
+                last_used[key] = os.path.getmtime(self._filename(key))
+            except OSError:
+                # Removed externally
+                del index[key]
+        total_size = sum(index.values())
+        for key in sorted(last_used, key=last_used.get):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(self._filename(key))
+            except OSError:
+                # Windows does not allow to remove files being used
+                continue
+            total_size -= index.pop(key)
+
+    def _read_index(self):
+        try:
+            with open(self.index_filename, "r") as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            index = {}
+        return index
+
+    def _write_index(self, index):
+        tmp_filename = self.index_filename + ".{}.tmp".format(os.getpid())
+        with open(tmp_filename, "w") as f:
+            json.dump(index, f)
+        os.replace(tmp_filename, self.index_filename)
+
+
+def _hash_update(h, value):
+    if value is None:
+        h.update(b"None;")
+    elif isinstance(value, bytes):
+        h.update(value)
+        h.update(b";")
+    elif isinstance(value, np.ndarray):
+        value = np.ascontiguousarray(value)
+        h.update(str(value.dtype.descr).encode() + str(value.shape).encode())
+        if value.dtype.hasobject:
+            h.update(repr(value.tolist()).encode())
+        else:
+            h.update(value.tobytes())
+        h.update(b";")
+    elif isinstance(value, (list, tuple)):
+        # Type, length and closing delimiter: different nestings of the same
+        # items do not produce the same hash
+        h.update("{}[{};".format(type(value).__name__, len(value)).encode())
+        for v in value:
+            _hash_update(h, v)
+        h.update(b"];")
+    elif isinstance(value, (int, float, np.integer, np.floating)) and not isinstance(value, bool):
+        # The same value as int, float or numpy scalar
+        h.update(repr(float(value)).encode() + b";")
+    else:
+        h.update(repr(value).encode() + b";")
@@ -16,16 +16,27 @@
 #    along with iSpec. If not, see <http://www.gnu.org/licenses/>.
 #
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from ispec.abundances import enhance_solar_abundances
+from ispec.spectrum import create_spectrum_structure, resample_spectrum
 from . import moog
 from . import sme
 from . import spectrum
 from . import synthe
 from . import turbospectrum
 from . import grid as grid_module
+from .cache import SynthesisCache
 
-def generate_fundamental_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, linelist, isotopes, abundances, fixed_abundances, microturbulence_vel, verbose=0, gui_queue=None, timeout=1800, atmosphere_layers_file=None, abundances_file=None, fixed_abundances_file=None, linelist_file=None, molecules_files=None, isotope_file=None, regions=None, code="spectrum", use_molecules=False, grid=None, tmp_dir=None):
+def generate_fundamental_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, linelist, isotopes, abundances, fixed_abundances, microturbulence_vel, verbose=0, gui_queue=None, timeout=1800, atmosphere_layers_file=None, abundances_file=None, fixed_abundances_file=None, linelist_file=None, molecules_files=None, isotope_file=None, regions=None, code="spectrum", use_molecules=False, grid=None, tmp_dir=None, cache=None, workers=1):
     """
+    If a cache (SynthesisCache or directory) is given, spectra already
+    synthesized with exactly the same inputs are read from it and new ones
+    are stored in it (it does not apply to code "grid").
+
+    With workers > 1, the regions (split in pieces of 100 nm like the
+    radiative transfer codes do) are synthesized concurrently in that number
+    of processes and joined in wavelength order (wavelengths out of the
+    regions are set to 1).
     """
     code = code.lower()
     if code not in ['spectrum', 'turbospectrum', 'moog', 'synthe', 'sme', 'grid']:
@@ -43,21 +54,146 @@ def generate_fundamental_spectrum(waveobs, atmosphere_layers, teff, logg, MH, al
 
         abundances = enhance_solar_abundances(abundances, alpha)
 
-        if code == "turbospectrum":
-            return turbospectrum.generate_fundamental_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, linelist, isotopes, abundances, fixed_abundances, microturbulence_vel, verbose=verbose,  atmosphere_layers_file=atmosphere_layers_file, linelist_file=linelist_file, regions=regions, use_molecules=use_molecules, tmp_dir=tmp_dir, timeout=timeout)
-        elif code == "moog":
-            return moog.generate_fundamental_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, linelist, isotopes, abundances, fixed_abundances, microturbulence_vel, verbose=verbose,  atmosphere_layers_file=atmosphere_layers_file, regions=regions, tmp_dir=tmp_dir, timeout=timeout)
-        elif code == "synthe":
-            return synthe.generate_fundamental_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, linelist, isotopes, abundances, fixed_abundances, microturbulence_vel, verbose=verbose,  atmosphere_layers_file=atmosphere_layers_file, linelist_file=linelist_file, molecules_files=molecules_files, regions=regions, tmp_dir=tmp_dir, timeout=timeout)
-        elif code == "sme":
-            return sme.generate_fundamental_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, linelist, isotopes, abundances, fixed_abundances, microturbulence_vel, verbose=verbose, regions=regions, tmp_dir=tmp_dir, timeout=timeout)
-        elif code == "spectrum":
-            return spectrum.generate_fundamental_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, linelist, isotopes, abundances, fixed_abundances, microturbulence_vel, verbose=verbose, gui_queue=gui_queue, timeout=timeout, atmosphere_layers_file=atmosphere_layers_file, abundances_file=abundances_file, fixed_abundances_file=fixed_abundances_file, linelist_file=linelist_file, isotope_file=isotope_file, regions=regions, tmp_dir=tmp_dir)
+        if cache is not None:
+            if not isinstance(cache, SynthesisCache):
+                cache = SynthesisCache(cache)
+            layers = atmosphere_layers
+            if layers is None and atmosphere_layers_file is not None:
+                with open(atmosphere_layers_file, "rb") as f:
+                    layers = f.read()
+            key = cache.key(waveobs, layers, teff, logg, MH, alpha, linelist, isotopes, abundances, fixed_abundances, microturbulence_vel, regions=regions, code=code, use_molecules=use_molecules)
+            fluxes = cache.get(key)
+            if fluxes is not None:
+                return fluxes
+
+        task = {'code': code, 'waveobs': waveobs, 'atmosphere_layers': atmosphere_layers, 'teff': teff, 'logg': logg, 'MH': MH, 'alpha': alpha, \
+                'linelist': linelist, 'isotopes': isotopes, 'abundances': abundances, 'fixed_abundances': fixed_abundances, \
+                'microturbulence_vel': microturbulence_vel, 'verbose': verbose, 'timeout': timeout, \
+                'atmosphere_layers_file': atmosphere_layers_file, 'abundances_file': abundances_file, \
+                'fixed_abundances_file': fixed_abundances_file, 'linelist_file': linelist_file, 'molecules_files': molecules_files, \
+                'isotope_file': isotope_file, 'regions': regions, 'use_molecules': use_molecules, 'tmp_dir': tmp_dir}
+        segments = _synthesis_segments(waveobs, regions)
+        if workers is not None and workers > 1 and len(segments) > 1:
+            fluxes = __synthesize_segments_in_parallel(task, segments, workers)
+        else:
+            fluxes = __synthesize(task, gui_queue=gui_queue)
+
+        if cache is not None and not np.all(fluxes == 0):
+            # Failed syntheses (zero fluxes) are not stored
+            cache.put(key, fluxes)
+        return fluxes
     elif code == "grid":
         if grid is None:
             raise Exception("Grid needed to generate an interpolated spectrum from a grid.")
         return grid_module.generate_fundamental_spectrum(grid, waveobs, teff, logg, MH, alpha, microturbulence_vel, regions=regions)
 
+def __synthesize(task, gui_queue=None):
+    code = task['code']
+    waveobs, atmosphere_layers, teff, logg, MH, alpha = task['waveobs'], task['atmosphere_layers'], task['teff'], task['logg'], task['MH'], task['alpha']
+    linelist, isotopes, abundances, fixed_abundances, microturbulence_vel = task['linelist'], task['isotopes'], task['abundances'], task['fixed_abundances'], task['microturbulence_vel']
+    verbose, timeout, regions, use_molecules, tmp_dir = task['verbose'], task['timeout'], task['regions'], task['use_molecules'], task['tmp_dir']
+    atmosphere_layers_file, abundances_file, fixed_abundances_file = task['atmosphere_layers_file'], task['abundances_file'], task['fixed_abundances_file']
+    linelist_file, molecules_files, isotope_file = task['linelist_file'], task['molecules_files'], task['isotope_file']
+    if code == "turbospectrum":
+        return turbospectrum.generate_fundamental_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, linelist, isotopes, abundances, fixed_abundances, microturbulence_vel, verbose=verbose,  atmosphere_layers_file=atmosphere_layers_file, linelist_file=linelist_file, regions=regions, use_molecules=use_molecules, tmp_dir=tmp_dir, timeout=timeout)
+    elif code == "moog":
+        return moog.generate_fundamental_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, linelist, isotopes, abundances, fixed_abundances, microturbulence_vel, verbose=verbose,  atmosphere_layers_file=atmosphere_layers_file, regions=regions, tmp_dir=tmp_dir, timeout=timeout)
+    elif code == "synthe":
+        return synthe.generate_fundamental_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, linelist, isotopes, abundances, fixed_abundances, microturbulence_vel, verbose=verbose,  atmosphere_layers_file=atmosphere_layers_file, linelist_file=linelist_file, molecules_files=molecules_files, regions=regions, tmp_dir=tmp_dir, timeout=timeout)
+    elif code == "sme":
+        return sme.generate_fundamental_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, linelist, isotopes, abundances, fixed_abundances, microturbulence_vel, verbose=verbose, regions=regions, tmp_dir=tmp_dir, timeout=timeout)
+    elif code == "spectrum":
+        return spectrum.generate_fundamental_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, linelist, isotopes, abundances, fixed_abundances, microturbulence_vel, verbose=verbose, gui_queue=gui_queue, timeout=timeout, atmosphere_layers_file=atmosphere_layers_file, abundances_file=abundances_file, fixed_abundances_file=fixed_abundances_file, linelist_file=linelist_file, isotope_file=isotope_file, regions=regions, tmp_dir=tmp_dir)
+
+def _synthesis_segments(waveobs, regions, max_segment=100.):
+    """
+    Regions split in pieces of at most max_segment nm (the same used by the
+    radiative transfer codes), sorted by wavelength.
+    """
+    if regions is None:
+        regions = np.recarray((1,),  dtype=[('wave_base', float), ('wave_top', float)])
+        regions['wave_base'][0] = np.min(waveobs)
+        regions['wave_top'][0] = np.max(waveobs)
+    sorted_waveobs = np.sort(waveobs)
+    wave_step = np.max((0.001, np.min(sorted_waveobs[1:] - sorted_waveobs[:-1])))
+    wave_bases = []
+    wave_tops = []
+    for region in regions:
+        if (region['wave_top'] - region['wave_base']) / wave_step > max_segment / wave_step:
+            segment_wave_base = np.arange(region['wave_base'], region['wave_top'], max_segment)
+            segment_wave_top = segment_wave_base + max_segment - wave_step
+            segment_wave_top[-1] = region['wave_top'] # Last segment should not over pass the original global limits
+            wave_bases += segment_wave_base.tolist()
+            wave_tops += segment_wave_top.tolist()
+        else:
+            wave_bases.append(region['wave_base'])
+            wave_tops.append(region['wave_top'])
+    segments = np.recarray((len(wave_bases),),  dtype=[('wave_base', float), ('wave_top', float)])
+    segments['wave_base'] = wave_bases
+    segments['wave_top'] = wave_tops
+    segments.sort(order=['wave_base'])
+    return segments
+
+def __synthesize_segment(task):
+    return __synthesize(task)
+
+def __synthesize_segments_in_parallel(task, segments, workers):
+    """
+    Each segment is synthesized independently (same wavelengths, sampling and
+    linelist margins) and the fluxes are joined in wavelength order.
+    """
+    # One more wavelength step at each side, the first and last wavelengths
+    # of a synthesis are zero when resampled (zero edges)
+    waveobs = task['waveobs']
+    sorted_waveobs = np.sort(waveobs)
+    wave_step = np.max((0.001, np.min(sorted_waveobs[1:] - sorted_waveobs[:-1])))
+    tasks = []
+    for i in range(len(segments)):
+        segment_task = task.copy()
+        segment_task['regions'] = segments[i:i+1].copy()
+        segment_task['regions']['wave_base'] -= wave_step
+        segment_task['regions']['wave_top'] += wave_step
+        tasks.append(segment_task)
+
+    # Processes instead of threads: some codes change the working directory
+    # (not daemonic, codes like SPECTRUM start their own processes)
+    with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as executor:
+        results = list(executor.map(__synthesize_segment, tasks))
+
+    # Requested wavelengths (those between two pieces of the same region are
+    # taken from the wavelength step added to the pieces)
+    if task['regions'] is None:
+        requested = np.ones(len(waveobs), dtype=bool)
+    else:
+        requested = np.zeros(len(waveobs), dtype=bool)
+        for region in task['regions']:
+            requested = np.logical_or(requested, np.logical_and(waveobs >= region['wave_base'], waveobs <= region['wave_top']))
+
+    fluxes = np.zeros(len(waveobs))
+    covered = np.zeros(len(waveobs), dtype=bool)
+    for segment, segment_task, segment_fluxes in zip(segments, tasks, results):
+        wfilter = np.logical_and(waveobs >= segment['wave_base'], waveobs <= segment['wave_top'])
+        if np.any(wfilter) and np.all(segment_fluxes[wfilter] == 0):
+            # Failed synthesis
+            return np.zeros(len(waveobs))
+        extended_segment = segment_task['regions'][0]
+        wfilter = np.logical_and(waveobs >= extended_segment['wave_base'], waveobs <= extended_segment['wave_top'])
+        # Zero fluxes are the edges of the synthesis (not synthesized)
+        wfilter = np.logical_and(np.logical_and(wfilter, requested), np.logical_and(segment_fluxes > 0, ~covered))
+        fluxes[wfilter] = segment_fluxes[wfilter]
+        covered = np.logical_or(covered, wfilter)
+
+    if task['code'] == "spectrum":
+        # SPECTRUM does not synthesize the masked wavelengths (continuum)
+        fluxes[~covered] = 1.
+    elif np.any(covered):
+        # The other codes join their pieces and resample them with zero edges:
+        # wavelengths between regions are interpolated and the rest are zero
+        joined_spectrum = create_spectrum_structure(waveobs[covered], fluxes[covered])
+        joined_spectrum.sort(order=['waveobs'])
+        fluxes[~covered] = resample_spectrum(joined_spectrum, waveobs[~covered], method="linear", zero_edges=True)['flux']
+    return fluxes
+
 
 def generate_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, linelist, isotopes, abundances, fixed_abundances, microturbulence_vel = 2.0, macroturbulence = 3.0, vsini = 2.0, limb_darkening_coeff = 0.60, R=500000, verbose=0, gui_queue=None, timeout=1800, atmosphere_layers_file=None, abundances_file=None, fixed_abundances_file=None, linelist_file=None, molecules_files=None, isotope_file=None, regions=None, code="spectrum", use_molecules=False, grid=None, tmp_dir=None):
     """
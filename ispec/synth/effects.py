@@ -15,17 +15,25 @@
 #    You should have received a copy of the GNU Affero General Public License
 #    along with iSpec. If not, see <http://www.gnu.org/licenses/>.
 #
+import hashlib
 import numpy as np
 from scipy import spatial
 from scipy.signal import fftconvolve
+from functools import lru_cache
+from collections import OrderedDict
 import logging
 
 from ispec.spectrum import create_spectrum_structure, resample_spectrum, convolve_spectrum, resample_spectrum, correct_velocity
+from ispec.spectrum import _gaussian_kernel, _instrumental_fwhm_in_velocity
 from ispec.lines import _sampling_uniform_in_velocity
 
-def apply_post_fundamental_effects(waveobs, fluxes, segments, macroturbulence = 3.0, vsini = 2.0, limb_darkening_coeff = 0.60, R=500000, vrad=(0,), verbose=0):
+def apply_post_fundamental_effects(waveobs, fluxes, segments, macroturbulence = 3.0, vsini = 2.0, limb_darkening_coeff = 0.60, R=500000, vrad=(0,), verbose=0, convolution_method="direct"):
     """
     Apply macroturbulence, rotation (visini), limb darkening coeff and resolution to already generated fundamental synthetic spectrum.
+
+    The resolution is applied with convolve_spectrum using the given convolution_method ("direct" or "fft").
+    If convolution_method is "fused", rotation, macroturbulence and resolution are
+    combined in a single kernel (cached) and applied with only one FFT convolution.
     """
     # Avoid zero fluxes, set a minimum value so that when it is convolved it
     # changes. This way we reduce the impact of the following problem:
@@ -36,13 +44,16 @@ def apply_post_fundamental_effects(waveobs, fluxes, segments, macroturbulence =
     spectrum = create_spectrum_structure(waveobs, fluxes)
     spectrum.sort(order=['waveobs'])
 
-    if (macroturbulence is not None and macroturbulence > 0) or (vsini is not None and vsini > 0):
+    if convolution_method == "fused":
+        fluxes = __fused_broadening(spectrum, macroturbulence, vsini, limb_darkening_coeff, R)
+    elif convolution_method not in ("direct", "fft"):
+        raise Exception("Unknown convolution method '{}'".format(convolution_method))
+
+    if convolution_method != "fused" and ((macroturbulence is not None and macroturbulence > 0) or (vsini is not None and vsini > 0)):
         # Build spectrum with sampling uniform in velocity (required by vmac and vsini broadening):
-        wave_base = spectrum['waveobs'][0]
-        wave_top = spectrum['waveobs'][-1]
-        velocity_step = __determine_velocity_step(spectrum)
-        waveobs_uniform_in_velocity = _sampling_uniform_in_velocity(wave_base, wave_top, velocity_step)
-        fluxes_uniform_in_velocity = np.interp(waveobs_uniform_in_velocity, spectrum['waveobs'], spectrum['flux'], left=0.0, right=0.0)
+        # (the grid and the interpolation weights are cached for repeated calls with the same wavelengths)
+        velocity_step, waveobs_uniform_in_velocity, to_uniform, from_uniform = _resampling_plan(spectrum, include_base=False)
+        fluxes_uniform_in_velocity = _interpolate_with_plan(to_uniform, spectrum['flux'])
 
         # Apply broadening
         #fluxes_uniform_in_velocity = __vsini_broadening_limbdarkening2(waveobs_uniform_in_velocity, fluxes_uniform_in_velocity, velocity_step, vsini, limb_darkening_coeff)
@@ -50,16 +61,24 @@ def apply_post_fundamental_effects(waveobs, fluxes, segments, macroturbulence =
         fluxes_uniform_in_velocity = __vmac_broadening(fluxes_uniform_in_velocity, velocity_step, macroturbulence)
 
         # Resample to origin wavelength grid
-        fluxes = np.interp(spectrum['waveobs'], waveobs_uniform_in_velocity, fluxes_uniform_in_velocity, left=0.0, right=0.0)
+        fluxes = _interpolate_with_plan(from_uniform, fluxes_uniform_in_velocity)
         spectrum['flux'] = fluxes
 
-    if R is not None and R > 0:
+    if convolution_method != "fused" and R is not None and R > 0:
         # Convolve (here it is not needed to be with a sampling uniform in velocity, the function is capable of dealing with that)
-        fluxes = convolve_spectrum(spectrum, R, from_resolution=None, frame=None)['flux']
+        fluxes = convolve_spectrum(spectrum, R, from_resolution=None, frame=None, method=convolution_method)['flux']
 
     # Make sure original zeros are set to 1.0 and not modified by the previous broadening operations
     fluxes[zeros] = 1.0e-10
 
+    return _shift_segments(waveobs, fluxes, segments, vrad, outside=1.)
+
+def _shift_segments(waveobs, fluxes, segments, vrad, outside=1., gaps=True):
+    """
+    Apply the radial velocity of each segment (values out of the segments
+    are set to 'outside'). If gaps is False, negative and zero values are
+    interpolated as any other value (i.e. for derivatives).
+    """
     if type(vrad) not in (tuple, list, np.ndarray):
         raise Exception("Velocity should be an array")
 
@@ -74,11 +93,139 @@ def apply_post_fundamental_effects(waveobs, fluxes, segments, macroturbulence =
             modified = np.logical_or(modified, wfilter)
             spectrum = create_spectrum_structure(waveobs[wfilter], fluxes[wfilter])
             spectrum = correct_velocity(spectrum, velocity)
-            spectrum = resample_spectrum(spectrum, waveobs[wfilter], method="linear", zero_edges=True)
-            fluxes[wfilter] = spectrum['flux']
-        fluxes[~modified] = 1.
+            if gaps:
+                spectrum = resample_spectrum(spectrum, waveobs[wfilter], method="linear", zero_edges=True)
+                fluxes[wfilter] = spectrum['flux']
+            else:
+                fluxes[wfilter] = np.interp(waveobs[wfilter], spectrum['waveobs'], spectrum['flux'], left=0., right=0.)
+        fluxes[~modified] = outside
     return fluxes
 
+def post_fundamental_effects_derivatives(waveobs, fluxes, segments, macroturbulence = 3.0, vsini = 2.0, limb_darkening_coeff = 0.60, R=500000, vrad=(0,), parameters=("macroturbulence", "vsini", "R")):
+    """
+    Analytical derivatives of apply_post_fundamental_effects with respect to
+    the macroturbulence, vsini and R (dictionary with one array per parameter).
+
+    The broadening is considered as a single convolution in a grid uniform in
+    velocity (like convolution_method="fused"), thus the derivative with
+    respect to one parameter is the convolution with the derivative of its
+    kernel (combined with the kernels of the other parameters). The fundamental
+    fluxes resampled to the grid uniform in velocity are cached, so they are
+    shared by all the parameters and iterations with the same fundamental
+    spectrum.
+    """
+    fluxes = fluxes.copy()
+    zeros = np.where(fluxes <= 1.0e-10)[0]
+    fluxes[zeros] = 1.0e-10
+
+    spectrum = create_spectrum_structure(waveobs, fluxes)
+    spectrum.sort(order=['waveobs'])
+    velocity_step, waveobs_uniform_in_velocity, to_uniform, from_uniform = _resampling_plan(spectrum, include_base=True)
+    depths_uniform_in_velocity = _uniform_depths(spectrum, to_uniform)
+
+    to_float = lambda value: 0. if value is None else float(value)
+    vmac, vsini, epsilon, R = to_float(macroturbulence), to_float(vsini), to_float(limb_darkening_coeff), to_float(R)
+    derivatives = {}
+    for parameter in parameters:
+        if parameter not in ("macroturbulence", "vsini", "R"):
+            raise Exception("Unknown broadening parameter '{}'".format(parameter))
+        kernel = _broadening_kernel_derivative(parameter, vmac, vsini, epsilon, R, float(velocity_step))
+        if kernel is None:
+            # Disabled broadening
+            derivatives[parameter] = np.zeros(len(waveobs))
+            continue
+        # Fluxes are broadened as 1 - K*(1 - fluxes)
+        derivative = -fftconvolve(depths_uniform_in_velocity, kernel, mode='same')
+        derivative = _interpolate_with_plan(from_uniform, derivative)
+        derivative[zeros] = 0.
+        derivatives[parameter] = _shift_segments(waveobs, derivative, segments, vrad, outside=0., gaps=False)
+    return derivatives
+
+def __normalized_kernel_derivative(kernel, kernel_derivative):
+    # Derivative of kernel/sum(kernel)
+    total = np.sum(kernel)
+    return kernel_derivative/total - kernel*np.sum(kernel_derivative)/total**2
+
+def __rotation_kernel_derivative(velocity_step, vsini, epsilon):
+    # Derivative with respect to vsini of the normalized kernel from __lsf_rotate
+    e1 = 2.0*(1.0 - epsilon)
+    e2 = np.pi*epsilon/2.0
+    e3 = np.pi*(1.0 - epsilon/3.0)
+    velgrid, kernel = __lsf_rotate(velocity_step, vsini, epsilon=epsilon)
+    x = velgrid/vsini
+    x1 = np.abs(1.0 - x**2)
+    # d(x1)/d(vsini)
+    dx1 = np.sign(1.0 - x**2) * 2.*x**2/vsini
+    with np.errstate(divide='ignore', invalid='ignore'):
+        kernel_derivative = (e1*0.5/np.sqrt(x1) + e2) * dx1 / e3
+    kernel_derivative[~np.isfinite(kernel_derivative)] = 0.
+    return __normalized_kernel_derivative(kernel, kernel_derivative)
+
+def __gaussian_kernel_derivative(kernel, sigma, dsigma):
+    # Derivative of a normalized gaussian kernel (sigma in pixels) given the derivative of sigma
+    x = np.arange(len(kernel)) - len(kernel)//2
+    return __normalized_kernel_derivative(kernel, kernel * x**2/sigma**3 * dsigma)
+
+def __vmac_kernel_derivative(velocity_step, vmac):
+    # Derivative with respect to vmac of _vmac_kernel (radial and tangential gaussians)
+    m = 0.5
+    sigma = vmac/np.sqrt(2.0) / velocity_step
+    mkern_derivative = 0.
+    for projected_sigma in (sigma * m, sigma * np.sqrt(1.0 - m**2.)):
+        nmk = max(round(sigma*10), 3)
+        xarg = (np.arange(2*nmk+1)-nmk) / projected_sigma
+        kernel = np.exp(-0.5*(xarg**2))
+        kernel /= kernel.sum()
+        mkern_derivative = mkern_derivative + 0.5*__gaussian_kernel_derivative(kernel, projected_sigma, projected_sigma/vmac)
+    return mkern_derivative
+
+@lru_cache(maxsize=128)
+def _broadening_kernel_derivative(parameter, vmac, vsini, epsilon, R, velocity_step):
+    """
+        Derivative of the composite kernel (see _broadening_kernel) with respect
+        to the given parameter or None if that broadening is disabled (cached,
+        read-only).
+    """
+    if parameter == "vsini" and not vsini > 0:
+        return None
+    if parameter == "macroturbulence" and not vmac > 0:
+        return None
+    if parameter == "R" and not R > 0:
+        return None
+    kernel = np.ones(1)
+    if vsini > 0:
+        if parameter == "vsini":
+            kernel = np.convolve(kernel, __rotation_kernel_derivative(velocity_step, vsini, epsilon))
+        else:
+            kernel = np.convolve(kernel, _rotation_kernel(velocity_step, vsini, epsilon))
+    if vmac > 0:
+        if parameter == "macroturbulence":
+            kernel = np.convolve(kernel, __vmac_kernel_derivative(velocity_step, vmac))
+        else:
+            kernel = np.convolve(kernel, _vmac_kernel(velocity_step, vmac))
+    if R > 0:
+        fwhm = _instrumental_fwhm_in_velocity(R)
+        gaussian_kernel = _gaussian_kernel(fwhm, velocity_step)
+        if parameter == "R":
+            # fwhm = c/R
+            sigma = fwhm / (2*np.sqrt(2*np.log(2))) / velocity_step
+            gaussian_kernel = __gaussian_kernel_derivative(gaussian_kernel, sigma, -sigma/R)
+        kernel = np.convolve(kernel, gaussian_kernel)
+    kernel.setflags(write=False)
+    return kernel
+
+def _uniform_depths(spectrum, to_uniform):
+    """
+        Line depths (1 - fluxes) in the grid uniform in velocity (cached for
+        the last fundamental spectra).
+    """
+    key = (hashlib.sha1(spectrum['waveobs'].tobytes()).hexdigest(), hashlib.sha1(spectrum['flux'].tobytes()).hexdigest())
+    depths = _uniform_depths_cache.get(key)
+    if depths is None:
+        depths = 1. - _interpolate_with_plan(to_uniform, spectrum['flux'])
+        depths.setflags(write=False)
+        _uniform_depths_cache.put(key, depths)
+    return depths
 
 
 def _filter_linelist(linelist, segments):
@@ -140,40 +287,7 @@ def __vmac_broadening(flux, velocity_step, vmac):
         It uses radial-tangential instead of isotropic Gaussian macroturbulence.
     """
     if vmac is not None and vmac > 0:
-        # mu represent angles that divide the star into equal area annuli,
-        # ordered from disk center (mu=1) to the limb (mu=0).
-        # But since we don't have intensity profiles at various viewing (mu) angles
-        # at this point, we just take a middle point:
-        m = 0.5
-        # Calc projected simga for radial and tangential velocity distributions.
-        sigma = vmac/np.sqrt(2.0) / velocity_step
-        sigr = sigma * m
-        sigt = sigma * np.sqrt(1.0 - m**2.)
-        # Figure out how many points to use in macroturbulence kernel
-        nmk = max(min(round(sigma*10), (len(flux)-3)/2), 3)
-        # Construct radial macroturbulence kernel w/ sigma of mu*vmac/sqrt(2)
-        if sigr > 0:
-            xarg = (np.arange(2*nmk+1)-nmk) / sigr   # exponential arg
-            #mrkern = np.exp(max((-0.5*(xarg**2)),-20.0))
-            mrkern = np.exp(-0.5*(xarg**2))
-            mrkern = mrkern/mrkern.sum()
-        else:
-            mrkern = np.zeros(2*nmk+1)
-            mrkern[nmk] = 1.0    #delta function
-
-        # Construct tangential kernel w/ sigma of sqrt(1-mu**2)*vmac/sqrt(2.)
-        if sigt > 0:
-            xarg = (np.arange(2*nmk+1)-nmk) /sigt
-            mtkern = np.exp(-0.5*(xarg**2))
-            mtkern = mtkern/mtkern.sum()
-        else:
-            mtkern = np.zeros(2*nmk+1)
-            mtkern[nmk] = 1.0
-
-        ## Sum the radial and tangential components, weighted by surface area
-        area_r = 0.5
-        area_t = 0.5
-        mkern = area_r*mrkern + area_t*mtkern
+        mkern = _vmac_kernel(velocity_step, vmac, max_half_width=(len(flux)-3)//2)
 
         # Convolve the flux with the kernel
         flux_conv = 1 - fftconvolve(1-flux, mkern, mode='same') # Fastest
@@ -184,6 +298,63 @@ def __vmac_broadening(flux, velocity_step, vmac):
     else:
         return flux
 
+@lru_cache(maxsize=128)
+def _vmac_kernel(velocity_step, vmac, max_half_width=None):
+    """
+        Radial-tangential macroturbulence kernel sampled every velocity_step [km/s]
+        (cached, read-only).
+    """
+    # mu represent angles that divide the star into equal area annuli,
+    # ordered from disk center (mu=1) to the limb (mu=0).
+    # But since we don't have intensity profiles at various viewing (mu) angles
+    # at this point, we just take a middle point:
+    m = 0.5
+    # Calc projected simga for radial and tangential velocity distributions.
+    sigma = vmac/np.sqrt(2.0) / velocity_step
+    sigr = sigma * m
+    sigt = sigma * np.sqrt(1.0 - m**2.)
+    # Figure out how many points to use in macroturbulence kernel
+    if max_half_width is None:
+        nmk = max(round(sigma*10), 3)
+    else:
+        nmk = max(min(round(sigma*10), max_half_width), 3)
+    # Construct radial macroturbulence kernel w/ sigma of mu*vmac/sqrt(2)
+    if sigr > 0:
+        xarg = (np.arange(2*nmk+1)-nmk) / sigr   # exponential arg
+        #mrkern = np.exp(max((-0.5*(xarg**2)),-20.0))
+        mrkern = np.exp(-0.5*(xarg**2))
+        mrkern = mrkern/mrkern.sum()
+    else:
+        mrkern = np.zeros(2*nmk+1)
+        mrkern[nmk] = 1.0    #delta function
+
+    # Construct tangential kernel w/ sigma of sqrt(1-mu**2)*vmac/sqrt(2.)
+    if sigt > 0:
+        xarg = (np.arange(2*nmk+1)-nmk) /sigt
+        mtkern = np.exp(-0.5*(xarg**2))
+        mtkern = mtkern/mtkern.sum()
+    else:
+        mtkern = np.zeros(2*nmk+1)
+        mtkern[nmk] = 1.0
+
+    ## Sum the radial and tangential components, weighted by surface area
+    area_r = 0.5
+    area_t = 0.5
+    mkern = area_r*mrkern + area_t*mtkern
+    mkern.setflags(write=False)
+    return mkern
+
+@lru_cache(maxsize=128)
+def _rotation_kernel(velocity_step, vsini, epsilon):
+    """
+        Normalized rotation kernel with limb darkening sampled every velocity_step [km/s]
+        (cached, read-only).
+    """
+    kernel_x, kernel_y = __lsf_rotate(velocity_step, vsini, epsilon=epsilon)
+    kernel_y /= kernel_y.sum()
+    kernel_y.setflags(write=False)
+    return kernel_y
+
 def __vsini_broadening_limbdarkening2(waveobs_uniform_in_velocity, flux, velocity_step, vsini, epsilon):
     """
         waveobs_uniform_in_velocity: wavelength
@@ -295,8 +466,7 @@ def __vsini_broadening_limbdarkening(flux, velocity_step, vsini, epsilon):
     if vsini is not None and vsini > 0:
         if epsilon is None:
             epsilon = 0.
-        kernel_x, kernel_y = __lsf_rotate(velocity_step, vsini, epsilon=epsilon)
-        kernel_y /= kernel_y.sum()
+        kernel_y = _rotation_kernel(velocity_step, vsini, epsilon)
 
         #-- convolve the flux with the kernel
         flux_conv = 1 - fftconvolve(1-flux, kernel_y, mode='same') # Fastest
@@ -306,6 +476,149 @@ def __vsini_broadening_limbdarkening(flux, velocity_step, vsini, epsilon):
     else:
         return flux
 
+@lru_cache(maxsize=128)
+def _broadening_kernel(vmac, vsini, epsilon, R, velocity_step):
+    """
+        Composite kernel (rotation * radial-tangential macroturbulence * instrumental
+        gaussian) sampled every velocity_step [km/s]. Zero or None values disable
+        the corresponding broadening.
+
+        Kernels are cached by (vmac, vsini, epsilon, R, velocity_step) and returned
+        as read-only arrays.
+    """
+    kernel = np.ones(1)
+    if vsini is not None and vsini > 0:
+        if epsilon is None:
+            epsilon = 0.
+        kernel = np.convolve(kernel, _rotation_kernel(velocity_step, vsini, epsilon))
+    if vmac is not None and vmac > 0:
+        kernel = np.convolve(kernel, _vmac_kernel(velocity_step, vmac))
+    if R is not None and R > 0:
+        kernel = np.convolve(kernel, _gaussian_kernel(_instrumental_fwhm_in_velocity(R), velocity_step))
+    kernel.setflags(write=False)
+    return kernel
+
+def __fused_broadening(spectrum, vmac, vsini, epsilon, R):
+    """
+        Apply rotation, macroturbulence and resolution at once: the spectrum is
+        resampled to a grid uniform in velocity, convolved only once with the
+        composite kernel and resampled back to the original wavelengths.
+    """
+    if not ((vmac is not None and vmac > 0) or (vsini is not None and vsini > 0) or (R is not None and R > 0)):
+        return spectrum['flux']
+    # Include the first wavelength, the grid remains uniform in velocity
+    velocity_step, waveobs_uniform_in_velocity, to_uniform, from_uniform = _resampling_plan(spectrum, include_base=True)
+    fluxes_uniform_in_velocity = _interpolate_with_plan(to_uniform, spectrum['flux'])
+
+    to_float = lambda value: 0. if value is None else float(value)
+    kernel = _broadening_kernel(to_float(vmac), to_float(vsini), to_float(epsilon), to_float(R), float(velocity_step))
+    fluxes_uniform_in_velocity = 1 - fftconvolve(1-fluxes_uniform_in_velocity, kernel, mode='same')
+
+    # Resample to origin wavelength grid
+    return _interpolate_with_plan(from_uniform, fluxes_uniform_in_velocity)
+
+class _LRUCache(object):
+    """
+        Small least recently used cache with hit/miss counters.
+    """
+    def __init__(self, maxsize=8):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self.hits = 0
+        self.misses = 0
+        self._entries.clear()
+
+    def info(self):
+        return {'hits': self.hits, 'misses': self.misses, 'maxsize': self.maxsize, 'currsize': len(self._entries)}
+
+_resampling_plans = _LRUCache(maxsize=4)
+_uniform_depths_cache = _LRUCache(maxsize=8)
+
+def precomputation_cache_info():
+    """
+        Hits/misses of the caches used by apply_post_fundamental_effects
+        (resampling plans and broadening kernels).
+    """
+    info = {'resampling_plans': _resampling_plans.info(), 'uniform_depths': _uniform_depths_cache.info()}
+    for name, cached_function in (('rotation_kernels', _rotation_kernel), ('vmac_kernels', _vmac_kernel), ('broadening_kernels', _broadening_kernel), ('broadening_kernel_derivatives', _broadening_kernel_derivative)):
+        cache_info = cached_function.cache_info()
+        info[name] = {'hits': cache_info.hits, 'misses': cache_info.misses, 'maxsize': cache_info.maxsize, 'currsize': cache_info.currsize}
+    return info
+
+def clear_precomputation_cache():
+    _resampling_plans.clear()
+    _uniform_depths_cache.clear()
+    _rotation_kernel.cache_clear()
+    _vmac_kernel.cache_clear()
+    _broadening_kernel.cache_clear()
+    _broadening_kernel_derivative.cache_clear()
+
+def __interpolation_plan(x, xp):
+    """
+        Indices and weights to linearly interpolate values sampled at 'xp' into 'x'
+        (equivalent to np.interp with left=0 and right=0).
+    """
+    indices = np.searchsorted(xp, x, side='right') - 1
+    outside = np.logical_or(x < xp[0], x > xp[-1])
+    indices = np.clip(indices, 0, len(xp)-2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        weights = (x - xp[indices]) / (xp[indices+1] - xp[indices])
+    weights[np.logical_or(outside, ~np.isfinite(weights))] = 0.
+    return indices, weights, outside
+
+def _interpolate_with_plan(plan, fp):
+    indices, weights, outside = plan
+    values = fp[indices] + weights * (fp[indices+1] - fp[indices])
+    values[outside] = 0.
+    return values
+
+def _resampling_plan(spectrum, include_base=False):
+    """
+        Velocity step, wavelengths uniform in velocity and interpolation plans to
+        go to that grid and back to the spectrum wavelengths. Plans are cached
+        for the last wavelength grids since they do not change during a
+        minimization.
+    """
+    waveobs = spectrum['waveobs']
+    key = (len(waveobs), waveobs[0], waveobs[-1], float(np.sum(waveobs)), include_base)
+    entry = _resampling_plans.get(key)
+    if entry is not None and np.array_equal(entry[0], waveobs):
+        return entry[1]
+    elif entry is not None:
+        # Fingerprint collision, count it as a miss
+        _resampling_plans.hits -= 1
+        _resampling_plans.misses += 1
+
+    wave_base = waveobs[0]
+    wave_top = waveobs[-1]
+    velocity_step = __determine_velocity_step(spectrum)
+    waveobs_uniform_in_velocity = _sampling_uniform_in_velocity(wave_base, wave_top, velocity_step)
+    if include_base:
+        waveobs_uniform_in_velocity = np.hstack((wave_base, waveobs_uniform_in_velocity))
+    to_uniform = __interpolation_plan(waveobs_uniform_in_velocity, waveobs)
+    from_uniform = __interpolation_plan(waveobs, waveobs_uniform_in_velocity)
+    plan = (velocity_step, waveobs_uniform_in_velocity, to_uniform, from_uniform)
+    _resampling_plans.put(key, (waveobs.copy(), plan))
+    return plan
+
 def __determine_velocity_step(spectrum):
     # Determine step size for a new model wavelength scale, which must be uniform
     # in velocity to facilitate convolution with broadening kernels. The uniform
@@ -18,6 +18,9 @@
 import os
 import sys
 import time
+import json
+import gzip
+import weakref
 import numpy as np
 from scipy import spatial
 from scipy.spatial.qhull import QhullError
@@ -31,13 +34,120 @@ from astropy.table import Table, Column
 import pickle as pickle
 import logging
 
-from ispec.atmospheres import interpolate_atmosphere_layers, valid_atmosphere_target, _interpolate
+from ispec.atmospheres import interpolate_atmosphere_layers, valid_atmosphere_target, _interpolate, _interpolation_nodes, _load_triangulations
 from ispec.common import mkdir_p, estimate_vmic, estimate_vmac
-from ispec.spectrum import create_spectrum_structure, resample_spectrum, create_wavelength_filter, read_spectrum, write_spectrum
+from ispec.spectrum import create_spectrum_structure, resample_spectrum, resample_spectra, create_wavelength_filter, read_spectrum, write_spectrum
 from .effects import apply_post_fundamental_effects
 from ispec.modeling.common import Constants
 import ispec.synth.common
 
+class SpectralGridStore(object):
+    """ Fluxes of all the spectra of a grid, restricted to some wavelength
+        ranges, in one float32 (n_nodes, n_pixels) array. Wavelengths are the
+        ones of the first spectrum (the rest are resampled if needed).
+
+        The array lives in shared memory (multiprocessing.shared_memory) so
+        that, when the grid is sent to other processes (i.e. pickled for a
+        multiprocessing pool), they attach to the same block instead of
+        copying it. The process that loaded the grid releases the block when
+        the store is closed or garbage collected.
+
+        It can be called with a filename (like the original 'read_point_value')
+        and it returns the spectrum of that node. """
+    def __init__(self, filenames, wave_range=None, shared=True):
+        self.filenames = np.asarray(filenames)
+        self.indices = dict((filename, i) for i, filename in enumerate(self.filenames))
+        regions = _wave_range_to_regions(wave_range)
+        self._shared_memory = None
+        self.waveobs = None
+        self.fluxes = None
+        for i, filename in enumerate(self.filenames):
+            spectrum = read_spectrum(filename, apply_filters=False, sort=False, regions=regions)
+            if regions is not None:
+                spectrum = spectrum[create_wavelength_filter(spectrum, regions=regions)]
+            if self.waveobs is None:
+                self.waveobs = np.array(spectrum['waveobs'], dtype=float)
+                self.__allocate((len(self.filenames), len(self.waveobs)), shared)
+            if not np.array_equal(spectrum['waveobs'], self.waveobs):
+                spectrum = resample_spectrum(spectrum, self.waveobs, method="linear", zero_edges=True)
+            self.fluxes[i] = spectrum['flux']
+        logging.info("Spectral grid loaded in memory: {} spectra of {} points ({:.1f} MB)".format(self.fluxes.shape[0], self.fluxes.shape[1], self.fluxes.nbytes/1024.**2))
+
+    def __allocate(self, shape, shared):
+        if shared:
+            from multiprocessing import shared_memory
+            nbytes = int(np.prod(shape)) * np.dtype(np.float32).itemsize
+            self._shared_memory = shared_memory.SharedMemory(create=True, size=max(nbytes, 1))
+            self.fluxes = np.ndarray(shape, dtype=np.float32, buffer=self._shared_memory.buf)
+            self._finalizer = weakref.finalize(self, SpectralGridStore._release, self._shared_memory, True)
+        else:
+            self.fluxes = np.zeros(shape, dtype=np.float32)
+
+    @staticmethod
+    def _release(block, owner):
+        try:
+            block.close()
+        except BufferError:
+            pass # Views of the fluxes are still in use
+        if owner:
+            try:
+                block.unlink()
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        """ Release the shared memory (it will be removed if this process created it) """
+        if self._shared_memory is not None:
+            self.fluxes = None
+            self._finalizer()
+
+    def __getstate__(self):
+        state = {'filenames': self.filenames, 'waveobs': self.waveobs}
+        if self._shared_memory is not None:
+            state['shared_memory_name'] = self._shared_memory.name
+            state['shape'] = self.fluxes.shape
+        else:
+            state['fluxes'] = self.fluxes
+        return state
+
+    def __setstate__(self, state):
+        self.filenames = state['filenames']
+        self.indices = dict((filename, i) for i, filename in enumerate(self.filenames))
+        self.waveobs = state['waveobs']
+        if 'shared_memory_name' in state:
+            from multiprocessing import shared_memory
+            # Attach to the block created by the process that loaded the grid
+            self._shared_memory = shared_memory.SharedMemory(name=state['shared_memory_name'])
+            self.fluxes = np.ndarray(state['shape'], dtype=np.float32, buffer=self._shared_memory.buf)
+            self._finalizer = weakref.finalize(self, SpectralGridStore._release, self._shared_memory, False)
+        else:
+            self._shared_memory = None
+            self.fluxes = state['fluxes']
+
+    def interpolate(self, node_indices, weights):
+        """ Weighted sum of the fluxes of the given nodes """
+        return np.dot(weights, self.fluxes[node_indices].astype(float))
+
+    def __call__(self, filename, regions=None):
+        spectrum = create_spectrum_structure(self.waveobs.copy(), self.fluxes[self.indices[filename]].astype(float))
+        if regions is not None:
+            spectrum = spectrum[create_wavelength_filter(spectrum, regions=regions)]
+        return spectrum
+
+def _wave_range_to_regions(wave_range):
+    """
+    Regions from a (wave_base, wave_top) tuple or from segments (with
+    'wave_base' and 'wave_top').
+    """
+    if wave_range is None:
+        return None
+    if hasattr(wave_range, 'dtype') and wave_range.dtype.names is not None:
+        return wave_range
+    regions = np.recarray((1,),  dtype=[('wave_base', float), ('wave_top', float)])
+    regions['wave_base'][0] = wave_range[0]
+    regions['wave_top'][0] = wave_range[1]
+    return regions
+
 def generate_fundamental_spectrum(grid, waveobs, teff, logg, MH, alpha, microturbulence_vel, regions=None):
     """
     Generates an interpolated spectrum from a grid. vmic is always fixed and depends
@@ -56,25 +166,33 @@ def _add_target_if_possible(free_parameters, target_point, name, value):
 def generate_spectrum(grid, waveobs, teff, logg, MH, alpha, microturbulence_vel, macroturbulence=0.0, vsini=0.0, limb_darkening_coeff=0.00, R=0, regions=None):
     existing_points, free_parameters, filenames, read_point_value, value_fields, delaunay_triangulation, kdtree, ranges, base_dirname = grid
 
-    if regions is None:
-        global_wave_base = np.min(waveobs)
-        global_wave_top = np.max(waveobs)
-        regions = np.recarray((1,),  dtype=[('wave_base', float), ('wave_top', float)])
-        regions['wave_base'][0] = global_wave_base
-        regions['wave_top'][0] = global_wave_top
-    # Only read the part of the spectrum that needs to be interpolated
-    def read_point_value(f, regions=None):
-        return read_spectrum(f, apply_filters=False, sort=False, regions=regions)
-    custom_read_point_value = lambda f: read_point_value(f, regions=regions)
-
     target_point = []
     target_point = _add_target_if_possible(free_parameters, target_point, 'teff', teff)
     target_point = _add_target_if_possible(free_parameters, target_point, 'logg', logg)
     target_point = _add_target_if_possible(free_parameters, target_point, 'MH', MH)
     target_point = _add_target_if_possible(free_parameters, target_point, 'alpha', alpha)
     target_point = _add_target_if_possible(free_parameters, target_point, 'vmic', microturbulence_vel)
-    interpolated = _interpolate(delaunay_triangulation, kdtree, existing_points, filenames, custom_read_point_value, value_fields, target_point)
-    interpolated_spectrum = create_spectrum_structure(interpolated['waveobs'], interpolated['flux'])
+
+    if isinstance(read_point_value, SpectralGridStore):
+        # Grid in memory: weighted sum of rows
+        if np.min(waveobs) < read_point_value.waveobs[0] or np.max(waveobs) > read_point_value.waveobs[-1]:
+            logging.warning("Requested wavelengths are out of the range loaded in memory for the grid")
+        node_indices, weights, closest = _interpolation_nodes(delaunay_triangulation, kdtree, existing_points, target_point)
+        interpolated_spectrum = create_spectrum_structure(read_point_value.waveobs, read_point_value.interpolate(node_indices, weights))
+    else:
+        if regions is None:
+            global_wave_base = np.min(waveobs)
+            global_wave_top = np.max(waveobs)
+            regions = np.recarray((1,),  dtype=[('wave_base', float), ('wave_top', float)])
+            regions['wave_base'][0] = global_wave_base
+            regions['wave_top'][0] = global_wave_top
+        # Only read the part of the spectrum that needs to be interpolated
+        def read_point_value(f, regions=None):
+            return read_spectrum(f, apply_filters=False, sort=False, regions=regions)
+        custom_read_point_value = lambda f: read_point_value(f, regions=regions)
+
+        interpolated = _interpolate(delaunay_triangulation, kdtree, existing_points, filenames, custom_read_point_value, value_fields, target_point)
+        interpolated_spectrum = create_spectrum_structure(interpolated['waveobs'], interpolated['flux'])
 
     # Make sure we return the number of expected fluxes
     if not np.array_equal(interpolated_spectrum['waveobs'], waveobs):
@@ -88,48 +206,238 @@ def generate_spectrum(grid, waveobs, teff, logg, MH, alpha, microturbulence_vel,
     return interpolated_spectrum['flux']
 
 
-def __generate_synthetic_fits(filename_out, wavelengths, segments, teff, logg, MH, alpha, vmic, vmac, vsini, limb_darkening_coeff, resolution, pickled_modeled_layers_pack, atomic_linelist, isotopes, solar_abundances, code="spectrum", use_molecules=False, tmp_dir=None, locked=False):
-    multiprocessing.current_process().daemon=False
+_PRECOMPUTE_MANIFEST_VERSION = 1
+_FITS_FLOAT_DTYPES = {-32: '>f4', -64: '>f8'}
+_PRECOMPUTE_MANIFEST_FILENAME = "manifest.json"
 
+# Synthesis context of each precompute worker (loaded only once per process)
+_precompute_context = None
+
+def __init_precompute_worker(pickled_context):
+    global _precompute_context
+    # Workers of a pool are daemonic but some radiative transfer codes run in
+    # their own child process
+    multiprocessing.current_process().daemon=False
     import dill # To allow pickle of lambda functions (e.g., one element in modeled_layers_pack)
-    import pickle
-    modeled_layers_pack = dill.loads(pickled_modeled_layers_pack)
+    _precompute_context = dill.loads(pickled_context)
 
-    if valid_atmosphere_target(modeled_layers_pack, {'teff':teff, 'logg':logg, 'MH':MH, 'alpha':alpha}):
-        if not locked:
-            lock = FileLock(filename_out+".lock")
-            try:
-                lock.acquire(timeout=-1)    # Don't wait
-            except (LockTimeout, AlreadyLocked) as e:
-                # Some other process is computing this spectrum, do not continue
-                print("Skipping", teff, logg, MH, alpha, vmic, vmac, vsini, limb_darkening_coeff, "already locked")
-                return None
+def __generate_synthetic_fits(filename_out, teff, logg, MH, alpha, vmic, vmac, vsini, limb_darkening_coeff, resolution):
+    """
+    Synthesize one spectrum with the context loaded by the worker and save it.
+    The file is written with a temporary name and renamed when complete, so a
+    crash never leaves truncated spectra in the grid.
+    """
+    context = _precompute_context
+    modeled_layers_pack = context['modeled_layers_pack']
+    if not valid_atmosphere_target(modeled_layers_pack, {'teff':teff, 'logg':logg, 'MH':MH, 'alpha':alpha}):
+        raise Exception("Not valid: %i %.2f %.2f" % (teff, logg, MH))
+    # Prepare atmosphere model
+    atmosphere_layers = interpolate_atmosphere_layers(modeled_layers_pack, {'teff':teff, 'logg':logg, 'MH':MH, 'alpha':alpha}, code=context['code'])
+    fixed_abundances=None
+    # Synthesis
+    synth_spectrum = create_spectrum_structure(context['wavelengths'])
+    synth_spectrum['flux'] = ispec.synth.common.generate_spectrum(synth_spectrum['waveobs'], \
+            atmosphere_layers, teff, logg, MH, alpha, context['atomic_linelist'], context['isotopes'], context['solar_abundances'], \
+            fixed_abundances, microturbulence_vel = vmic, \
+            macroturbulence=vmac, vsini=vsini, limb_darkening_coeff=limb_darkening_coeff, \
+            R=resolution, regions=context['segments'], verbose=0, timeout=context['timeout'], \
+            code=context['code'], use_molecules=context['use_molecules'], tmp_dir=context['tmp_dir'])
+    if np.all(synth_spectrum['flux'] == 0):
+        # Radiative transfer codes return zeros when they fail or time out
+        raise Exception("Synthesis failed or timed out")
+    tmp_filename_out = os.path.join(os.path.dirname(filename_out), ".partial_" + os.path.basename(filename_out))
+    write_spectrum(synth_spectrum, tmp_filename_out)
+    os.replace(tmp_filename_out, filename_out)
+    return synth_spectrum
 
+def __run_precompute_task(task):
+    """
+    Execute one task of the manifest and return (filename, status, elapsed, error, convolved).
+    The status is 'done', 'failed' or 'locked' (another process is computing it).
+    Reference spectra are also convolved and stored in their rows of the
+    convolved grid (tasks already 'done' are only convolved).
+    """
+    context = _precompute_context
+    filename_out = os.path.join(context['output_dirname'], task['filename'])
+    parameters = [task[name] for name in ('teff', 'logg', 'MH', 'alpha', 'vmic', 'vmac', 'vsini', 'limb_darkening_coeff')]
+    spectrum = None
+    elapsed = task['elapsed']
+    if task['status'] != 'done':
+        lock = FileLock(filename_out+".lock")
         try:
-            print("[started]", teff, logg, MH, alpha, vmic, vmac, vsini, limb_darkening_coeff, resolution)
-            # Prepare atmosphere model
-            atmosphere_layers = interpolate_atmosphere_layers(modeled_layers_pack, {'teff':teff, 'logg':logg, 'MH':MH, 'alpha':alpha}, code=code)
-            fixed_abundances=None
-            # Synthesis
-            synth_spectrum = create_spectrum_structure(wavelengths)
-            synth_spectrum['flux'] = ispec.synth.common.generate_spectrum(synth_spectrum['waveobs'], \
-                    atmosphere_layers, teff, logg, MH, alpha, atomic_linelist, isotopes, solar_abundances, \
-                    fixed_abundances, microturbulence_vel = vmic, \
-                    macroturbulence=vmac, vsini=vsini, limb_darkening_coeff=limb_darkening_coeff, \
-                    R=resolution, regions=segments, verbose=0, \
-                    code=code, use_molecules=use_molecules, tmp_dir=tmp_dir)
-            # FITS
-            write_spectrum(synth_spectrum, filename_out)
-            print("[finished]", teff, logg, MH, alpha, vmic, vmac, vsini, limb_darkening_coeff, resolution)
+            lock.acquire(timeout=-1)    # Don't wait
+        except (LockTimeout, AlreadyLocked) as e:
+            # Some other process is computing this spectrum, do not continue
+            return task['filename'], 'locked', 0., None, False
+        tcheck = time.time()
+        try:
+            print("[started]", *parameters)
+            spectrum = __generate_synthetic_fits(filename_out, *parameters, resolution=0)
+            print("[finished]", *parameters)
+            elapsed = time.time() - tcheck
+        except Exception as e:
+            logging.error("Synthesis failed for {}: {}".format(task['filename'], e))
+            return task['filename'], 'failed', time.time() - tcheck, "{}: {}".format(type(e).__name__, e), False
         finally:
-            if not locked: # Not locked in this function
-                lock.release()
+            lock.release()
+
+    convolved = task['convolved']
+    if len(task['rows']) > 0 and context['to_resolution'] is not None and not convolved:
+        try:
+            if spectrum is None:
+                spectrum = read_spectrum(filename_out)
+            flux = __convolve_reference_spectrum(spectrum, task['teff'], task['logg'], task['MH'], context['to_resolution'])
+            _store_convolved_fluxes(context['convolved_grid_filename'], task['rows'], flux)
+            convolved = True
+        except Exception as e:
+            logging.error("Convolution failed for {}: {}".format(task['filename'], e))
+            return task['filename'], 'done', elapsed, "{}: {}".format(type(e).__name__, e), False
+    return task['filename'], 'done', elapsed, None, convolved
+
+def _open_convolved_grid(filename, shape=None):
+    """
+    Memory-mapped convolved grid (one row per reference spectrum). Big-endian
+    floats are used so that it can be written to FITS without byte swapping.
+    If 'shape' is specified, a new grid is created.
+    """
+    if shape is not None:
+        return np.lib.format.open_memmap(filename, mode="w+", dtype='>f8', shape=shape)
+    return np.lib.format.open_memmap(filename, mode="r+")
+
+def _store_convolved_fluxes(filename, rows, flux):
+    # Every process writes its own rows directly in the file
+    convolved_grid = _open_convolved_grid(filename)
+    convolved_grid[rows] = flux
+    convolved_grid.flush()
+    del convolved_grid
+
+def __write_precompute_manifest(manifest_filename, tasks):
+    # Write and rename, a crash while writing does not corrupt the manifest
+    tmp_manifest_filename = manifest_filename + ".tmp"
+    with open(tmp_manifest_filename, "w") as manifest_file:
+        json.dump({'version': _PRECOMPUTE_MANIFEST_VERSION, 'tasks': tasks}, manifest_file, indent=1)
+    os.replace(tmp_manifest_filename, manifest_filename)
+
+def __load_precompute_manifest(output_dirname, manifest_filename, tasks):
+    """
+    Merge the status of a previous (maybe interrupted) execution with the
+    requested tasks. Spectra found in disk are considered done.
+    """
+    previous = {}
+    if os.path.exists(manifest_filename):
+        try:
+            with open(manifest_filename, "r") as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get('version') == _PRECOMPUTE_MANIFEST_VERSION:
+                previous = dict((task['filename'], task) for task in manifest['tasks'])
+            else:
+                logging.warning("Ignoring manifest with a different version: {}".format(manifest_filename))
+        except ValueError:
+            logging.warning("Ignoring corrupted manifest: {}".format(manifest_filename))
+    for task in tasks:
+        if task['filename'] in previous:
+            task['attempts'] = previous[task['filename']].get('attempts', 0)
+            task['elapsed'] = previous[task['filename']].get('elapsed', 0.)
+            task['error'] = previous[task['filename']].get('error', None)
+        if os.path.exists(os.path.join(output_dirname, task['filename'])):
+            task['status'] = 'done'
+            # Rows in the convolved grid are only valid if they correspond to the same rows
+            task['convolved'] = task['filename'] in previous and previous[task['filename']].get('convolved', False) \
+                                    and previous[task['filename']].get('rows') == task['rows']
+        elif task['filename'] in previous and previous[task['filename']]['status'] == 'failed':
+            task['status'] = 'failed'
+        else:
+            task['status'] = 'pending'
+    return tasks
+
+def __run_precompute_tasks(tasks, manifest_filename, pickled_context, number_of_processes=1, max_retries=2, convolve=False, manifest_interval=1.):
+    """
+    Execute the pending tasks (and the failed ones until they reach
+    1 + max_retries attempts) in a pool of workers that load the synthesis
+    context only once. If 'convolve' is True, reference spectra that are done
+    but not convolved are also processed. The manifest is updated as results
+    arrive (at most every 'manifest_interval' seconds).
+    """
+    tasks_by_filename = dict((task['filename'], task) for task in tasks)
+    convolution_attempted = set()
+    def runnable(task):
+        if task['status'] == 'done':
+            return convolve and len(task['rows']) > 0 and not task['convolved'] and task['filename'] not in convolution_attempted
+        return task['status'] == 'pending' or (task['status'] == 'failed' and task['attempts'] <= max_retries)
+
+    if number_of_processes == 1:
+        pool = None
+        __init_precompute_worker(pickled_context)
     else:
-        raise Exception("Not valid: %i %.2f %.2f" % (teff, logg, MH))
+        pool = Pool(number_of_processes, initializer=__init_precompute_worker, initargs=(pickled_context,))
+
+    start_time = time.time()
+    completed = 0
+    try:
+        while True:
+            batch = [task for task in tasks if runnable(task)]
+            if len(batch) == 0:
+                break
+            for task in batch:
+                if task['status'] == 'done':
+                    convolution_attempted.add(task['filename'])
+                else:
+                    task['attempts'] += 1
+                    task['status'] = 'running'
+            __write_precompute_manifest(manifest_filename, tasks)
+            manifest_written = time.time()
+            if pool is None:
+                results = map(__run_precompute_task, batch)
+            else:
+                results = pool.imap_unordered(__run_precompute_task, batch)
+            remaining = len(batch)
+            for filename, status, elapsed, error, convolved in results:
+                remaining -= 1
+                task = tasks_by_filename[filename]
+                task['status'] = status
+                task['elapsed'] = elapsed
+                task['error'] = error
+                task['convolved'] = convolved
+                if status == 'locked':
+                    # Not an attempt, some other process is taking care of it
+                    task['attempts'] -= 1
+                    task['status'] = 'skipped'
+                elif status == 'done':
+                    completed += 1
+                if time.time() - manifest_written > manifest_interval:
+                    __write_precompute_manifest(manifest_filename, tasks)
+                    manifest_written = time.time()
 
+                    # Estimate remaining time from the measured throughput
+                    throughput = completed / (time.time() - start_time) # spectra per second
+                    if throughput > 0:
+                        logging.info("Precomputed grid: {} done, {} remaining in this round, {:.2f} spectra/hour, ETA {:.1f} hours".format(completed, remaining, throughput*3600, remaining/throughput/3600))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+        for task in tasks:
+            if task['status'] in ('running', 'skipped'):
+                task['status'] = 'pending'
+        __write_precompute_manifest(manifest_filename, tasks)
 
+    failed = [task['filename'] for task in tasks if task['status'] == 'failed']
+    if len(failed) > 0:
+        logging.error("{} spectra could not be computed after {} attempts (see {}): {}".format(len(failed), 1+max_retries, manifest_filename, ", ".join(failed)))
+    return tasks
 
-def precompute_synthetic_grid(output_dirname, ranges, wavelengths, to_resolution, modeled_layers_pack, atomic_linelist, isotopes, solar_abundances, segments=None, number_of_processes=1, code="spectrum", use_molecules=False, steps=False, tmp_dir=None):
+def __convolve_reference_spectrum(spectrum, teff, logg, MH, to_resolution):
+    # Spectra in the grid is convolved to the specified resolution for fast comparison
+    vmac = estimate_vmac(teff, logg, MH)
+    vsini = 1.6 # Sun
+    limb_darkening_coeff = 0.6
+    segments = None
+    vrad = (0,)
+    return apply_post_fundamental_effects(spectrum['waveobs'], spectrum['flux'], segments, \
+                macroturbulence=vmac, vsini=vsini, \
+                limb_darkening_coeff=limb_darkening_coeff, R=to_resolution, vrad=vrad)
+
+def precompute_synthetic_grid(output_dirname, ranges, wavelengths, to_resolution, modeled_layers_pack, atomic_linelist, isotopes, solar_abundances, segments=None, number_of_processes=1, code="spectrum", use_molecules=False, steps=False, tmp_dir=None, spectrum_format="fits.gz", max_retries=2, timeout=1800, index_linemasks=None):
     """
     Pre-compute a synthetic grid with some reference ranges (Teff, log(g) and
     MH combinations) and all the steps that iSpec will perform in the
@@ -141,14 +449,42 @@ def precompute_synthetic_grid(output_dirname, ranges, wavelengths, to_resolution
 
     The output directory can be used by the routines 'model_spectrum' and
     'estimate_initial_ap'.
+
+    The non-convolved spectra are saved as compressed FITS files by default
+    (spectrum_format="fits.gz") or in iSpec binary format (spectrum_format="ispec"),
+    which is bigger on disk but it is memory-mapped when the grid is interpolated
+    and only the requested wavelength regions are read.
+
+    The status of every spectrum is kept in 'manifest.json' in the output
+    directory. If the execution is interrupted, calling this function again
+    resumes the work. Spectra that fail or exceed the 'timeout' (seconds) are
+    retried up to 'max_retries' times (also in later executions if they
+    still have attempts left). Reference spectra are convolved by the workers
+    as soon as they are computed and stored in their row of a preallocated
+    memory-mapped file ('convolved_grid_<R>.partial.npy'), which is streamed
+    to the final FITS file when all the rows are ready (and kept as
+    'convolved_grid_<R>.npy' for 'estimate_initial_ap', with the wavelengths
+    and parameters in 'convolved_grid_<R>.npz'). If 'index_linemasks' are
+    given, an index for fast initial parameter estimation with those
+    linemasks is also built (see 'build_convolved_grid_index').
     """
     code = code.lower()
     if code not in ['spectrum', 'turbospectrum', 'moog', 'synthe', 'sme']:
         raise Exception("Unknown radiative transfer code: %s" % (code))
+    spectrum_format = spectrum_format.lower()
+    if spectrum_format not in ['fits.gz', 'ispec']:
+        raise Exception("Unknown spectrum format: %s" % (spectrum_format))
+    spectrum_extension = "." + spectrum_format
 
     reference_list_filename = output_dirname + "/parameters.tsv"
+    manifest_filename = os.path.join(output_dirname, _PRECOMPUTE_MANIFEST_FILENAME)
+    convolve = False
+    convolved_grid_filename = None
     if to_resolution is not None:
         reference_grid_filename = output_dirname + "/convolved_grid_%i.fits.gz" % to_resolution
+        # Rows are written in this file (memory-mapped) as reference spectra are convolved
+        convolved_grid_filename = output_dirname + "/convolved_grid_%i.partial.npy" % to_resolution
+        convolve = not os.path.exists(reference_grid_filename)
     fits_dir = os.path.join(output_dirname, "grid/")
     mkdir_p(fits_dir)
     if steps:
@@ -156,8 +492,22 @@ def precompute_synthetic_grid(output_dirname, ranges, wavelengths, to_resolution
         mkdir_p(steps_fits_dir)
 
     import dill # To allow pickle of lambda functions (e.g., one element in modeled_layers_pack)
-    import pickle
-    pickled_modeled_layers_pack = dill.dumps(modeled_layers_pack)
+    # Everything the workers need is sent only once, when they start
+    pickled_context = dill.dumps({
+            'output_dirname': output_dirname,
+            'modeled_layers_pack': modeled_layers_pack,
+            'wavelengths': wavelengths,
+            'segments': segments,
+            'atomic_linelist': atomic_linelist,
+            'isotopes': isotopes,
+            'solar_abundances': solar_abundances,
+            'code': code,
+            'use_molecules': use_molecules,
+            'tmp_dir': tmp_dir,
+            'timeout': timeout,
+            'to_resolution': to_resolution if convolve else None,
+            'convolved_grid_filename': convolved_grid_filename,
+        })
 
     # For code != "grid", ranges are always in position 7 (for grid it would be in position 8)
     valid_ranges = modeled_layers_pack[7]
@@ -167,26 +517,14 @@ def precompute_synthetic_grid(output_dirname, ranges, wavelengths, to_resolution
     alpha_range = valid_ranges.get('alpha', (-1.5, 1.5)) # Default (0.,) if 'alpha' is not a free parameter for atmosphere interpolation
     vmic_range = valid_ranges.get('vmic', (0.0, 50.)) # Default (0.,) if 'vmic' is not a free parameter for atmosphere interpolation
 
-    # Parallelization pool
-    if number_of_processes == 1:
-        pool = None
-    else:
-        pool = Pool(number_of_processes)
-
-    # Create grid binary file
-    elapsed = 0 # seconds
-
-    num_ref_spec = len(ranges)
-    num_spec = num_ref_spec * 9 # Reference + 8 variations in Teff, logg, MH, alpha, vmic, vmac, vsini, limb darkening coeff
-
-    i = 0
-    for teff, logg, MH, alpha, vmic in ranges:
+    tasks = []
+    tasks_by_filename = {}
+    for row, (teff, logg, MH, alpha, vmic) in enumerate(ranges):
         if vmic is None:
             vmic = estimate_vmic(teff, logg, MH)
         vmac = 0.0 # This can be modified after synthesis if needed
         vsini = 0.0 # This can be modified after synthesis if needed
         limb_darkening_coeff = 0.00 # This can be modified after synthesis if needed
-        resolution = 0 # This can be modified after synthesis if needed
         is_step = False
         if not valid_atmosphere_target(modeled_layers_pack, {'teff': teff, 'logg': logg, 'MH': MH, 'alpha': alpha}):
             raise Exception("Target parameters out of the valid ranges: teff={} logg={} MH={} alpha={}".format(teff, logg, MH, alpha))
@@ -216,57 +554,34 @@ def precompute_synthetic_grid(output_dirname, ranges, wavelengths, to_resolution
                     ]
 
         for j, (teff, logg, MH, alpha, vmic, vmac, vsini, limb_darkening_coeff, is_step) in enumerate(points):
-            if is_step:
-                filename_out = steps_fits_dir + "{0}_{1:.2f}_{2:.2f}_{3:.2f}_{4:.2f}_{5:.2f}_{6:.2f}_{7:.2f}".format(int(teff), logg, MH, alpha, vmic, vmac, vsini, limb_darkening_coeff) + ".fits.gz"
-            else:
-                filename_out = fits_dir + "{0}_{1:.2f}_{2:.2f}_{3:.2f}_{4:.2f}_{5:.2f}_{6:.2f}_{7:.2f}".format(int(teff), logg, MH, alpha, vmic, vmac, vsini, limb_darkening_coeff) + ".fits.gz"
+            filename_out = ("steps/" if is_step else "grid/") + "{0}_{1:.2f}_{2:.2f}_{3:.2f}_{4:.2f}_{5:.2f}_{6:.2f}_{7:.2f}".format(int(teff), logg, MH, alpha, vmic, vmac, vsini, limb_darkening_coeff) + spectrum_extension
+            if filename_out not in tasks_by_filename:
+                tasks_by_filename[filename_out] = {'filename': filename_out, 'teff': float(teff), 'logg': float(logg), 'MH': float(MH), 'alpha': float(alpha), \
+                            'vmic': float(vmic), 'vmac': float(vmac), 'vsini': float(vsini), 'limb_darkening_coeff': float(limb_darkening_coeff), \
+                            'is_step': is_step, 'rows': [], 'status': 'pending', 'attempts': 0, 'elapsed': 0., 'error': None, 'convolved': False}
+                tasks.append(tasks_by_filename[filename_out])
+            if j == 0:
+                # Reference spectrum: row(s) of the convolved grid
+                tasks_by_filename[filename_out]['rows'].append(row)
 
-            if os.path.exists(filename_out):
-                print("Skipping", teff, logg, MH, alpha, vmic, vmac, vsini, limb_darkening_coeff, "already computed")
-                continue
-
-
-            if pool is None:
-                if sys.platform == "win32":
-                    # On Windows, the best timer is time.clock()
-                    default_timer = time.clock
-                else:
-                    # On most other platforms the best timer is time.time()
-                    default_timer = time.time
-
-                lock = FileLock(filename_out+".lock")
-                try:
-                    lock.acquire(timeout=-1)    # Don't wait
-                except (LockTimeout, AlreadyLocked) as e:
-                    # Some other process is computing this spectrum, do not continue
-                    print("Skipping", teff, logg, MH, alpha, vmic, vmac, vsini, limb_darkening_coeff, "already locked")
-                    continue
-
-                try:
-                    tcheck = default_timer()
-                    # Validate parameters
-                    __generate_synthetic_fits(filename_out, wavelengths, segments, teff, logg, MH, alpha, vmic, vmac, vsini, limb_darkening_coeff, resolution, pickled_modeled_layers_pack, atomic_linelist, isotopes, solar_abundances, code=code, use_molecules=use_molecules, tmp_dir=tmp_dir, locked=True)
-                    elapsed = default_timer() - tcheck
-
-                    print("-----------------------------------------------------")
-                    print("Remaining time:")
-                    print("\t", (num_spec-i)*elapsed, "seconds")
-                    print("\t", (num_spec-i)*(elapsed/60), "minutes")
-                    print("\t", (num_spec-i)*(elapsed/(60*60)), "hours")
-                    print("\t", (num_spec-i)*(elapsed/(60*60*24)), "days")
-                    print("-----------------------------------------------------")
-                finally:
-                    lock.release()
-
-            else:
-                pool.apply_async(__generate_synthetic_fits, [filename_out, wavelengths, segments, teff, logg, MH, alpha, vmic, vmac, vsini, limb_darkening_coeff, resolution, pickled_modeled_layers_pack, atomic_linelist, isotopes, solar_abundances], kwds={'code': code, 'use_molecules': use_molecules, 'tmp_dir':tmp_dir, 'locked':False})
-            i += 1
-
-    if pool is not None:
-        pool.close()
-        pool.join()
+    tasks = __load_precompute_manifest(output_dirname, manifest_filename, tasks)
+    num_done = len([task for task in tasks if task['status'] == 'done'])
+    if num_done > 0:
+        logging.info("Resuming precomputed grid: {} of {} spectra already computed".format(num_done, len(tasks)))
 
+    if convolve:
+        shape = (len(ranges), len(wavelengths))
+        if os.path.exists(convolved_grid_filename) and _open_convolved_grid(convolved_grid_filename).shape == shape:
+            num_convolved = len([task for task in tasks if task['convolved']])
+            if num_convolved > 0:
+                logging.info("Resuming convolved grid: {} reference spectra already convolved".format(num_convolved))
+        else:
+            # Preallocated on disk, rows are filled by the workers
+            _open_convolved_grid(convolved_grid_filename, shape=shape).flush()
+            for task in tasks:
+                task['convolved'] = False
 
+    __run_precompute_tasks(tasks, manifest_filename, pickled_context, number_of_processes=number_of_processes, max_retries=max_retries, convolve=convolve)
 
     # Create parameters.tsv
     reference_list = Table()
@@ -296,7 +611,7 @@ def precompute_synthetic_grid(output_dirname, ranges, wavelengths, to_resolution
         zero_vmac = 0.0
         zero_vsini = 0.0
         zero_limb_darkening_coeff = 0.00
-        reference_filename_out = "./grid/{0}_{1:.2f}_{2:.2f}_{3:.2f}_{4:.2f}_{5:.2f}_{6:.2f}_{7:.2f}".format(int(teff), logg, MH, alpha, vmic, zero_vmac, zero_vsini, zero_limb_darkening_coeff) + ".fits.gz"
+        reference_filename_out = "./grid/{0}_{1:.2f}_{2:.2f}_{3:.2f}_{4:.2f}_{5:.2f}_{6:.2f}_{7:.2f}".format(int(teff), logg, MH, alpha, vmic, zero_vmac, zero_vsini, zero_limb_darkening_coeff) + spectrum_extension
         reference_list.add_row((int(teff), logg, MH, alpha, vmic, reference_filename_out))
 
     if not os.path.exists(reference_list_filename):
@@ -323,7 +638,6 @@ def precompute_synthetic_grid(output_dirname, ranges, wavelengths, to_resolution
                 print("Skipping", reference_grid_filename, "already locked")
             else:
                 try:
-                    reference_grid = None
                     complete_reference_list = Table()
                     complete_reference_list.add_column(Column(name='teff', dtype=int))
                     complete_reference_list.add_column(Column(name='logg', dtype=float))
@@ -341,42 +655,326 @@ def precompute_synthetic_grid(output_dirname, ranges, wavelengths, to_resolution
                         vmac = estimate_vmac(teff, logg, MH)
                         vsini = 1.6 # Sun
                         limb_darkening_coeff = 0.6
-                        reference_filename_out = "{0}_{1:.2f}_{2:.2f}_{3:.2f}_{4:.2f}_{5:.2f}_{6:.2f}_{7:.2f}".format(int(teff), logg, MH, alpha, vmic, zero_vmac, zero_vsini, zero_limb_darkening_coeff) + ".fits.gz"
+                        reference_filename_out = "{0}_{1:.2f}_{2:.2f}_{3:.2f}_{4:.2f}_{5:.2f}_{6:.2f}_{7:.2f}".format(int(teff), logg, MH, alpha, vmic, zero_vmac, zero_vsini, zero_limb_darkening_coeff) + spectrum_extension
                         if not os.path.exists(fits_dir + reference_filename_out):
                             continue
                         complete_reference_list.add_row((int(teff), logg, MH, alpha, vmic, vmac, vsini, limb_darkening_coeff))
 
-
-                        # Spectra in the grid is convolved to the specified resolution for fast comparison
-                        print("Quick grid:", reference_filename_out)
-                        spectrum = read_spectrum(fits_dir + reference_filename_out)
-
-                        segments = None
-                        vrad = (0,)
-                        spectrum['flux'] = apply_post_fundamental_effects(spectrum['waveobs'], spectrum['flux'], segments, \
-                                    macroturbulence=vmac, vsini=vsini, \
-                                    limb_darkening_coeff=limb_darkening_coeff, R=to_resolution, vrad=vrad)
-
-                        if reference_grid is None:
-                            reference_grid = spectrum['flux']
-                        else:
-                            reference_grid = np.vstack((reference_grid, spectrum['flux']))
-
-                    if len(ranges) == len(complete_reference_list):
+                    convolved = all(task['convolved'] for task in tasks if len(task['rows']) > 0)
+                    if len(ranges) == len(complete_reference_list) and convolved:
                         # Generate FITS file with grid for fast comparison
+                        # (streamed from the memory-mapped grid, big-endian as FITS)
+                        reference_grid = np.load(convolved_grid_filename, mmap_mode="r")
                         primary_hdu = fits.PrimaryHDU(reference_grid)
                         wavelengths_hdu = fits.ImageHDU(wavelengths, name="WAVELENGTHS")
                         params_bintable_hdu = fits.BinTableHDU(complete_reference_list.as_array(), name="PARAMS")
                         fits_format = fits.HDUList([primary_hdu, wavelengths_hdu, params_bintable_hdu])
                         fits_format.writeto(reference_grid_filename, overwrite=True)
+                        del primary_hdu, reference_grid
+                        # Uncompressed copy that can be memory-mapped by estimate_initial_ap
+                        os.replace(convolved_grid_filename, output_dirname + "/convolved_grid_%i.npy" % to_resolution)
+                        os.utime(output_dirname + "/convolved_grid_%i.npy" % to_resolution, None) # Newer than the FITS file
+                        _write_convolved_grid_metadata(output_dirname + "/convolved_grid_%i.npz" % to_resolution, wavelengths, complete_reference_list.as_array())
                         print("Written", reference_grid_filename)
+                        if index_linemasks is not None:
+                            build_convolved_grid_index(output_dirname, to_resolution, index_linemasks)
                 finally:
                     lock.release()
 
+def _load_convolved_grid(precomputed_dir, resolution, chunk_size=1024):
+    """
+    Return the wavelengths, the memory-mapped fluxes (one row per reference
+    spectrum) and the parameters of a convolved grid. The compressed FITS file
+    cannot be memory-mapped (and it has to be decompressed to reach the
+    wavelengths and parameters), thus the first time its content is copied
+    to 'convolved_grid_<R>.npy' (fluxes, uncompressed) and
+    'convolved_grid_<R>.npz' (wavelengths and parameters) next to it. If the
+    directory is not writable (e.g. shared grids), the FITS file is read in
+    memory instead.
+    """
+    reference_grid_filename = precomputed_dir + "/convolved_grid_%i.fits.gz" % resolution
+    memmap_filename = precomputed_dir + "/convolved_grid_%i.npy" % resolution
+    metadata_filename = precomputed_dir + "/convolved_grid_%i.npz" % resolution
+    outdated = lambda filename: not os.path.exists(filename) or os.path.getmtime(filename) < os.path.getmtime(reference_grid_filename)
+    if outdated(memmap_filename) or outdated(metadata_filename):
+        try:
+            __convert_convolved_grid(reference_grid_filename, memmap_filename, metadata_filename, chunk_size)
+        except (IOError, OSError) as e:
+            logging.warning("Convolved grid cannot be copied to '{}' ({}), reading it in memory".format(memmap_filename, e))
+            with fits.open(reference_grid_filename) as grid:
+                return np.asarray(grid['WAVELENGTHS'].data, dtype=float), np.asarray(grid['PRIMARY'].data), np.asarray(grid['PARAMS'].data)
+    metadata = np.load(metadata_filename)
+    fluxes = np.load(memmap_filename, mmap_mode="r")
+    return metadata['waveobs'], fluxes, metadata['params']
+
+def __convert_convolved_grid(reference_grid_filename, memmap_filename, metadata_filename, chunk_size):
+    # Temporary file per process, concurrent conversions do not interfere
+    tmp_memmap_filename = memmap_filename + ".{}.tmp.npy".format(os.getpid())
+    try:
+        with fits.open(reference_grid_filename) as grid:
+            grid_waveobs = np.asarray(grid['WAVELENGTHS'].data, dtype=float)
+            params = np.asarray(grid['PARAMS'].data)
+            header = grid['PRIMARY'].header
+            data_offset = grid.fileinfo(0)['datLoc']
+            shape = (header['NAXIS2'], header['NAXIS1'])
+            fluxes = np.lib.format.open_memmap(tmp_memmap_filename, mode="w+", dtype='>f8', shape=shape)
+            if header['BITPIX'] in _FITS_FLOAT_DTYPES and header.get('BSCALE', 1.) == 1. and header.get('BZERO', 0.) == 0.:
+                # Stream the decompressed data in chunks of rows
+                dtype = np.dtype(_FITS_FLOAT_DTYPES[header['BITPIX']])
+                with gzip.open(reference_grid_filename, "rb") as fits_file:
+                    fits_file.seek(data_offset)
+                    for start in range(0, shape[0], chunk_size):
+                        nrows = min(chunk_size, shape[0] - start)
+                        fluxes[start:start+nrows] = np.frombuffer(fits_file.read(nrows*shape[1]*dtype.itemsize), dtype=dtype).reshape((nrows, shape[1]))
+            else:
+                fluxes[:] = grid['PRIMARY'].data
+            fluxes.flush()
+            del fluxes
+        os.replace(tmp_memmap_filename, memmap_filename)
+    finally:
+        if os.path.exists(tmp_memmap_filename):
+            os.remove(tmp_memmap_filename)
+    _write_convolved_grid_metadata(metadata_filename, grid_waveobs, params)
+
+def _write_convolved_grid_metadata(filename, waveobs, params):
+    tmp_filename = filename + ".{}.tmp.npz".format(os.getpid())
+    np.savez(tmp_filename, waveobs=np.asarray(waveobs, dtype=float), params=np.asarray(params))
+    os.replace(tmp_filename, filename)
+
+def build_convolved_grid_index(precomputed_dir, resolution, linemasks, n_components=30, chunk_size=1024):
+    """
+    Build an index of the convolved grid for fast initial parameter estimation
+    with the pixels inside the linemasks: a PCA basis (the first 'n_components'
+    eigenvectors of the covariance of the grid) and the projection of every
+    reference spectrum on it. It is saved as 'convolved_grid_<R>.index.npz'
+    and used by 'estimate_initial_ap_candidates' when the linemasks select
+    the same pixels.
+    """
+    grid_waveobs, grid_fluxes, params = _load_convolved_grid(precomputed_dir, resolution)
+    fsegment = create_wavelength_filter(create_spectrum_structure(grid_waveobs), regions=linemasks)
+    isegment = np.where(fsegment)[0]
+    if len(isegment) == 0:
+        raise Exception("No pixels of the grid inside the linemasks")
+    n_components = min(n_components, len(grid_fluxes), len(isegment))
+
+    # Mean accumulated in chunks (the grid may not fit in memory)
+    mean = np.zeros(len(isegment))
+    for start in range(0, len(grid_fluxes), chunk_size):
+        mean += np.sum(np.asarray(grid_fluxes[start:start+chunk_size, isegment], dtype=float), axis=0)
+    mean /= len(grid_fluxes)
+    components, eigenvalues, total_variance = __principal_components(grid_fluxes, isegment, mean, n_components, chunk_size)
+    explained_variance = np.sum(eigenvalues) / total_variance if total_variance > 0 else 1.
+
+    coefficients = np.zeros((len(grid_fluxes), n_components))
+    for start in range(0, len(grid_fluxes), chunk_size):
+        chunk = np.asarray(grid_fluxes[start:start+chunk_size, isegment], dtype=float) - mean
+        coefficients[start:start+len(chunk)] = np.dot(chunk, components.T)
+
+    index_filename = precomputed_dir + "/convolved_grid_%i.index.npz" % resolution
+    tmp_index_filename = index_filename + ".tmp.npz"
+    np.savez(tmp_index_filename, pixels=isegment, mean=mean, components=components, coefficients=coefficients)
+    os.replace(tmp_index_filename, index_filename)
+    logging.info("Convolved grid index with {} components ({:.4f} of the variance): {}".format(n_components, explained_variance, index_filename))
+    return index_filename
+
+# Exact PCA if the number of reference points or pixels is not bigger
+# (square matrix of this size), otherwise a randomized SVD is used
+_MAX_EXACT_PCA_SIZE = 4096
+
+def __centered_chunks(grid_fluxes, isegment, mean, chunk_size):
+    for start in range(0, len(grid_fluxes), chunk_size):
+        yield start, np.asarray(grid_fluxes[start:start+chunk_size, isegment], dtype=float) - mean
+
+def __principal_components(grid_fluxes, isegment, mean, n_components, chunk_size, n_iter=4, oversampling=10):
+    """
+    First 'n_components' principal components (one per row) of the grid
+    pixels 'isegment', their eigenvalues and the total variance (both not
+    normalized by the number of reference points). The grid is read in
+    chunks and the memory needed does not grow with the square of the size
+    of the grid:
+
+    - If there are less reference points than pixels (or the opposite) and
+      they are not more than _MAX_EXACT_PCA_SIZE, the eigenvectors of the
+      smallest Gram matrix (points x points or pixels x pixels) are used.
+    - Otherwise, a randomized SVD (Halko et al. 2011) with 'n_iter' power
+      iterations is computed.
+    """
+    npoints, npixels = len(grid_fluxes), len(isegment)
+    total_variance = 0.
+    if min(npoints, npixels) <= _MAX_EXACT_PCA_SIZE:
+        if npoints < npixels:
+            # Gram matrix in the space of the reference points
+            gram = np.zeros((npoints, npoints))
+            for start, chunk in __centered_chunks(grid_fluxes, isegment, mean, chunk_size):
+                total_variance += np.sum(chunk**2)
+                for other_start, other_chunk in __centered_chunks(grid_fluxes[:start+len(chunk)], isegment, mean, chunk_size):
+                    block = np.dot(chunk, other_chunk.T)
+                    gram[start:start+len(chunk), other_start:other_start+len(other_chunk)] = block
+                    gram[other_start:other_start+len(other_chunk), start:start+len(chunk)] = block.T
+            eigenvalues, eigenvectors = np.linalg.eigh(gram)
+            order = np.argsort(eigenvalues)[::-1][:n_components]
+            # Principal components: X.T u / |X.T u|
+            components = np.zeros((len(order), npixels))
+            for start, chunk in __centered_chunks(grid_fluxes, isegment, mean, chunk_size):
+                components += np.dot(eigenvectors[start:start+len(chunk), order].T, chunk)
+            norms = np.sqrt(np.sum(components**2, axis=1))
+            components[norms > 0] /= norms[norms > 0][:, np.newaxis]
+        else:
+            covariance = np.zeros((npixels, npixels))
+            for start, chunk in __centered_chunks(grid_fluxes, isegment, mean, chunk_size):
+                total_variance += np.sum(chunk**2)
+                covariance += np.dot(chunk.T, chunk)
+            eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+            order = np.argsort(eigenvalues)[::-1][:n_components]
+            components = eigenvectors[:, order].T
+        return components, np.maximum(eigenvalues[order], 0.), total_variance
+
+    # Randomized SVD: range of X (points x pixels) found with a random projection
+    random_state = np.random.RandomState(42)
+    nrandom = min(n_components + oversampling, npixels)
+    projection = random_state.normal(size=(npixels, nrandom))
+    sample = np.zeros((npoints, nrandom))
+    for start, chunk in __centered_chunks(grid_fluxes, isegment, mean, chunk_size):
+        total_variance += np.sum(chunk**2)
+        sample[start:start+len(chunk)] = np.dot(chunk, projection)
+    for i in range(n_iter):
+        # Power iterations (orthonormalized) to improve the accuracy
+        sample = np.linalg.qr(sample)[0]
+        projection = np.zeros((npixels, nrandom))
+        for start, chunk in __centered_chunks(grid_fluxes, isegment, mean, chunk_size):
+            projection += np.dot(chunk.T, sample[start:start+len(chunk)])
+        projection = np.linalg.qr(projection)[0]
+        for start, chunk in __centered_chunks(grid_fluxes, isegment, mean, chunk_size):
+            sample[start:start+len(chunk)] = np.dot(chunk, projection)
+    basis = np.linalg.qr(sample)[0]
+    reduced = np.zeros((basis.shape[1], npixels))
+    for start, chunk in __centered_chunks(grid_fluxes, isegment, mean, chunk_size):
+        reduced += np.dot(basis[start:start+len(chunk)].T, chunk)
+    singular_values, components = np.linalg.svd(reduced, full_matrices=False)[1:]
+    return components[:n_components], singular_values[:n_components]**2, total_variance
+
+_convolved_grid_indices = {}
+
+def _load_convolved_grid_index(precomputed_dir, resolution, isegment):
+    """
+    Return the PCA basis and the KD-tree of the index of a convolved grid if
+    it exists, it is not older than the grid and it was built with the same
+    pixels. Otherwise, return None.
+    """
+    index_filename = precomputed_dir + "/convolved_grid_%i.index.npz" % resolution
+    reference_grid_filename = precomputed_dir + "/convolved_grid_%i.fits.gz" % resolution
+    if not os.path.exists(index_filename) or os.path.getmtime(index_filename) < os.path.getmtime(reference_grid_filename):
+        return None
+    key = (index_filename, os.path.getmtime(index_filename))
+    index = _convolved_grid_indices.get(key)
+    if index is None:
+        data = np.load(index_filename)
+        index = {'pixels': data['pixels'], 'mean': data['mean'], 'components': data['components'], 'kdtree': spatial.cKDTree(data['coefficients'])}
+        _convolved_grid_indices.clear() # Keep only the last one
+        _convolved_grid_indices[key] = index
+    if not np.array_equal(index['pixels'], isegment):
+        return None
+    return index
+
+def estimate_initial_ap_candidates(spectra, precomputed_dir, resolution, linemasks, top_k=10, chunk_size=1024, use_index=True, index_neighbours=None):
+    """
+    Compare one or several spectra with a pre-computed grid at a given
+    resolution and return, for each spectrum, the 'top_k' reference points
+    with the lowest chi-square (a recarray sorted by 'chi2' with the
+    parameters of the grid). The comparison is based on the linemasks and the
+    residuals are weighted by the errors of the spectrum (pixels without
+    errors get the median weight and, if no errors are available, all the
+    pixels have the same weight).
+
+    The grid is memory-mapped and processed in chunks of 'chunk_size'
+    reference points, so it does not need to fit in memory. Spectra that
+    share the same wavelengths are resampled and compared all at once.
+
+    If the grid has an index built with the same linemasks (see
+    'build_convolved_grid_index') and 'use_index' is True, the spectra are
+    projected on its PCA basis and the exact chi-square is only computed for
+    their 'index_neighbours' nearest reference points (by default, 10 times
+    'top_k').
+    """
+    if hasattr(spectra, 'dtype'):
+        spectra = [spectra]
+    grid_waveobs, grid_fluxes, params = _load_convolved_grid(precomputed_dir, resolution)
+
+    # Resample to the wavelengths of the grid
+    if all(np.array_equal(spectrum['waveobs'], spectra[0]['waveobs']) for spectrum in spectra[1:]):
+        fluxes, errors = resample_spectra(spectra[0]['waveobs'], [spectrum['flux'] for spectrum in spectra], grid_waveobs, err=[spectrum['err'] for spectrum in spectra], method="linear", zero_edges=True)
+    else:
+        resampled_spectra = [resample_spectrum(spectrum, grid_waveobs, method="linear") for spectrum in spectra]
+        fluxes = np.vstack([spectrum['flux'] for spectrum in resampled_spectra])
+        errors = np.vstack([spectrum['err'] for spectrum in resampled_spectra])
+
+    fsegment = create_wavelength_filter(create_spectrum_structure(grid_waveobs), regions=linemasks)
+    isegment = np.where(fsegment)[0]
+    fluxes = fluxes[:, isegment]
+    errors = errors[:, isegment]
+    # http://en.wikipedia.org/wiki/Goodness_of_fit#Example
+    weights = np.ones(fluxes.shape)
+    with_errors = errors > 0
+    weights[with_errors] = 1. / errors[with_errors]**2
+    # Pixels without errors have the median weight of the rest of the spectrum
+    for i in np.where(np.logical_and(np.any(with_errors, axis=1), ~np.all(with_errors, axis=1)))[0]:
+        weights[i, ~with_errors[i]] = np.median(weights[i, with_errors[i]])
+    weights[fluxes <= 0.0] = 0.
+
+    # chi2 = sum(w * (g - f)**2) = g**2 . w - 2 g . (w * f) + sum(w * f**2)
+    weighted_fluxes = weights * fluxes
+    constant = np.sum(weighted_fluxes * fluxes, axis=1)
+    top_k = min(top_k, len(grid_fluxes))
+
+    index = _load_convolved_grid_index(precomputed_dir, resolution, isegment) if use_index else None
+    if index is not None:
+        # Nearest neighbours in the PCA space (pixels without valid fluxes do not contribute)
+        if index_neighbours is None:
+            index_neighbours = 10 * top_k
+        index_neighbours = min(max(index_neighbours, top_k), len(grid_fluxes))
+        projected = np.dot(np.where(weights > 0, fluxes, index['mean']) - index['mean'], index['components'].T)
+        neighbours = index['kdtree'].query(projected, k=index_neighbours)[1]
+        rows = np.unique(neighbours)
+        chunks = [rows[start:start+chunk_size] for start in range(0, len(rows), chunk_size)]
+    else:
+        chunks = [np.arange(start, min(start+chunk_size, len(grid_fluxes))) for start in range(0, len(grid_fluxes), chunk_size)]
+
+    best_chisq = np.full((len(spectra), top_k), np.inf)
+    best_indices = np.zeros((len(spectra), top_k), dtype=int)
+    for rows in chunks:
+        if index is None:
+            chunk = np.asarray(grid_fluxes[rows[0]:rows[-1]+1, isegment], dtype=float)
+        else:
+            chunk = np.asarray(grid_fluxes[rows][:, isegment], dtype=float)
+        chisq = np.dot(chunk**2, weights.T) - 2. * np.dot(chunk, weighted_fluxes.T) + constant
+        chisq = np.maximum(chisq.T, 0.) # Rounding errors
+        # Keep the best candidates found so far
+        chisq = np.hstack((best_chisq, chisq))
+        indices = np.hstack((best_indices, np.tile(rows, (len(spectra), 1))))
+        selected = np.argpartition(chisq, top_k-1, axis=1)[:, :top_k]
+        best_chisq = np.take_along_axis(chisq, selected, axis=1)
+        best_indices = np.take_along_axis(indices, selected, axis=1)
+    order = np.argsort(best_chisq, axis=1, kind="stable")
+    best_chisq = np.take_along_axis(best_chisq, order, axis=1)
+    best_indices = np.take_along_axis(best_indices, order, axis=1)
+
+    dtype = [(name, params.dtype[name]) for name in params.dtype.names] + [('chi2', float)]
+    candidates = []
+    for chisq, indices in zip(best_chisq, best_indices):
+        candidate = np.recarray((top_k,), dtype=dtype)
+        for name in params.dtype.names:
+            candidate[name] = params[name][indices]
+        candidate['chi2'] = chisq
+        candidates.append(candidate)
+    return candidates
+
 def estimate_initial_ap(spectrum, precomputed_dir, resolution, linemasks, default_teff = 5000., default_logg = 2.5, default_MH = 0.0, default_alpha = 0.0, default_vmic = 1.0, default_vmac = 0.0, default_vsini = 0.0, default_limb_darkening_coeff = 0.00):
     """
     Estimate the initial atmospheric parameters by using a pre-computed grid
     at a given resolution. The comparison will be based on the linemasks.
+
+    See 'estimate_initial_ap_candidates' to obtain several candidates or to
+    process several spectra at once.
     """
 
     reference_grid_filename = precomputed_dir + "/convolved_grid_%i.fits.gz" % resolution
@@ -385,39 +983,60 @@ def estimate_initial_ap(spectrum, precomputed_dir, resolution, linemasks, defaul
         logging.warning("Pre-computed grid does not exists for R = %i" % resolution)
     else:
         try:
-            grid = fits.open(reference_grid_filename)
-            grid_waveobs = np.asarray(grid['WAVELENGTHS'].data, dtype=float)
-            resampled_spectrum = resample_spectrum(spectrum, grid_waveobs, method="linear")
-
-            fsegment = create_wavelength_filter(resampled_spectrum, regions=linemasks)
-            fsegment = np.logical_and(fsegment, resampled_spectrum['flux'] > 0.0)
-            isegment = np.where(fsegment == True)[0]
-
-            # http://en.wikipedia.org/wiki/Goodness_of_fit#Example
-            residuals = grid['PRIMARY'].data[:,isegment] - resampled_spectrum['flux'][isegment]
-            chisq = np.sum((residuals)**2, axis=1)
-            min_j = np.argmin(chisq)
-            initial_teff, initial_logg, initial_MH, initial_alpha, initial_vmic, initial_vmac, initial_vsini, initial_limb_darkening_coeff = grid['PARAMS'].data[min_j]
+            best = estimate_initial_ap_candidates(spectrum, precomputed_dir, resolution, linemasks, top_k=1)[0][0]
+            initial_teff, initial_logg, initial_MH, initial_alpha, initial_vmic, initial_vmac, initial_vsini, initial_limb_darkening_coeff = [best[name] for name in ('teff', 'logg', 'MH', 'alpha', 'vmic', 'vmac', 'vsini', 'limb_darkening_coeff')]
             estimation_found = True
-
         except Exception as e:
             print("Initial parameters could not be estimated")
-            print(type(e), e.message)
+            print(type(e), e)
             pass
-        finally:
-            grid.close()
 
     if estimation_found:
         return initial_teff, initial_logg, initial_MH, initial_alpha, initial_vmic, initial_vmac, initial_vsini, initial_limb_darkening_coeff
     else:
         return default_teff, default_logg, default_MH, default_alpha, default_vmic, default_vmac, default_vsini, default_limb_darkening_coeff
 
-def load_spectral_grid(input_path):
+def __triangulate(points):
+    if points.shape[1] > 4:
+        # Typically our case since we usually have 5 parameters: teff, logg, MH, alpha, vmic
+        default_qhull_options = "Qbb Qc Qz Qx Q12"
+    else:
+        default_qhull_options = "Qbb Qc Qz Q12"
+    try:
+        delaunay = spatial.Delaunay(points, qhull_options=default_qhull_options)
+    except QhullError:
+        logging.info("...failed")
+        logging.info("Retrying pre-computing joggling input to avoid precision problems (using QJ Qhull parameter)...")
+        alternative_qhull_options = "Qbb Qc Qz Q12 QJ"  # Use same parameters as for dimension < 4 + QJ
+        delaunay = spatial.Delaunay(points, qhull_options=alternative_qhull_options)
+    return delaunay
+
+def _read_grid_spectrum(f, regions=None):
+    # Module level function (instead of a nested one) to allow pickling the grid
+    return read_spectrum(f, apply_filters=False, sort=False, regions=regions)
+
+def load_spectral_grid(input_path, regular_grid=False, preload=False, wave_range=None):
     """
     :param input_path:
         Name of the input file (i.e. models.dump) or directory (new interpolator)
     :type input_path: string
 
+    :param regular_grid:
+        If the spectra are (mostly) placed in a rectilinear mesh of parameters,
+        use multilinear interpolation with the corners of the cell that
+        contains the target (Delaunay triangulations are only used for cells
+        with missing spectra).
+    :type regular_grid: bool
+
+    :param preload:
+        Load all the spectra in memory (float32 array shared between processes,
+        see SpectralGridStore) so that interpolations do not read any file.
+    :type preload: bool
+
+    :param wave_range:
+        If preloaded, only keep the wavelengths in this range (wave_base, wave_top)
+        or in these segments (i.e. the ones used in the analysis).
+
     :returns:
         List of modeled_layers, used_values_for_layers, proximity, teff_range, logg_range, MH_range and nlayers
     """
@@ -427,7 +1046,6 @@ def load_spectral_grid(input_path):
     base_dirname = input_path
     atm_dirname = os.path.join(base_dirname, "grid")
     params_filename = os.path.join(base_dirname, "parameters.tsv")
-    cache_filename = os.path.join(base_dirname, "cache.dump")
 
     if not os.path.exists(atm_dirname):
         raise Exception("Grid path '{}' does not exist".format(atm_dirname))
@@ -458,46 +1076,14 @@ def load_spectral_grid(input_path):
     existing_points = np.array(existing_points)
 
     # The delaunay triangulation and kdtree can be computationally expensive,
-    # do it once and save a pickle dump
-    # But first verify that the computed one (if exists) matches what is expected
-    use_dump = False
-    if os.path.exists(cache_filename):
-        use_dump = True
-        delaunay_triangulations, kdtree = pickle.load(open(cache_filename, 'rb'))
-        for delaunay_triangulation, parameters_subset in zip(delaunay_triangulations['precomputed'], parameters_subsets):
-            if delaunay_triangulation is None:
-                continue
-            if not (delaunay_triangulation.ndim == len(free_parameters) and delaunay_triangulation.npoints == len(existing_points[parameters_subset])):
-                use_dump = False
-                break
-
-    if not os.path.exists(cache_filename) or not use_dump:
-        delaunay_triangulations = {'subsets': parameters_subsets, 'precomputed': []}
-        for i, parameters_subset in enumerate(parameters_subsets):
-            logging.info("Pre-computing [{}/{}]...".format(i+1, len(parameters_subsets)))
-            if len(existing_points[parameters_subset]) > 0:
-                if existing_points[parameters_subset].shape[1] > 4:
-                    # Typically our case since we usually have 5 parameters: teff, logg, MH, alpha, vmic
-                    default_qhull_options = "Qbb Qc Qz Qx Q12"
-                else:
-                    default_qhull_options = "Qbb Qc Qz Q12"
-                try:
-                    delaunay = spatial.Delaunay(existing_points[parameters_subset], qhull_options=default_qhull_options)
-                except QhullError:
-                    logging.info("...failed")
-                    logging.info("Retrying pre-computing [{}/{}] joggling input to avoid precision problems (using QJ Qhull parameter)...".format(i+1, len(parameters_subsets)))
-                    alternative_qhull_options = "Qbb Qc Qz Q12 QJ"  # Use same parameters as for dimension < 4 + QJ
-                    delaunay = spatial.Delaunay(existing_points[parameters_subset], qhull_options=alternative_qhull_options)
-                delaunay_triangulations['precomputed'].append(delaunay)
-            else:
-                delaunay_triangulations['precomputed'].append(None)
-        kdtree = spatial.cKDTree(existing_points)
-        pickle.dump((delaunay_triangulations, kdtree), open(cache_filename, 'wb'), protocol=2)
+    # do it once and save it in a cache (identified by the content of parameters.tsv)
+    delaunay_triangulations, kdtree = _load_triangulations(base_dirname, params_filename, existing_points, parameters_subsets, triangulate=__triangulate, regular_grid=regular_grid)
 
     # Functions will receive the parameters in the same order
-    #read_point_value = lambda f, regions: read_spectrum(f, apply_filters=False, sort=False, regions=regions)
-    def read_point_value(f, regions=None):
-        return read_spectrum(f, apply_filters=False, sort=False, regions=regions)
+    read_point_value = _read_grid_spectrum
+
+    if preload:
+        read_point_value = SpectralGridStore(filenames, wave_range=wave_range)
 
     value_fields = ["waveobs", "flux"]
     return existing_points, free_parameters, filenames, read_point_value, value_fields, delaunay_triangulations, kdtree, ranges, base_dirname
@@ -510,6 +1096,9 @@ def valid_interpolated_spectrum_target(grid, target):
     target_point = []
     for param in free_parameters:
         target_point.append(target[param])
+    regular_grid = delaunay_triangulations.get('regular_grid')
+    if regular_grid is not None and regular_grid.cells(target_point)[2][0]:
+        return True
     target_point_cannot_be_interpolated = None
     for delaunay_triangulation in delaunay_triangulations['precomputed']:
         if delaunay_triangulation is None:
@@ -19,10 +19,12 @@ import os
 import sys
 import numpy as np
 import subprocess
+import time
 from multiprocessing import Process
-#from multiprocessing import Queue
-from multiprocessing import JoinableQueue
-from queue import Empty
+from multiprocessing import Pipe
+from multiprocessing import shared_memory
+from multiprocessing import resource_tracker
+from multiprocessing.connection import wait
 import logging
 
 from ispec.abundances import write_solar_abundances, write_fixed_abundances, enhance_solar_abundances
@@ -112,39 +114,23 @@ def generate_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, linelis
     # be reinitialized to work properly
     # * The best solution would be to improve the C code but since it is too complex
     #   this hack has been implemented
-    #process_communication_queue = Queue()
-    process_communication_queue = JoinableQueue()
-
-    p = Process(target=__spectrum_true_generate_spectrum, args=(process_communication_queue, waveobs, waveobs_mask, atmosphere_layers_file, linelist_file, isotope_file, abundances_file, fixed_abundances_file, microturbulence_vel), kwargs={'macroturbulence': macroturbulence, 'vsini': vsini, 'limb_darkening_coeff': limb_darkening_coeff, 'R': R, 'nlayers': nlayers, 'verbose': verbose})
-    p.start()
-    fluxes = np.zeros(len(waveobs))
-    num_seconds = 0
-    # Constantly check that the process has not died without returning any result and blocking the queue call
-    while p.is_alive() and num_seconds < timeout:
-        try:
-            data = process_communication_queue.get(timeout=1)
-            if type(data) == np.ndarray:
-                # Results received!
-                fluxes = data
-                break
-            elif gui_queue is not None:
-                # GUI update
-                # It allows communications between process in order to update the GUI progress bar
-                gui_queue.put(data)
-                gui_queue.join()
-            process_communication_queue.task_done()
-        except Empty:
-            # No results, continue waiting
-            pass
-        num_seconds += 1
-    if num_seconds >= timeout:
+    # * The process is forked in advance (see _run_in_synthesis_worker) and
+    #   the fluxes are written directly to shared memory
+    fluxes_buffer = shared_memory.SharedMemory(create=True, size=max(1, len(waveobs))*np.dtype(float).itemsize)
+    try:
+        args = (fluxes_buffer.name, waveobs, waveobs_mask, atmosphere_layers_file, linelist_file, isotope_file, abundances_file, fixed_abundances_file, microturbulence_vel)
+        kwargs = {'macroturbulence': macroturbulence, 'vsini': vsini, 'limb_darkening_coeff': limb_darkening_coeff, 'R': R, 'nlayers': nlayers, 'verbose': verbose}
+        status, result = _run_in_synthesis_worker(__spectrum_true_generate_spectrum, args, kwargs, gui_queue=gui_queue, timeout=timeout)
+        fluxes = np.zeros(len(waveobs))
+        if status == "done":
+            fluxes[:] = np.ndarray(len(waveobs), dtype=float, buffer=fluxes_buffer.buf)
+    finally:
+        fluxes_buffer.close()
+        fluxes_buffer.unlink()
+    if status == "timeout":
         logging.error("A timeout has occurred in the synthetic spectrum generation.")
-        p.terminate()
     elif np.all(fluxes == 0):
         logging.error("The synthetic spectrum generation has failed for these astrophysical parameters.")
-        p.terminate()
-    else:
-        p.join()
 
     if remove_tmp_atm_file:
         os.remove(atmosphere_layers_file)
@@ -160,7 +146,7 @@ def generate_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, linelis
     return fluxes
 
 
-def __spectrum_true_generate_spectrum(process_communication_queue, waveobs, waveobs_mask, atmosphere_model_file, linelist_file, isotope_file, abundances_file, fixed_abundances_file, microturbulence_vel, macroturbulence=0., vsini=0., limb_darkening_coeff=0., R=0, nlayers=56, verbose=0):
+def __spectrum_true_generate_spectrum(update_progress_func, fluxes_buffer_name, waveobs, waveobs_mask, atmosphere_model_file, linelist_file, isotope_file, abundances_file, fixed_abundances_file, microturbulence_vel, macroturbulence=0., vsini=0., limb_darkening_coeff=0., R=0, nlayers=56, verbose=0):
     """
     Generate synthetic spectrum and apply macroturbulence, rotation (visini), limb darkening coeff and resolution except
     if all those parameters are set to zero, in that case the fundamental synthetic spectrum is returned.
@@ -170,8 +156,6 @@ def __spectrum_true_generate_spectrum(process_communication_queue, waveobs, wave
 
     import ispec.synthesizer
 
-    #update_progress_func = lambda v: process_communication_queue.put(("self.update_progress(%i)" % v))
-    update_progress_func = lambda v: __enqueue_progress(process_communication_queue, v)
     ## The convolution (R), rotation broadening (vsini) and macroturbulence broadening (vmac),
     ## do not seem to work as expected in the SPECTRUM code, thus we set them to zero and
     ## we use a python implementation
@@ -191,9 +175,13 @@ def __spectrum_true_generate_spectrum(process_communication_queue, waveobs, wave
                 macroturbulence=macroturbulence, vsini=vsini, \
                 limb_darkening_coeff=limb_darkening_coeff, R=R, vrad=vrad)
 
-    process_communication_queue.put(fluxes)
+    fluxes_buffer = shared_memory.SharedMemory(name=fluxes_buffer_name)
+    shared_fluxes = np.ndarray(len(waveobs), dtype=float, buffer=fluxes_buffer.buf)
+    shared_fluxes[:] = fluxes
+    del shared_fluxes # Views should be released before closing
+    fluxes_buffer.close()
 
-def __calculate_ew_and_depth(process_communication_queue, atmosphere_model_file, linelist_file, isotope_file, abundances_file, num_lines, microturbulence_vel = 2.0, nlayers=56, start=3000, end=11000, verbose=0):
+def __calculate_ew_and_depth(update_progress_func, atmosphere_model_file, linelist_file, isotope_file, abundances_file, num_lines, microturbulence_vel = 2.0, nlayers=56, start=3000, end=11000, verbose=0):
     """
     start and end in Amstrom
     """
@@ -202,14 +190,103 @@ def __calculate_ew_and_depth(process_communication_queue, atmosphere_model_file,
 
     import ispec.synthesizer
 
-    #update_progress_func = lambda v: process_communication_queue.put(("self.update_progress(%i)" % v))
-    update_progress_func = lambda v: __enqueue_progress(process_communication_queue, v)
     output_wave, output_code, output_ew, output_depth = ispec.synthesizer.calculate_ew_and_depth(atmosphere_model_file.encode('utf-8'), linelist_file.encode('utf-8'), isotope_file.encode('utf-8'), abundances_file.encode('utf-8'), num_lines, microturbulence_vel, nlayers, start, end, verbose, update_progress_func)
-    process_communication_queue.put((output_wave, output_code, output_ew, output_depth))
+    return (output_wave, output_code, output_ew, output_depth)
 
-def __enqueue_progress(process_communication_queue, v):
-    process_communication_queue.put(("self.update_progress(%i)" % v))
-    process_communication_queue.join()
+
+# Process forked in advance that will run the next synthesis:
+# (pid of the process that owns it, process, connection)
+_spare_synthesis_worker = None
+
+def _start_synthesis_worker():
+    # Workers should share the resource tracker of the parent process,
+    # otherwise theirs would destroy the shared memory blocks when they exit
+    resource_tracker.ensure_running()
+    connection, worker_connection = Pipe()
+    p = Process(target=__synthesis_worker, args=(worker_connection,))
+    p.daemon = True
+    p.start()
+    worker_connection.close()
+    return (os.getpid(), p, connection)
+
+def _take_synthesis_worker():
+    global _spare_synthesis_worker
+    worker = _spare_synthesis_worker
+    _spare_synthesis_worker = None
+    # Processes forked from this one (i.e. parallel synthesis) inherit the
+    # spare worker but they cannot use it
+    if worker is not None and worker[0] == os.getpid() and worker[1].is_alive():
+        return worker
+    return _start_synthesis_worker()
+
+def _run_in_synthesis_worker(target, args, kwargs, gui_queue=None, timeout=1800):
+    """
+    Execute 'target(update_progress_func, *args, **kwargs)' in a separate
+    process so that the static variables of the SPECTRUM C code are always
+    freshly initialized. The process is forked (and the "synthesizer" module
+    imported) in advance while the previous synthesis is finished, thus
+    only one process is used for one synthesis but its start up cost is
+    not paid when calling this function.
+
+    The caller is woken up as soon as the process reports progress (which is
+    forwarded to 'gui_queue'), finishes or dies. It returns a status ("done",
+    "timeout" or "failed") and the value returned by the target.
+    """
+    global _spare_synthesis_worker
+    owner, p, connection = _take_synthesis_worker()
+    status = "failed"
+    result = None
+    try:
+        connection.send((target, args, kwargs))
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                status = "timeout"
+                break
+            ready = wait([connection, p.sentinel], timeout=remaining)
+            if connection in ready:
+                try:
+                    message, data = connection.recv()
+                except EOFError:
+                    # Died without returning any result
+                    break
+                if message == "done":
+                    # Results received!
+                    status = "done"
+                    result = data
+                    break
+                elif gui_queue is not None:
+                    # GUI update
+                    # It allows communications between process in order to update the GUI progress bar
+                    gui_queue.put(data)
+                    gui_queue.join()
+            elif p.sentinel in ready:
+                # Died without returning any result
+                break
+    finally:
+        connection.close()
+        if status == "done":
+            p.join()
+        else:
+            p.terminate()
+            p.join()
+        # Ready for the next synthesis
+        _spare_synthesis_worker = _start_synthesis_worker()
+    return status, result
+
+def __synthesis_worker(connection):
+    if is_spectrum_support_enabled():
+        # Import in advance while waiting for the task
+        import ispec.synthesizer
+    try:
+        target, args, kwargs = connection.recv()
+    except EOFError:
+        # The parent process does not need this worker anymore
+        return
+    update_progress_func = lambda v: connection.send(("progress", "self.update_progress(%i)" % v))
+    result = target(update_progress_func, *args, **kwargs)
+    connection.send(("done", result))
 
 
 def calculate_theoretical_ew_and_depth(atmosphere_layers, teff, logg, MH, alpha, linelist, isotopes, abundances, microturbulence_vel = 2.0, atmosphere_layers_file=None, abundances_file=None, linelist_file=None, isotope_file=None, verbose=0, gui_queue=None, timeout=1800, tmp_dir=None):
@@ -250,40 +327,18 @@ def calculate_theoretical_ew_and_depth(atmosphere_layers, teff, logg, MH, alpha,
     # be reinitialized to work properly
     # * The best solution would be to improve the C code but since it is too complex
     #   this hack has been implemented
-    #process_communication_queue = Queue()
-    process_communication_queue = JoinableQueue()
-
-
-    p = Process(target=__calculate_ew_and_depth, args=(process_communication_queue, atmosphere_layers_file, linelist_file, isotope_file, abundances_file, num_lines), kwargs={'microturbulence_vel': microturbulence_vel, 'nlayers': nlayers, 'start': start, 'end':end, 'verbose': verbose})
-    p.start()
-    output_wave = np.zeros(len(linelist))
-    output_code = np.zeros(len(linelist))
-    output_ew = np.zeros(len(linelist))
-    output_depth = np.zeros(len(linelist))
-    num_seconds = 0
-    # Constantly check that the process has not died without returning any result and blocking the queue call
-    while p.is_alive() and num_seconds < timeout:
-        try:
-            data = process_communication_queue.get(timeout=1)
-            if type(data) is tuple:
-                # Results received!
-                output_wave, output_code, output_ew, output_depth = data
-                break
-            elif gui_queue is not None:
-                # GUI update
-                # It allows communications between process in order to update the GUI progress bar
-                gui_queue.put(data)
-                gui_queue.join()
-            process_communication_queue.task_done()
-        except Empty:
-            # No results, continue waiting
-            pass
-        num_seconds += 1
-    if num_seconds >= timeout:
-        logging.error("A timeout has occurred in the synthetic spectrum generation.")
-        p.terminate()
+    args = (atmosphere_layers_file, linelist_file, isotope_file, abundances_file, num_lines)
+    kwargs = {'microturbulence_vel': microturbulence_vel, 'nlayers': nlayers, 'start': start, 'end':end, 'verbose': verbose}
+    status, result = _run_in_synthesis_worker(__calculate_ew_and_depth, args, kwargs, gui_queue=gui_queue, timeout=timeout)
+    if status == "done":
+        output_wave, output_code, output_ew, output_depth = result
     else:
-        p.join()
+        output_wave = np.zeros(len(linelist))
+        output_code = np.zeros(len(linelist))
+        output_ew = np.zeros(len(linelist))
+        output_depth = np.zeros(len(linelist))
+        if status == "timeout":
+            logging.error("A timeout has occurred in the synthetic spectrum generation.")
 
     if remove_tmp_atm_file:
         os.remove(atmosphere_layers_file)
@@ -0,0 +1,263 @@
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+import numpy as np
+from astropy.table import Table
+
+ispec_dir = os.path.dirname(os.path.realpath(__file__)) + "/../../"
+sys.path.insert(0, os.path.abspath(ispec_dir))
+import ispec
+
+value_fields = ["rhox", "temperature", "pgas", "xne", "abross", "accrad", "vturb", "logtau5", "depth", "pelectron"]
+value_fields += ["alpha_enhancement", "c_enhancement", "n_enhancement", "o_enhancement", "rapid_neutron_capture_enhancement", "slow_neutron_capture_enhancement"]
+value_fields += ["radius", "mass", "vmic"]
+
+def _create_model_atmospheres(base_dirname, teffs=(4000., 4500., 5000., 5500.), loggs=(1.0, 2.0, 3.0), MHs=(-1.0, 0.0), alphas=(0.0, 0.4), nlayers=56, missing=()):
+    """
+    Small grid of fake model atmospheres where every field is a linear function
+    of the parameters (thus linear interpolations are exact).
+    """
+    os.makedirs(os.path.join(base_dirname, "grid"))
+    random_state = np.random.RandomState(42)
+    coefficients = random_state.uniform(0.5, 1.5, (len(value_fields), 5))
+    layers = np.arange(nlayers) / nlayers
+    lines = ["teff\tlogg\tMH\talpha\tfilename"]
+    for teff in teffs:
+        for logg in loggs:
+            for MH in MHs:
+                for alpha in alphas:
+                    if (teff, logg, MH, alpha) in missing:
+                        continue
+                    filename = "grid/{:.0f}_{:.2f}_{:.2f}_{:.2f}.fits".format(teff, logg, MH, alpha)
+                    columns = [coefficients[i].dot([teff/1000., logg, MH, alpha, 1.]) * (1. + layers) for i in range(len(value_fields))]
+                    Table(columns, names=value_fields).write(os.path.join(base_dirname, filename), format="fits")
+                    lines.append("{}\t{}\t{}\t{}\t{}".format(teff, logg, MH, alpha, filename))
+    open(os.path.join(base_dirname, "parameters.tsv"), "w").write("\n".join(lines) + "\n")
+    return coefficients, layers
+
+
+def _create_spectral_grid(base_dirname, teffs=(4000., 4500., 5000.), loggs=(1.0, 2.0, 3.0), MHs=(-1.0, 0.0), alphas=(0.0, 0.4)):
+    """
+    Small grid of fake synthetic spectra.
+    """
+    os.makedirs(os.path.join(base_dirname, "grid"))
+    random_state = np.random.RandomState(42)
+    waveobs = np.arange(515., 520., 0.001)
+    lines = ["teff\tlogg\tMH\talpha\tfilename"]
+    for teff in teffs:
+        for logg in loggs:
+            for MH in MHs:
+                for alpha in alphas:
+                    filename = "grid/{:.0f}_{:.2f}_{:.2f}_{:.2f}.fits".format(teff, logg, MH, alpha)
+                    flux = 1. - random_state.uniform(0., 0.5) * np.exp(-(waveobs - 517.)**2 / (2*0.01**2))
+                    ispec.write_spectrum(ispec.create_spectrum_structure(waveobs, flux), os.path.join(base_dirname, filename))
+                    lines.append("{}\t{}\t{}\t{}\t{}".format(teff, logg, MH, alpha, filename))
+    open(os.path.join(base_dirname, "parameters.tsv"), "w").write("\n".join(lines) + "\n")
+    return waveobs
+
+def _reference_interpolate(delaunay_triangulations, existing_points, filenames, read_point_value, value_fields, target_point):
+    """
+    Previous implementation: one LinearNDInterpolator per field built with
+    the vertices of the simplex that contains the target point.
+    """
+    from scipy.interpolate import LinearNDInterpolator
+    for subset, delaunay_triangulation in zip(delaunay_triangulations['subsets'], delaunay_triangulations['precomputed']):
+        if delaunay_triangulation is None:
+            continue
+        simplex = delaunay_triangulation.find_simplex(target_point)
+        if not np.any(simplex == -1):
+            break
+    index = delaunay_triangulation.simplices[simplex]
+    points = existing_points[subset][index]
+    values = [read_point_value(filename) for filename in filenames[subset][index]]
+    interpolated = {}
+    for field in value_fields:
+        interpolator = LinearNDInterpolator(points, np.vstack([value[field] for value in values]))
+        interpolated[field] = interpolator((target_point))[0]
+    return interpolated
+
+
+class TestAtmospheres(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.model = os.path.join(self.tmp_dir, "ATLAS9.Test")
+        self.coefficients, self.layers = _create_model_atmospheres(self.model)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_interpolate_atmosphere_layers_from_memory(self):
+        targets = [{'teff': 4777., 'logg': 2.33, 'MH': -0.21, 'alpha': 0.1}, {'teff': 4000., 'logg': 1.0, 'MH': -1.0, 'alpha': 0.0}, {'teff': 5432., 'logg': 2.9, 'MH': -0.9, 'alpha': 0.37}]
+        modeled_layers_pack = ispec.load_modeled_layers_pack(self.model)
+        preloaded_modeled_layers_pack = ispec.load_modeled_layers_pack(self.model, preload=True)
+        cached_modeled_layers_pack = ispec.load_modeled_layers_pack(self.model, cache_size=10)
+        self.assertEqual(preloaded_modeled_layers_pack[3].data.shape, (48, 56, len(value_fields)))
+        for target in targets:
+            expected = ispec.interpolate_atmosphere_layers(modeled_layers_pack, target, code="spectrum")
+            for pack in (preloaded_modeled_layers_pack, cached_modeled_layers_pack, cached_modeled_layers_pack):
+                atmosphere_layers = ispec.interpolate_atmosphere_layers(pack, target, code="spectrum")
+                np.testing.assert_allclose(atmosphere_layers, expected, rtol=1e-12)
+            # Fields are linear functions of the parameters
+            np.testing.assert_allclose(expected[:, 1], self.coefficients[1].dot([target['teff']/1000., target['logg'], target['MH'], target['alpha'], 1.]) * (1. + self.layers), rtol=1e-12)
+        node_store = cached_modeled_layers_pack[3]
+        self.assertGreater(node_store.hits, 0)
+        self.assertLessEqual(len(node_store._cache), 10)
+
+    def test_interpolate_atmosphere_layers_equivalence(self):
+        from ispec.atmospheres import _interpolate
+        existing_points, free_parameters, filenames, read_point_value, value_fields, delaunay_triangulations, kdtree, ranges, base_dirname = ispec.load_modeled_layers_pack(self.model)
+        random_state = np.random.RandomState(0)
+        for i in range(20):
+            target_point = [random_state.uniform(4000., 5500.), random_state.uniform(1., 3.), random_state.uniform(-1., 0.), random_state.uniform(0., 0.4)]
+            interpolated = _interpolate(delaunay_triangulations, kdtree, existing_points, filenames, read_point_value, value_fields, target_point)
+            expected = _reference_interpolate(delaunay_triangulations, existing_points, filenames, read_point_value, value_fields, target_point)
+            for field in value_fields:
+                np.testing.assert_allclose(interpolated[field], expected[field], rtol=1e-10)
+
+    def test_generate_spectrum_from_grid_equivalence(self):
+        from ispec.synth.grid import load_spectral_grid, generate_spectrum
+        grid_dirname = os.path.join(self.tmp_dir, "SPECTRUM_grid")
+        waveobs = _create_spectral_grid(grid_dirname)
+        grid = load_spectral_grid(grid_dirname)
+        existing_points, free_parameters, filenames, read_point_value, value_fields, delaunay_triangulations, kdtree, ranges, base_dirname = grid
+        for teff, logg, MH, alpha in ((4321., 1.7, -0.3, 0.25), (4999., 2.9, -0.9, 0.05)):
+            flux = generate_spectrum(grid, waveobs, teff, logg, MH, alpha, 1.0)
+            expected = _reference_interpolate(delaunay_triangulations, existing_points, filenames, read_point_value, value_fields, [teff, logg, MH, alpha])
+            # Edges are not compared (the interpolated wavelengths may differ in the last digit and then the flux is resampled with zero edges)
+            np.testing.assert_allclose(flux[1:-1], expected['flux'][1:-1], rtol=1e-10)
+
+    def test_interpolate_atmosphere_layers_batch(self):
+        # Grid with a hole in a corner (targets near it are out of the convex hull)
+        model = os.path.join(self.tmp_dir, "MARCS.Test")
+        _create_model_atmospheres(model, missing=((5500., 3.0, 0.0, 0.4),))
+        modeled_layers_pack = ispec.load_modeled_layers_pack(model)
+        random_state = np.random.RandomState(0)
+        targets = [{'teff': random_state.uniform(4000., 5500.), 'logg': random_state.uniform(1., 3.), 'MH': random_state.uniform(-1., 0.), 'alpha': random_state.uniform(0., 0.4)} for i in range(30)]
+        targets.append({'teff': 5490., 'logg': 2.95, 'MH': -0.01, 'alpha': 0.39})
+        atmospheres_layers = ispec.interpolate_atmosphere_layers_batch(modeled_layers_pack, targets)
+        self.assertEqual(atmospheres_layers.shape, (len(targets), 56, 11))
+        for target, atmosphere_layers in zip(targets, atmospheres_layers):
+            np.testing.assert_allclose(atmosphere_layers, ispec.interpolate_atmosphere_layers(modeled_layers_pack, target), rtol=1e-12)
+        self.assertTrue(ispec.atmospheres.model_atmosphere_is_closest_copy(modeled_layers_pack, targets[-1]))
+        # Targets as an array (preloaded models)
+        target_points = np.array([[target['teff'], target['logg'], target['MH'], target['alpha']] for target in targets])
+        preloaded_modeled_layers_pack = ispec.load_modeled_layers_pack(model, preload=True)
+        np.testing.assert_allclose(ispec.interpolate_atmosphere_layers_batch(preloaded_modeled_layers_pack, target_points, chunk_size=7), atmospheres_layers, rtol=1e-12)
+        self.assertRaises(Exception, ispec.interpolate_atmosphere_layers_batch, modeled_layers_pack, [{'teff': 6000., 'logg': 2., 'MH': 0., 'alpha': 0.}])
+
+    def test_triangulation_cache(self):
+        from ispec.atmospheres import _TRIANGULATION_CACHE_DIRNAME
+        modeled_layers_pack = ispec.load_modeled_layers_pack(self.model)
+        self.assertTrue(os.path.exists(os.path.join(self.model, _TRIANGULATION_CACHE_DIRNAME, "index.json")))
+        cached_modeled_layers_pack = ispec.load_modeled_layers_pack(self.model)
+        delaunay_triangulation = modeled_layers_pack[5]['precomputed'][0]
+        cached_delaunay_triangulation = cached_modeled_layers_pack[5]['precomputed'][0]
+        self.assertIsInstance(cached_delaunay_triangulation.simplices, np.memmap)
+        np.testing.assert_equal(cached_delaunay_triangulation.simplices, delaunay_triangulation.simplices)
+        random_state = np.random.RandomState(0)
+        target_points = np.column_stack([random_state.uniform(3900., 5600., 100), random_state.uniform(0.9, 3.1, 100), random_state.uniform(-1.1, 0.1, 100), random_state.uniform(-0.1, 0.5, 100)])
+        np.testing.assert_equal(cached_delaunay_triangulation.find_simplex(target_points), delaunay_triangulation.find_simplex(target_points))
+        target = {'teff': 4777., 'logg': 2.33, 'MH': -0.21, 'alpha': 0.1}
+        np.testing.assert_equal(ispec.interpolate_atmosphere_layers(cached_modeled_layers_pack, target), ispec.interpolate_atmosphere_layers(modeled_layers_pack, target))
+        # A different parameters file invalidates the cache
+        import json
+        index_filename = os.path.join(self.model, _TRIANGULATION_CACHE_DIRNAME, "index.json")
+        previous_arrays = json.load(open(index_filename))['arrays']
+        expected_simplices = np.array(cached_delaunay_triangulation.simplices)
+        parameters = open(os.path.join(self.model, "parameters.tsv")).readlines()
+        open(os.path.join(self.model, "parameters.tsv"), "w").write("".join(parameters[:-1]))
+        modified_modeled_layers_pack = ispec.load_modeled_layers_pack(self.model)
+        self.assertEqual(modified_modeled_layers_pack[5]['precomputed'][0].npoints, len(parameters) - 2)
+        self.assertNotIsInstance(modified_modeled_layers_pack[5]['precomputed'][0].simplices, np.memmap)
+        # The new cache is saved in a different directory and the arrays
+        # memory mapped from the previous one are not overwritten
+        self.assertNotEqual(json.load(open(index_filename))['arrays'], previous_arrays)
+        self.assertFalse(os.path.exists(os.path.join(self.model, _TRIANGULATION_CACHE_DIRNAME, previous_arrays)))
+        np.testing.assert_equal(cached_delaunay_triangulation.simplices, expected_simplices)
+        self.assertEqual([filename for filename in os.listdir(os.path.join(self.model, _TRIANGULATION_CACHE_DIRNAME)) if filename.endswith(".tmp")], [])
+
+        # Caches from other scipy/numpy versions are recomputed
+        index = json.load(open(index_filename))
+        self.assertIn('scipy', index)
+        self.assertIn('numpy', index)
+        index['scipy'] = "0.0.0"
+        json.dump(index, open(index_filename, "w"))
+        self.assertNotIsInstance(ispec.load_modeled_layers_pack(self.model)[5]['precomputed'][0].simplices, np.memmap)
+        self.assertIsInstance(ispec.load_modeled_layers_pack(self.model)[5]['precomputed'][0].simplices, np.memmap)
+        # Caches that cannot be rebuilt are recomputed
+        arrays_dirname = os.path.join(self.model, _TRIANGULATION_CACHE_DIRNAME, json.load(open(index_filename))['arrays'])
+        np.save(os.path.join(arrays_dirname, "delaunay_0_transform.npy"), np.zeros((len(modified_modeled_layers_pack[5]["precomputed"][0].simplices), 5, 4)))
+        recomputed_modeled_layers_pack = ispec.load_modeled_layers_pack(self.model)
+        self.assertNotIsInstance(recomputed_modeled_layers_pack[5]['precomputed'][0].simplices, np.memmap)
+        np.testing.assert_equal(ispec.interpolate_atmosphere_layers(recomputed_modeled_layers_pack, target), ispec.interpolate_atmosphere_layers(modified_modeled_layers_pack, target))
+        arrays_dirname = os.path.join(self.model, _TRIANGULATION_CACHE_DIRNAME, json.load(open(index_filename))['arrays'])
+        os.remove(os.path.join(arrays_dirname, "delaunay_0simplices.npy"))
+        self.assertNotIsInstance(ispec.load_modeled_layers_pack(self.model)[5]['precomputed'][0].simplices, np.memmap)
+
+    def test_regular_grid_interpolation(self):
+        from ispec.atmospheres import _TRIANGULATION_CACHE_DIRNAME
+        # Complete grid: no triangulation is needed
+        modeled_layers_pack = ispec.load_modeled_layers_pack(self.model, regular_grid=True)
+        delaunay_triangulations = modeled_layers_pack[5]
+        self.assertTrue(delaunay_triangulations['regular_grid'].is_complete())
+        self.assertEqual(delaunay_triangulations['precomputed'], [None])
+        self.assertFalse(os.path.exists(os.path.join(self.model, _TRIANGULATION_CACHE_DIRNAME)))
+        random_state = np.random.RandomState(0)
+        targets = [{'teff': random_state.uniform(4000., 5500.), 'logg': random_state.uniform(1., 3.), 'MH': random_state.uniform(-1., 0.), 'alpha': random_state.uniform(0., 0.4)} for i in range(10)]
+        for target in targets:
+            atmosphere_layers = ispec.interpolate_atmosphere_layers(modeled_layers_pack, target)
+            # Fields are linear functions of the parameters
+            np.testing.assert_allclose(atmosphere_layers[:, 1], self.coefficients[1].dot([target['teff']/1000., target['logg'], target['MH'], target['alpha'], 1.]) * (1. + self.layers), rtol=1e-12)
+            self.assertFalse(ispec.atmospheres.model_atmosphere_is_closest_copy(modeled_layers_pack, target))
+        np.testing.assert_allclose(ispec.interpolate_atmosphere_layers_batch(modeled_layers_pack, targets), [ispec.interpolate_atmosphere_layers(modeled_layers_pack, target) for target in targets], rtol=1e-12)
+
+        # Grid with a hole: cells with the missing corner use the Delaunay triangulation
+        model = os.path.join(self.tmp_dir, "ATLAS9.Hole")
+        _create_model_atmospheres(model, missing=((4500., 2.0, 0.0, 0.4),))
+        modeled_layers_pack = ispec.load_modeled_layers_pack(model, regular_grid=True)
+        reference_modeled_layers_pack = ispec.load_modeled_layers_pack(model)
+        regular_grid = modeled_layers_pack[5]['regular_grid']
+        self.assertIsNotNone(modeled_layers_pack[5]['precomputed'][0])
+        targets = [{'teff': 4300., 'logg': 1.8, 'MH': -0.1, 'alpha': 0.3}, {'teff': 4500., 'logg': 2.0, 'MH': -1.0, 'alpha': 0.4}, {'teff': 5200., 'logg': 1.5, 'MH': -0.5, 'alpha': 0.2}]
+        found = regular_grid.cells([[target['teff'], target['logg'], target['MH'], target['alpha']] for target in targets])[2]
+        # Missing corner, missing corner with zero weight (on a face), complete cell
+        np.testing.assert_equal(found, [False, True, True])
+        for target in targets:
+            np.testing.assert_allclose(ispec.interpolate_atmosphere_layers(modeled_layers_pack, target), ispec.interpolate_atmosphere_layers(reference_modeled_layers_pack, target), rtol=1e-12)
+        np.testing.assert_allclose(ispec.interpolate_atmosphere_layers_batch(modeled_layers_pack, targets), [ispec.interpolate_atmosphere_layers(modeled_layers_pack, target) for target in targets], rtol=1e-12)
+
+    def test_preloaded_spectral_grid(self):
+        import pickle
+        from ispec.synth.grid import load_spectral_grid, generate_spectrum
+        grid_dirname = os.path.join(self.tmp_dir, "SPECTRUM_grid")
+        waveobs = _create_spectral_grid(grid_dirname)
+        grid = load_spectral_grid(grid_dirname)
+        preloaded_grid = load_spectral_grid(grid_dirname, preload=True)
+        store = preloaded_grid[3]
+        self.assertEqual(store.fluxes.shape, (len(grid[2]), len(waveobs)))
+        self.assertEqual(store.fluxes.dtype, np.float32)
+        for teff, logg, MH, alpha in ((4321., 1.7, -0.3, 0.25), (4999., 2.9, -0.9, 0.05), (4500., 2.0, 0.0, 0.4)):
+            expected = generate_spectrum(grid, waveobs, teff, logg, MH, alpha, 1.0)
+            flux = generate_spectrum(preloaded_grid, waveobs, teff, logg, MH, alpha, 1.0)
+            np.testing.assert_allclose(flux[1:-1], expected[1:-1], rtol=1e-6)
+
+        # Only the pixels in the requested range are kept
+        restricted_grid = load_spectral_grid(grid_dirname, preload=True, wave_range=(516.5, 517.5))
+        restricted_store = restricted_grid[3]
+        self.assertTrue(np.all((restricted_store.waveobs >= 516.5) & (restricted_store.waveobs <= 517.5)))
+        self.assertLess(restricted_store.fluxes.shape[1], store.fluxes.shape[1])
+        restricted_waveobs = waveobs[(waveobs > 516.6) & (waveobs < 517.4)]
+        flux = generate_spectrum(restricted_grid, restricted_waveobs, 4321., 1.7, -0.3, 0.25, 1.0)
+        expected = generate_spectrum(grid, restricted_waveobs, 4321., 1.7, -0.3, 0.25, 1.0)
+        np.testing.assert_allclose(flux[1:-1], expected[1:-1], rtol=1e-6)
+
+        # Other processes attach to the same shared memory (no copy)
+        unpickled_store = pickle.loads(pickle.dumps(store))
+        self.assertEqual(unpickled_store._shared_memory.name, store._shared_memory.name)
+        np.testing.assert_array_equal(unpickled_store.fluxes, store.fluxes)
+        unpickled_store.close()
+        restricted_store.close()
+        store.close()
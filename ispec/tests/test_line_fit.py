@@ -264,3 +264,123 @@ class TestLineFit(unittest.TestCase):
         self.assertEqual(linemasks['element'][-3], 'Si 1')
         self.assertAlmostEqual(linemasks['loggf'][0], -1.028)
         self.assertAlmostEqual(linemasks['loggf'][-3], -1.062)
+
+    def test_parallel_jacobian(self):
+        import pickle
+        import multiprocessing
+        x = np.linspace(500., 501., 200)
+        y = 1. - 0.3*np.exp(-(x-500.47)**2/(2*0.04**2))
+        y += np.random.RandomState(42).normal(0., 0.005, len(x))
+        parinfo = [{'value':1., 'fixed':False, 'limited':[False, False], 'limits':[0., 0.]},
+                   {'value':-0.2, 'fixed':False, 'limited':[False, True], 'limits':[0., 0.]},
+                   {'value':0.05, 'fixed':False, 'limited':[True, False], 'limits':[0., 0.]},
+                   {'value':500.5, 'fixed':False, 'limited':[False, False], 'limits':[0., 0.], 'mpside':2}]
+
+        serial_model = ispec.modeling.mpfitmodels.GaussianModel()
+        serial_model.fitData(x, y, parinfo=[dict(p) for p in parinfo])
+
+        parallel_model = ispec.modeling.mpfitmodels.GaussianModel()
+        pool = multiprocessing.Pool(2)
+        try:
+            parallel_model.fitData(x, y, parinfo=[dict(p) for p in parinfo], jacobian_executor=pool)
+        finally:
+            pool.close()
+            pool.join()
+
+        # Same results as the serial minimization
+        self.assertTrue(np.array_equal(serial_model.m.params, parallel_model.m.params))
+        self.assertTrue(np.array_equal(serial_model.m.perror, parallel_model.m.perror))
+        self.assertEqual(serial_model.m.niter, parallel_model.m.niter)
+        self.assertEqual(serial_model.m.nfev, parallel_model.m.nfev)
+        self.assertAlmostEqual(parallel_model.mu(), 500.47, places=2)
+
+        # Fitted models can be sent to other processes
+        unpickled_model = pickle.loads(pickle.dumps(parallel_model))
+        self.assertIsNone(unpickled_model.m)
+        self.assertEqual(unpickled_model.mu(), parallel_model.mu())
+
+    def test_explicit_derivatives(self):
+        class GaussianModelWithDerivatives(ispec.modeling.mpfitmodels.GaussianModel):
+            def _model_derivatives(self, x, requested):
+                derivatives = np.zeros((len(x), len(requested)))
+                gaussian = np.exp(-(x-self.mu())**2/(2*self.sig()**2))
+                derivatives[:, 1] = gaussian
+                derivatives[:, 3] = self.A() * gaussian * (x-self.mu())/self.sig()**2
+                return derivatives
+
+        x = np.linspace(500., 501., 200)
+        y = 1. - 0.3*np.exp(-(x-500.47)**2/(2*0.04**2))
+        y += np.random.RandomState(42).normal(0., 0.005, len(x))
+        parinfo = [{'value':1., 'fixed':False, 'limited':[False, False], 'limits':[0., 0.]},
+                   {'value':-0.2, 'fixed':False, 'limited':[False, True], 'limits':[0., 0.]},
+                   {'value':0.05, 'fixed':False, 'limited':[True, False], 'limits':[0., 0.]},
+                   {'value':500.5, 'fixed':False, 'limited':[False, False], 'limits':[0., 0.]}]
+        numerical_model = ispec.modeling.mpfitmodels.GaussianModel()
+        numerical_model.fitData(x, y, parinfo=[dict(p) for p in parinfo])
+
+        parinfo[1]['mpside'] = 3
+        parinfo[3]['mpside'] = 3
+        explicit_model = GaussianModelWithDerivatives()
+        explicit_model.fitData(x, y, parinfo=[dict(p) for p in parinfo])
+        np.testing.assert_allclose(explicit_model.m.params, numerical_model.m.params, rtol=1e-6)
+        np.testing.assert_allclose(explicit_model.m.perror, numerical_model.m.perror, rtol=1e-4)
+        # One evaluation for both parameters instead of one for each
+        self.assertLess(explicit_model.m.nfev, numerical_model.m.nfev)
+
+    def test_parallel_jacobian_with_child_processes(self):
+        import pickle
+        import multiprocessing
+        class TaskSizeExecutor(object):
+            # Records the size of the tasks sent to the pool
+            def __init__(self, pool):
+                self.pool = pool
+                self.task_sizes = []
+            def map(self, function, iterable, chunksize=1):
+                tasks = list(iterable)
+                self.task_sizes += [len(pickle.dumps(task)) for task in tasks]
+                return self.pool.map(function, tasks, chunksize=chunksize)
+
+        x = np.linspace(500., 501., 200)
+        y = 1. - 0.3*np.exp(-(x-500.47)**2/(2*0.04**2))
+        y += np.random.RandomState(42).normal(0., 0.005, len(x))
+        parinfo = [{'value':1., 'fixed':False, 'limited':[False, False], 'limits':[0., 0.]},
+                   {'value':-0.2, 'fixed':False, 'limited':[False, True], 'limits':[0., 0.]},
+                   {'value':0.05, 'fixed':False, 'limited':[True, False], 'limits':[0., 0.]},
+                   {'value':500.5, 'fixed':False, 'limited':[False, False], 'limits':[0., 0.]}]
+
+        serial_model = ispec.modeling.mpfitmodels.GaussianModel()
+        serial_model.fitData(x, y, parinfo=[dict(p) for p in parinfo])
+
+        parallel_model = ChildProcessGaussianModel()
+        # Big data that should not be sent with every task
+        parallel_model.data = np.zeros(100000)
+        pool = multiprocessing.Pool(2)
+        executor = TaskSizeExecutor(pool)
+        try:
+            parallel_model.fitData(x, y, parinfo=[dict(p) for p in parinfo], jacobian_executor=executor)
+        finally:
+            pool.close()
+            pool.join()
+
+        # Pool workers are daemonic but the model runs in a child process
+        self.assertTrue(np.array_equal(serial_model.m.params, parallel_model.m.params))
+        self.assertEqual(serial_model.m.nfev, parallel_model.m.nfev)
+        self.assertTrue(0 < max(executor.task_sizes) < 10000)
+        # Temporary files are removed after the fit
+        self.assertIsNone(parallel_model.m._jacobian_snapshots)
+
+
+class ChildProcessGaussianModel(ispec.modeling.mpfitmodels.GaussianModel):
+    # Evaluated in a child process like the SPECTRUM syntheses
+    def _model_function(self, x, p=None):
+        from ispec.synth.spectrum import _run_in_synthesis_worker
+        if p is not None:
+            for i in range(len(p)):
+                self._parinfo[i]['value'] = p[i]
+        status, result = _run_in_synthesis_worker(_gaussian_in_child_process, (self.baseline(), self.A(), self.sig(), self.mu(), x), {}, timeout=60)
+        if status != "done":
+            raise Exception("Evaluation failed in the child process")
+        return result
+
+def _gaussian_in_child_process(update_progress_func, baseline, A, sig, mu, x):
+    return baseline + A*np.exp(-(x-mu)**2/(2*sig**2))
@@ -1,5 +1,7 @@
 import os
 import sys
+import shutil
+import tempfile
 import unittest
 import numpy as np
 
@@ -8,6 +10,40 @@ sys.path.insert(0, os.path.abspath(ispec_dir))
 import ispec
 
 
+def _reference_convolve_spectrum(waveobs, flux, err, to_resolution, from_resolution=None):
+    """
+    Straightforward transcription of the original per-point convolution kernel
+    (including its window limits), used as reference for the optimized one.
+    """
+    total_points = len(waveobs)
+    convolved_flux = np.zeros(total_points)
+    convolved_err = np.zeros(total_points)
+    last_x = 0
+    wave_filter_top = total_points
+    for i in range(total_points):
+        if flux[i] <= 1e-10:
+            continue
+        if from_resolution is None:
+            fwhm = waveobs[i] / to_resolution
+        else:
+            fwhm = np.sqrt((waveobs[i] / to_resolution)**2 - (waveobs[i] / from_resolution)**2)
+        sigma = fwhm / 2.3548200450309493
+        lambda_peak = waveobs[i]
+        wave_filter_base = last_x + np.searchsorted(waveobs[last_x:], lambda_peak - 2*fwhm)
+        last_x = wave_filter_base
+        top = last_x + np.searchsorted(waveobs[last_x:], lambda_peak + 2*fwhm)
+        if top < total_points:
+            wave_filter_top = top
+        gaussian = np.exp(- ((waveobs[wave_filter_base:wave_filter_top] - lambda_peak)**2) / (2*sigma**2))
+        positive = flux[wave_filter_base:wave_filter_top] > 0.0
+        total_gaussian = np.sum(gaussian[positive])
+        if total_gaussian > 0:
+            convolved_flux[i] = np.sum(flux[wave_filter_base:wave_filter_top][positive] * gaussian[positive]) / total_gaussian
+            if err[i] > 0:
+                convolved_err[i] = np.sum(err[wave_filter_base:wave_filter_top][positive] * gaussian[positive]) / total_gaussian
+    return convolved_flux, convolved_err
+
+
 class TestSpectrum(unittest.TestCase):
 
     def test_convert_air_to_vacuum(self):
@@ -76,6 +112,39 @@ class TestSpectrum(unittest.TestCase):
         self.assertAlmostEqual(resampled_star_spectrum['err'][0], 0.002313683448275862)
         self.assertAlmostEqual(resampled_star_spectrum['err'][-1], 0.0)
 
+    def test_resample_spectra(self):
+        from ispec.spectrum import _interpolation
+        waveobs = np.array([1., 2., 3., 4., 5., 6.])
+        flux = np.array([1., 2., 3., 0., 5., 6.])
+        err = np.ones(len(waveobs)) * 0.1
+        xaxis = np.array([0.5, 1.5, 2.5, 3.5, 5.5, 6.5])
+        spectrum = ispec.create_spectrum_structure(waveobs, flux, err)
+        resampled_spectrum = ispec.resample_spectrum(spectrum, xaxis, method="linear", zero_edges=False)
+        # Gaps (zero fluxes) are not interpolated and edges are duplicated
+        np.testing.assert_almost_equal(resampled_spectrum['flux'], [1., 1.5, 2.5, 0., 5.5, 6.])
+        np.testing.assert_almost_equal(resampled_spectrum['err'], [0.1, 0.1, 0.1, 0., 0.1, 0.1])
+        resampled_spectrum = ispec.resample_spectrum(spectrum, xaxis, method="linear", zero_edges=True)
+        np.testing.assert_almost_equal(resampled_spectrum['flux'], [0., 1.5, 2.5, 0., 5.5, 0.])
+
+        random_state = np.random.RandomState(42)
+        waveobs = np.arange(480., 490., 0.01)
+        fluxes = random_state.uniform(-0.1, 1.2, (5, len(waveobs)))
+        errors = random_state.uniform(-0.01, 0.02, (5, len(waveobs)))
+        xaxis = np.arange(479.995, 490.005, 0.0037)
+        for method in ("linear", "bessel"):
+            for zero_edges in (True, False):
+                resampled_fluxes, resampled_err = ispec.resample_spectra(waveobs, fluxes, xaxis, err=errors, method=method, zero_edges=zero_edges)
+                self.assertEqual(resampled_fluxes.shape, (5, len(xaxis)))
+                for i in range(len(fluxes)):
+                    spectrum = ispec.create_spectrum_structure(waveobs, fluxes[i], errors[i])
+                    resampled_spectrum = ispec.resample_spectrum(spectrum, xaxis, method=method, zero_edges=zero_edges)
+                    np.testing.assert_equal(resampled_fluxes[i], resampled_spectrum['flux'])
+                    np.testing.assert_equal(resampled_err[i], resampled_spectrum['err'])
+                    # Vectorized version used when the optimized one is not available
+                    waveobs_, flux_, err_ = _interpolation(waveobs, fluxes[i], errors[i], xaxis, bessel=method == "bessel", zero_edges=zero_edges)
+                    np.testing.assert_equal(flux_, resampled_spectrum['flux'])
+                    np.testing.assert_equal(err_, resampled_spectrum['err'])
+
     def test_filter_cosmic_rays(self):
         star_spectrum = ispec.read_spectrum(ispec_dir + "/input/spectra/examples/NARVAL_Sun_Vesta-1.txt.gz")
         #--- Continuum fit -------------------------------------------------------------
@@ -143,3 +212,172 @@ class TestSpectrum(unittest.TestCase):
         estimated_snr = ispec.estimate_snr(star_spectrum['flux'], num_points=num_points)
         self.assertAlmostEqual(estimated_snr, 139.92497450174938)
 
+
+    def test_read_plain_text_dialects(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            waveobs = np.linspace(480., 680., 1001)
+            flux = np.linspace(0.5, 1.5, 1001)
+            err = flux / 100.
+            spectrum = ispec.create_spectrum_structure(waveobs, flux, err)
+            #--- iSpec format (tab separated with header), plain and compressed ----------
+            ispec.write_spectrum(spectrum, os.path.join(tmp_dir, "spectrum.txt"))
+            ispec.write_spectrum(spectrum, os.path.join(tmp_dir, "spectrum.txt.gz"))
+            #--- NARVAL format (two header lines, lines separated by \\r) ----------------
+            body = "\r".join(["%.9f %.9f %.9f" % (w, f, e) for w, f, e in zip(waveobs, flux, err)])
+            with open(os.path.join(tmp_dir, "narval.s"), "w", newline='') as narval:
+                narval.write("***Reduced spectrum\r 1001 2\r" + body + "\r")
+            #--- ESPaDOnS format (two header lines, space separated) ---------------------
+            with open(os.path.join(tmp_dir, "espadons.s"), "w") as espadons:
+                espadons.write("***Reduced spectrum\n 1001 2\n" + body.replace("\r", "\n") + "\n")
+            for filename in ("spectrum.txt", "spectrum.txt.gz", "narval.s", "espadons.s"):
+                read_spectrum = ispec.read_spectrum(os.path.join(tmp_dir, filename))
+                self.assertEqual(len(read_spectrum), len(spectrum))
+                np.testing.assert_almost_equal(read_spectrum['waveobs'], waveobs)
+                np.testing.assert_almost_equal(read_spectrum['flux'], flux)
+                np.testing.assert_almost_equal(read_spectrum['err'], err)
+            #--- Incompatible format ----------------------------------------------------
+            with open(os.path.join(tmp_dir, "broken.txt"), "w") as broken:
+                broken.write("waveobs\tflux\terr\n480.0\t1.0\n481.0\tone\t0.01\n")
+            self.assertRaises(Exception, ispec.read_spectrum, os.path.join(tmp_dir, "broken.txt"))
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_read_write_binary_spectrum(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            waveobs = np.linspace(480., 680., 20001)
+            flux = np.linspace(0.5, 1.5, 20001)
+            err = flux / 100.
+            spectrum = ispec.create_spectrum_structure(waveobs, flux, err)
+            regions = np.recarray((3,), dtype=[('wave_base', float), ('wave_top', float)])
+            regions['wave_base'] = [500., 400., 505.]
+            regions['wave_top'] = [510., 401., 506.]
+            wfilter = ispec.create_wavelength_filter(spectrum, regions=regions)
+            #--- Double precision ---------------------------------------------------------
+            binary_filename = os.path.join(tmp_dir, "spectrum.ispec")
+            ispec.write_spectrum(spectrum, binary_filename)
+            read_spectrum = ispec.read_spectrum(binary_filename)
+            np.testing.assert_equal(read_spectrum['waveobs'], waveobs)
+            np.testing.assert_equal(read_spectrum['flux'], flux)
+            np.testing.assert_equal(read_spectrum['err'], err)
+            read_spectrum = ispec.read_spectrum(binary_filename, apply_filters=False, sort=False, regions=regions)
+            np.testing.assert_equal(read_spectrum['waveobs'], waveobs[wfilter])
+            np.testing.assert_equal(read_spectrum['flux'], flux[wfilter])
+            #--- Single precision fluxes --------------------------------------------------
+            ispec.write_spectrum(spectrum, binary_filename, flux_dtype=np.float32)
+            self.assertEqual(os.path.getsize(binary_filename), 64 + len(spectrum)*(8+4+4))
+            read_spectrum = ispec.read_spectrum(binary_filename, regions=regions)
+            np.testing.assert_equal(read_spectrum['waveobs'], waveobs[wfilter])
+            np.testing.assert_allclose(read_spectrum['flux'], flux[wfilter], rtol=1e-7)
+            np.testing.assert_allclose(read_spectrum['err'], err[wfilter], rtol=1e-7)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_write_plain_text_precision(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            waveobs = np.linspace(480., 680., 1001)
+            flux = np.linspace(0.5, 1.5, 1001)
+            err = flux / 100.
+            spectrum = ispec.create_spectrum_structure(waveobs, flux, err)
+            #--- Full precision (default) -------------------------------------------------
+            filename = os.path.join(tmp_dir, "spectrum.txt.gz")
+            ispec.write_spectrum(spectrum, filename, compresslevel=1)
+            read_spectrum = ispec.read_spectrum(filename)
+            np.testing.assert_equal(read_spectrum['waveobs'], waveobs)
+            np.testing.assert_equal(read_spectrum['flux'], flux)
+            np.testing.assert_equal(read_spectrum['err'], err)
+            #--- Limited number of significant digits -------------------------------------
+            filename = os.path.join(tmp_dir, "spectrum.txt")
+            ispec.write_spectrum(spectrum, filename, precision=5)
+            with open(filename) as spectrum_file:
+                self.assertEqual(spectrum_file.readline(), "waveobs\tflux\terr\n")
+                self.assertEqual(spectrum_file.readline(), "480\t0.5\t0.005\n")
+                self.assertEqual(spectrum_file.readline(), "480.2\t0.501\t0.00501\n")
+            read_spectrum = ispec.read_spectrum(filename)
+            np.testing.assert_allclose(read_spectrum['flux'], flux, rtol=1e-5)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_read_fits_spectrum_regions(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            waveobs = 480. + np.arange(40001) * 0.005
+            flux = np.linspace(0.5, 1.5, len(waveobs))
+            err = flux / 100.
+            spectrum = ispec.create_spectrum_structure(waveobs, flux, err)
+            regions = np.recarray((3,), dtype=[('wave_base', float), ('wave_top', float)])
+            regions['wave_base'] = [500., 400., 505.]
+            regions['wave_top'] = [510., 481., 506.0025]
+            for filename in ("spectrum.fits", "spectrum.fits.gz"):
+                filename = os.path.join(tmp_dir, filename)
+                ispec.write_spectrum(spectrum, filename)
+                full_spectrum = ispec.read_spectrum(filename, apply_filters=False, sort=False)
+                full_spectrum = full_spectrum[ispec.create_wavelength_filter(full_spectrum, regions=regions)]
+                read_spectrum = ispec.read_spectrum(filename, apply_filters=False, sort=False, regions=regions)
+                self.assertEqual(len(read_spectrum), len(full_spectrum))
+                np.testing.assert_equal(read_spectrum['waveobs'], full_spectrum['waveobs'])
+                np.testing.assert_equal(read_spectrum['flux'], full_spectrum['flux'])
+                np.testing.assert_equal(read_spectrum['err'], full_spectrum['err'])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_read_spectra(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            waveobs = np.linspace(480., 680., 1001)
+            spectrum = ispec.create_spectrum_structure(waveobs, np.linspace(0.5, 1.5, 1001))
+            filenames = [os.path.join(tmp_dir, filename) for filename in ("spectrum.txt.gz", "spectrum.fits", "missing.txt")]
+            ispec.write_spectrum(spectrum, filenames[0])
+            ispec.write_spectrum(spectrum, filenames[1])
+            results = {}
+            for spectrum_filename, read_spectrum, elapsed, error in ispec.read_spectra(filenames, workers=2):
+                results[spectrum_filename] = (read_spectrum, error)
+                self.assertTrue(elapsed >= 0)
+            self.assertEqual(sorted(results.keys()), sorted(filenames))
+            for spectrum_filename in filenames[:2]:
+                read_spectrum, error = results[spectrum_filename]
+                self.assertIsNone(error)
+                np.testing.assert_almost_equal(read_spectrum['flux'], spectrum['flux'])
+            read_spectrum, error = results[filenames[2]]
+            self.assertIsNone(read_spectrum)
+            self.assertIsNotNone(error)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_convolve_spectrum_kernel(self):
+        random_state = np.random.RandomState(42)
+        waveobs = np.sort(480. + random_state.uniform(0., 10., 5000))
+        flux = random_state.uniform(0.2, 1.2, len(waveobs))
+        # Gaps
+        flux[random_state.randint(0, len(waveobs), 50)] = 0.
+        flux[1000:1020] = -1.
+        err = random_state.uniform(0., 0.01, len(waveobs))
+        err[random_state.randint(0, len(waveobs), 50)] = 0.
+        spectrum = ispec.create_spectrum_structure(waveobs, flux, err)
+        for to_resolution, from_resolution in ((47000, None), (47000, 80000), (5000, None)):
+            convolved_spectrum = ispec.convolve_spectrum(spectrum, to_resolution, from_resolution=from_resolution)
+            expected_flux, expected_err = _reference_convolve_spectrum(waveobs, flux, err, to_resolution, from_resolution=from_resolution)
+            np.testing.assert_equal(convolved_spectrum['waveobs'], waveobs)
+            np.testing.assert_allclose(convolved_spectrum['flux'], expected_flux, rtol=1e-12, atol=1e-15)
+            np.testing.assert_allclose(convolved_spectrum['err'], expected_err, rtol=1e-12, atol=1e-15)
+            # Gaps are not convolved
+            np.testing.assert_equal(convolved_spectrum['flux'][flux <= 1e-10], 0.)
+
+    def test_convolve_spectrum_fft(self):
+        waveobs = np.arange(480., 490., 0.001)
+        flux = 1. - 0.6*np.exp(-(waveobs - 483.)**2/(2*0.01**2)) - 0.3*np.exp(-(waveobs - 487.)**2/(2*0.02**2))
+        flux[5000:5010] = 0.
+        err = np.ones(len(waveobs))*0.01
+        spectrum = ispec.create_spectrum_structure(waveobs, flux, err)
+        inner = slice(100, -100)
+        for to_resolution, from_resolution in ((47000, None), (20000, 80000)):
+            direct_spectrum = ispec.convolve_spectrum(spectrum, to_resolution, from_resolution=from_resolution, method="direct")
+            fft_spectrum = ispec.convolve_spectrum(spectrum, to_resolution, from_resolution=from_resolution, method="fft")
+            np.testing.assert_equal(fft_spectrum['waveobs'], waveobs)
+            np.testing.assert_allclose(fft_spectrum['flux'][inner], direct_spectrum['flux'][inner], atol=5e-3)
+            np.testing.assert_allclose(fft_spectrum['err'][inner], direct_spectrum['err'][inner], atol=1e-4)
+            # Gaps are not convolved
+            np.testing.assert_equal(fft_spectrum['flux'][5000:5010], 0.)
+        self.assertRaises(Exception, ispec.convolve_spectrum, spectrum, 47000, method="unknown")
@@ -1,5 +1,7 @@
 import os
 import sys
+import shutil
+import tempfile
 import unittest
 import numpy as np
 
@@ -167,3 +169,446 @@ class TestSynthesis(unittest.TestCase):
         np.testing.assert_almost_equal(interpolated_spectrum['waveobs'][:10], np.array([515.   , 515.001, 515.002, 515.003, 515.004, 515.005, 515.006, 515.007, 515.008, 515.009]))
 
 
+
+    def test_apply_post_fundamental_effects_fused(self):
+        from ispec.synth.effects import _broadening_kernel
+        waveobs = np.arange(515., 520., 0.001)
+        fluxes = 1. - 0.6*np.exp(-(waveobs - 516.)**2/(2*0.01**2)) - 0.3*np.exp(-(waveobs - 518.)**2/(2*0.02**2))
+        inner = slice(100, -100)
+        _broadening_kernel.cache_clear()
+        for macroturbulence, vsini, resolution in ((3.0, 2.0, 47000), (5.0, 10.0, 20000), (3.0, 2.0, 0)):
+            direct = ispec.apply_post_fundamental_effects(waveobs, fluxes.copy(), None, macroturbulence=macroturbulence, vsini=vsini, limb_darkening_coeff=0.6, R=resolution)
+            for i in range(2):
+                fused = ispec.apply_post_fundamental_effects(waveobs, fluxes.copy(), None, macroturbulence=macroturbulence, vsini=vsini, limb_darkening_coeff=0.6, R=resolution, convolution_method="fused")
+                np.testing.assert_allclose(fused[inner], direct[inner], atol=1e-4)
+        cache_info = _broadening_kernel.cache_info()
+        self.assertEqual(cache_info.misses, 3)
+        self.assertEqual(cache_info.hits, 3)
+
+    def test_apply_post_fundamental_effects_cache(self):
+        from ispec.synth.effects import precomputation_cache_info, clear_precomputation_cache, _interpolate_with_plan, _resampling_plan
+        waveobs = np.arange(515., 520., 0.001)
+        fluxes = 1. - 0.6*np.exp(-(waveobs - 516.)**2/(2*0.01**2))
+        spectrum = ispec.create_spectrum_structure(waveobs, fluxes)
+        clear_precomputation_cache()
+        velocity_step, waveobs_uniform_in_velocity, to_uniform, from_uniform = _resampling_plan(spectrum)
+        np.testing.assert_allclose(_interpolate_with_plan(to_uniform, fluxes), np.interp(waveobs_uniform_in_velocity, waveobs, fluxes, left=0., right=0.), rtol=0, atol=1e-15)
+        np.testing.assert_allclose(_interpolate_with_plan(from_uniform, np.ones(len(waveobs_uniform_in_velocity))), np.interp(waveobs, waveobs_uniform_in_velocity, np.ones(len(waveobs_uniform_in_velocity)), left=0., right=0.), rtol=0, atol=1e-15)
+        for vsini in (2.0, 2.0, 3.0):
+            ispec.apply_post_fundamental_effects(waveobs, fluxes.copy(), None, macroturbulence=3.0, vsini=vsini, limb_darkening_coeff=0.6, R=0)
+        cache_info = precomputation_cache_info()
+        self.assertEqual(cache_info['resampling_plans']['misses'], 1)
+        self.assertEqual(cache_info['resampling_plans']['hits'], 3)
+        self.assertEqual(cache_info['rotation_kernels']['misses'], 2)
+        self.assertEqual(cache_info['rotation_kernels']['hits'], 1)
+        self.assertEqual(cache_info['vmac_kernels']['misses'], 1)
+        self.assertEqual(cache_info['vmac_kernels']['hits'], 2)
+        # A different grid is not confused with the cached one
+        other_waveobs = waveobs.copy()
+        other_waveobs[1000] += 1e-5
+        other_spectrum = ispec.create_spectrum_structure(other_waveobs, fluxes)
+        self.assertFalse(np.array_equal(_resampling_plan(other_spectrum)[3][1], from_uniform[1]))
+
+    def test_synthesis_cache(self):
+        import tempfile
+        import shutil
+        from unittest import mock
+        cache_dir = tempfile.mkdtemp()
+        try:
+            waveobs = np.arange(515., 520., 0.01)
+            linelist = np.zeros(3, dtype=[('wave_nm', float), ('loggf', float), ('spectrum_support', 'U1')])
+            linelist['wave_nm'] = (515.5, 517., 530.)
+            linelist['loggf'] = (-1., -2., -1.5)
+            linelist['spectrum_support'] = ("T", "T", "T")
+            abundances = np.zeros(2, dtype=[('code', int), ('Abund', float)])
+            abundances['code'] = (1, 26)
+            abundances['Abund'] = (0., -4.5)
+            atmosphere_layers = np.ones((10, 9))
+            calls = []
+            def generate_fundamental_spectrum(waveobs, atmosphere_layers, teff, *args, **kwargs):
+                calls.append(teff)
+                return 1. - (teff/10000.) * np.exp(-(waveobs - 517.)**2 / (2*0.05**2))
+
+            cache = ispec.SynthesisCache(cache_dir)
+            with mock.patch('ispec.synth.spectrum.generate_fundamental_spectrum', side_effect=generate_fundamental_spectrum):
+                fluxes = ispec.generate_fundamental_spectrum(waveobs, atmosphere_layers, 5000, 4.0, 0., 0., linelist, None, abundances, None, 1.0, cache=cache)
+                # Numpy scalars and another instance of the cache in the same directory
+                cached_fluxes = ispec.generate_fundamental_spectrum(waveobs, atmosphere_layers.copy(), np.float64(5000.), 4.0, 0., 0., linelist.copy(), None, abundances, None, 1.0, cache=cache_dir)
+                np.testing.assert_array_equal(fluxes, cached_fluxes)
+                self.assertEqual(calls, [5000])
+                # Lines outside the synthesized range do not affect the result
+                linelist['loggf'][2] = -3.
+                ispec.generate_fundamental_spectrum(waveobs, atmosphere_layers, 5000, 4.0, 0., 0., linelist, None, abundances, None, 1.0, cache=cache)
+                self.assertEqual(calls, [5000])
+                # Any other change in the inputs does
+                linelist['loggf'][0] = -1.1
+                ispec.generate_fundamental_spectrum(waveobs, atmosphere_layers, 5000, 4.0, 0., 0., linelist, None, abundances, None, 1.0, cache=cache)
+                ispec.generate_fundamental_spectrum(waveobs, atmosphere_layers, 5000, 4.0, 0., 0., linelist, None, abundances, None, 1.1, cache=cache)
+                ispec.generate_fundamental_spectrum(waveobs[:-1], atmosphere_layers, 5000, 4.0, 0., 0., linelist, None, abundances, None, 1.1, cache=cache)
+                self.assertEqual(len(calls), 4)
+
+            # Nested inputs with the same items do not share the key
+            import hashlib
+            from ispec.synth.cache import _hash_update
+            def digest(value):
+                h = hashlib.sha1()
+                _hash_update(h, value)
+                return h.hexdigest()
+            self.assertNotEqual(digest(([1, 2], [3])), digest(([1], [2, 3])))
+            self.assertNotEqual(digest([[1], 2]), digest([1, [2]]))
+            self.assertNotEqual(digest([[], 1]), digest([1, []]))
+            self.assertEqual(digest([1, (2., 3)]), digest([1., (np.float64(2.), np.int64(3))]))
+
+            # Least recently used spectra are removed when the cache is full
+            cache.clear()
+            self.assertEqual(cache.size(), 0)
+            keys = [cache.key(waveobs, None, teff, 4.0, 0., 0., None, None, None, None, 1.0) for teff in (4000, 4500, 5500)]
+            cache.put(keys[0], waveobs)
+            size = cache.size()
+            small_cache = ispec.SynthesisCache(cache_dir, max_size=2*size)
+            small_cache.put(keys[1], waveobs)
+            os.utime(os.path.join(cache_dir, keys[0] + ".npy"), (0, 0))
+            os.utime(os.path.join(cache_dir, keys[1] + ".npy"), (1, 1))
+            small_cache.get(keys[0])
+            small_cache.put(keys[2], waveobs)
+            self.assertIsNotNone(small_cache.get(keys[0]))
+            self.assertIsNone(small_cache.get(keys[1]))
+            np.testing.assert_array_equal(small_cache.get(keys[2]), waveobs)
+            self.assertEqual(small_cache.size(), 2*size)
+            # Spectra that cannot be registered (locked index) are not stored
+            from lockfile import LockTimeout
+            key = cache.key(waveobs, None, 6000, 4.0, 0., 0., None, None, None, None, 1.0)
+            with mock.patch('ispec.synth.cache.FileLock.acquire', side_effect=LockTimeout("Locked")):
+                small_cache.put(key, waveobs)
+            self.assertIsNone(small_cache.get(key))
+            self.assertEqual(sorted(os.listdir(cache_dir)), sorted([keys[0] + ".npy", keys[2] + ".npy", "index.json"]))
+        finally:
+            shutil.rmtree(cache_dir)
+
+    def test_post_fundamental_effects_derivatives(self):
+        from ispec.synth.effects import post_fundamental_effects_derivatives
+        waveobs = np.arange(515., 520., 0.001)
+        fluxes = 1. - 0.6*np.exp(-(waveobs - 516.)**2/(2*0.01**2)) - 0.3*np.exp(-(waveobs - 518.)**2/(2*0.02**2))
+        segments = np.array([(515., 517.5), (517.5, 520.)], dtype=[('wave_base', float), ('wave_top', float)])
+        parameters = {'macroturbulence': 3.0, 'vsini': 4.0, 'limb_darkening_coeff': 0.6, 'R': 47000}
+        vrad = (0., 1.5)
+        derivatives = post_fundamental_effects_derivatives(waveobs, fluxes, segments, vrad=vrad, **parameters)
+        inner = slice(200, -200)
+        for name, step in (('macroturbulence', 1e-4), ('vsini', 1e-4), ('R', 0.1)):
+            upper = dict(parameters)
+            upper[name] += step
+            lower = dict(parameters)
+            lower[name] -= step
+            numerical = (ispec.apply_post_fundamental_effects(waveobs, fluxes.copy(), segments, vrad=vrad, convolution_method="fused", **upper) \
+                        - ispec.apply_post_fundamental_effects(waveobs, fluxes.copy(), segments, vrad=vrad, convolution_method="fused", **lower)) / (2*step)
+            np.testing.assert_allclose(derivatives[name][inner], numerical[inner], rtol=0, atol=1e-3*np.max(np.abs(numerical)))
+        # Disabled broadening
+        derivatives = post_fundamental_effects_derivatives(waveobs, fluxes, None, macroturbulence=0., vsini=2.0, limb_darkening_coeff=0.6, R=0)
+        self.assertFalse(np.any(derivatives['macroturbulence']))
+        self.assertFalse(np.any(derivatives['R']))
+        self.assertTrue(np.any(derivatives['vsini']))
+
+    def test_fit_broadening_from_zero(self):
+        from unittest import mock
+        from ispec.modeling.ssf import SynthModel
+        import ispec.modeling.ssf
+        create_param_structure = getattr(ispec.modeling.ssf, "__create_param_structure")
+        waveobs = np.arange(515., 520., 0.002)
+        fluxes = 1. - 0.6*np.exp(-(waveobs - 516.)**2/(2*0.01**2)) - 0.3*np.exp(-(waveobs - 518.)**2/(2*0.02**2))
+        segments = np.array([(515., 520.)], dtype=[('wave_base', float), ('wave_top', float)])
+        observed_fluxes = ispec.apply_post_fundamental_effects(waveobs, fluxes.copy(), segments, macroturbulence=4.0, vsini=6.0, limb_darkening_coeff=0.6, R=47000)
+        # vmac and vsini start at zero (i.e. their lower limit, see estimate_initial_ap)
+        linelist_free_loggf = np.recarray((0,), dtype=[('loggf', float)])
+        parinfo = create_param_structure(5000., 3.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.6, 47000, np.zeros(1), ["vmac", "vsini"], [], linelist_free_loggf, (3500., 7000.), (0., 5.), (-2.5, 0.5), (-1.5, 1.5), (0., 50.), False, False)
+        def generate_fundamental_spectrum(waveobs, *args, **kwargs):
+            return fluxes.copy()
+        with mock.patch('ispec.modeling.ssf.generate_fundamental_spectrum', side_effect=generate_fundamental_spectrum), \
+                mock.patch('ispec.modeling.ssf.valid_interpolated_spectrum_target', return_value=True):
+            synth_model = SynthModel(None, None, None, linelist_free_loggf, None, grid=object())
+            synth_model.fitData(waveobs, segments, np.ones(len(waveobs)), observed_fluxes, parinfo=parinfo, code="grid", vmic_from_empirical_relation=False, vmac_from_empirical_relation=False)
+        self.assertAlmostEqual(synth_model.vmac(), 4.0, places=1)
+        self.assertAlmostEqual(synth_model.vsini(), 6.0, places=1)
+        # The parameters of the caller are not modified
+        self.assertEqual((parinfo[5]['value'], parinfo[6]['value']), (0., 0.))
+        self.assertFalse(any('mpside' in parameter for parameter in parinfo))
+
+    def test_generate_fundamental_spectrum_in_parallel(self):
+        from unittest import mock
+        waveobs = np.arange(400., 700., 0.01)
+        linelist = np.zeros(1, dtype=[('wave_nm', float), ('moog_support', 'U1')])
+        linelist['wave_nm'] = 500.
+        linelist['moog_support'] = "T"
+        abundances = np.zeros(2, dtype=[('code', int), ('Abund', float)])
+        abundances['code'] = (1, 26)
+        abundances['Abund'] = (0., -4.5)
+        regions = np.recarray((3,),  dtype=[('wave_base', float), ('wave_top', float)])
+        regions['wave_base'] = (480., 401., 690.)
+        regions['wave_top'] = (650., 410., 690.5)
+        def synthesized_wavelengths(waveobs, regions):
+            inside = np.zeros(len(waveobs), dtype=bool)
+            for region in regions:
+                inside = np.logical_or(inside, np.logical_and(waveobs >= region['wave_base'], waveobs <= region['wave_top']))
+            return inside
+        def generate_fundamental_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, linelist, *args, **kwargs):
+            # Like the wrappers: only the regions are synthesized and the joined
+            # pieces are resampled with zero edges
+            synth_waveobs = np.hstack([np.arange(region['wave_base'], region['wave_top']+0.005, 0.01) for region in kwargs['regions']])
+            synth_spectrum = ispec.create_spectrum_structure(synth_waveobs, 1. - 0.5*np.sin(synth_waveobs)**2)
+            synth_spectrum.sort(order=['waveobs'])
+            return ispec.resample_spectrum(synth_spectrum, waveobs, method="linear", zero_edges=True)['flux']
+        def generate_fundamental_spectrum_with_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, linelist, *args, **kwargs):
+            # SPECTRUM does not synthesize the masked wavelengths
+            inside = synthesized_wavelengths(waveobs, kwargs['regions'])
+            return np.where(inside, 1. - 0.5*np.sin(waveobs)**2, 1.)
+
+        inside = synthesized_wavelengths(waveobs, regions)
+        with mock.patch('ispec.synth.moog.generate_fundamental_spectrum', side_effect=generate_fundamental_spectrum):
+            serial_fluxes = ispec.generate_fundamental_spectrum(waveobs, None, 5000, 4.0, 0., 0., linelist, None, abundances, None, 1.0, regions=regions, code="moog")
+            parallel_fluxes = ispec.generate_fundamental_spectrum(waveobs, None, 5000, 4.0, 0., 0., linelist, None, abundances, None, 1.0, regions=regions, code="moog", workers=2)
+        # Same assembly as the serial synthesis: interpolated between regions
+        # (from the closest wavelengths instead of the ones synthesized by the
+        # code) and zero outside
+        np.testing.assert_allclose(parallel_fluxes[inside], serial_fluxes[inside], rtol=1e-4)
+        np.testing.assert_allclose(parallel_fluxes, serial_fluxes, rtol=1e-2)
+        self.assertTrue(np.all(parallel_fluxes[waveobs < 401.] == 0.))
+        self.assertTrue(np.all(parallel_fluxes[waveobs > 690.5] == 0.))
+        self.assertTrue(np.all(parallel_fluxes[np.logical_and(waveobs > 410., waveobs < 480.)] > 0.))
+
+        linelist['moog_support'] = "F"
+        linelist = np.lib.recfunctions.append_fields(linelist, 'spectrum_support', ["T"], usemask=False)
+        with mock.patch('ispec.synth.spectrum.generate_fundamental_spectrum', side_effect=generate_fundamental_spectrum_with_spectrum):
+            serial_fluxes = ispec.generate_fundamental_spectrum(waveobs, None, 5000, 4.0, 0., 0., linelist, None, abundances, None, 1.0, regions=regions, code="spectrum")
+            parallel_fluxes = ispec.generate_fundamental_spectrum(waveobs, None, 5000, 4.0, 0., 0., linelist, None, abundances, None, 1.0, regions=regions, code="spectrum", workers=2)
+        np.testing.assert_array_equal(parallel_fluxes[inside], serial_fluxes[inside])
+        self.assertTrue(np.all(parallel_fluxes[~inside] == 1.))
+
+        # Regions bigger than 100 nm are split like the radiative transfer codes do
+        from ispec.synth.common import _synthesis_segments
+        segments = _synthesis_segments(waveobs, regions)
+        np.testing.assert_array_equal(segments['wave_base'], (401., 480., 580., 690.))
+        np.testing.assert_allclose(segments['wave_top'], (410., 579.99, 650., 690.5))
+
+    def test_synthesis_worker(self):
+        from ispec.synth import spectrum
+        messages = []
+        class GUIQueue(object):
+            def put(self, data):
+                messages.append(data)
+            def join(self):
+                pass
+        status, result = spectrum._run_in_synthesis_worker(_worker_task, (np.arange(3.),), {'factor': 2.}, gui_queue=GUIQueue(), timeout=60)
+        self.assertEqual(status, "done")
+        np.testing.assert_array_equal(result[0], (0., 2., 4.))
+        self.assertEqual(messages, ["self.update_progress(50)"])
+        # The next synthesis is executed by another process forked in advance
+        first_pid = result[1]
+        self.assertTrue(spectrum._spare_synthesis_worker[1].is_alive())
+        status, result = spectrum._run_in_synthesis_worker(_worker_task, (np.arange(3.),), {}, timeout=60)
+        self.assertEqual(status, "done")
+        self.assertNotEqual(result[1], first_pid)
+
+        status, result = spectrum._run_in_synthesis_worker(_worker_task, (np.arange(3.),), {'crash': True}, timeout=60)
+        self.assertEqual(status, "failed")
+        self.assertIsNone(result)
+        status, result = spectrum._run_in_synthesis_worker(_worker_task, (np.arange(3.),), {'sleep': 60}, timeout=0.5)
+        self.assertEqual(status, "timeout")
+        self.assertIsNone(result)
+
+
+
+class TestSyntheticGrid(unittest.TestCase):
+
+    def setUp(self):
+        from test_atmospheres import _create_model_atmospheres
+        self.tmp_dir = tempfile.mkdtemp()
+        self.model = os.path.join(self.tmp_dir, "ATLAS9.Test")
+        _create_model_atmospheres(self.model)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_precompute_synthetic_grid_resume(self):
+        import json
+        from unittest import mock
+        output_dirname = os.path.join(self.tmp_dir, "precomputed_grid")
+        modeled_layers_pack = ispec.load_modeled_layers_pack(self.model)
+        ranges = np.recarray((3,),  dtype=[('teff', int), ('logg', float), ('MH', float), ('alpha', float), ('vmic', float)])
+        ranges['teff'] = (4500, 5000, 5000)
+        ranges['logg'] = (2.0, 2.5, 2.5)
+        ranges['MH'] = (0.0, -0.5, 0.0)
+        ranges['alpha'] = (0.0, 0.2, 0.0)
+        ranges['vmic'] = (1.0, 1.0, 1.0)
+        wavelengths = np.arange(515., 520., 0.01)
+        calls = []
+        failures = {4500: 1} # Number of times that the synthesis will fail
+        def generate_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, *args, **kwargs):
+            calls.append(teff)
+            if failures.get(teff, 0) > 0:
+                failures[teff] -= 1
+                return np.zeros(len(waveobs))
+            return 1. - (teff/10000.) * np.exp(-(waveobs - 517.)**2 / (2*0.05**2))
+
+        with mock.patch('ispec.synth.common.generate_spectrum', side_effect=generate_spectrum):
+            ispec.precompute_synthetic_grid(output_dirname, ranges, wavelengths, 20000, modeled_layers_pack, None, None, None, max_retries=1)
+            self.assertEqual(sorted(calls), [4500, 4500, 5000, 5000])
+            manifest = json.load(open(os.path.join(output_dirname, "manifest.json")))
+            self.assertTrue(all(task['status'] == 'done' for task in manifest['tasks']))
+            self.assertEqual(dict((task['teff'], task['attempts']) for task in manifest['tasks'] if task['MH'] == 0.0), {4500.: 2, 5000.: 1})
+            convolved_grid_filename = os.path.join(output_dirname, "convolved_grid_20000.fits.gz")
+            expected_reference_grid = ispec.synth.grid.fits.getdata(convolved_grid_filename)
+            self.assertEqual(expected_reference_grid.shape, (3, len(wavelengths)))
+
+            # Resume after a crash: only the missing spectrum is computed
+            os.remove(os.path.join(output_dirname, manifest['tasks'][1]['filename']))
+            os.remove(convolved_grid_filename)
+            del calls[:]
+            ispec.precompute_synthetic_grid(output_dirname, ranges, wavelengths, 20000, modeled_layers_pack, None, None, None, max_retries=1)
+            self.assertEqual(calls, [5000])
+            np.testing.assert_allclose(ispec.synth.grid.fits.getdata(convolved_grid_filename), expected_reference_grid)
+
+            # Spectra that always fail are given up (and the convolved grid is not complete)
+            failures[4000] = 10
+            ranges['teff'][0] = 4000
+            os.remove(convolved_grid_filename)
+            del calls[:]
+            ispec.precompute_synthetic_grid(output_dirname, ranges, wavelengths, 20000, modeled_layers_pack, None, None, None, max_retries=1)
+            self.assertEqual(calls, [4000, 4000])
+            manifest = json.load(open(os.path.join(output_dirname, "manifest.json")))
+            self.assertEqual([task['status'] for task in manifest['tasks']], ['failed', 'done', 'done'])
+            self.assertFalse(os.path.exists(convolved_grid_filename))
+
+    def test_estimate_initial_ap_candidates(self):
+        from unittest import mock
+        from astropy.io import fits
+        output_dirname = os.path.join(self.tmp_dir, "precomputed_grid")
+        modeled_layers_pack = ispec.load_modeled_layers_pack(self.model)
+        ranges = np.recarray((6,),  dtype=[('teff', int), ('logg', float), ('MH', float), ('alpha', float), ('vmic', float)])
+        ranges['teff'] = (4200, 4500, 4800, 5000, 5200, 5400)
+        ranges['logg'] = (1.5, 2.0, 2.5, 2.5, 2.0, 1.5)
+        ranges['MH'] = (0.0, -0.5, -0.2, 0.0, -0.8, -0.3)
+        ranges['alpha'] = 0.0
+        ranges['vmic'] = 1.0
+        wavelengths = np.arange(515., 520., 0.01)
+        def generate_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, *args, **kwargs):
+            return 1. - (teff/10000.) * np.exp(-(waveobs - 517.)**2 / (2*(0.03 + 0.01*logg)**2)) - 0.2 * (1 + MH) * np.exp(-(waveobs - 518.)**2 / (2*0.05**2))
+        with mock.patch('ispec.synth.common.generate_spectrum', side_effect=generate_spectrum):
+            ispec.precompute_synthetic_grid(output_dirname, ranges, wavelengths, 20000, modeled_layers_pack, None, None, None)
+        reference_grid = fits.getdata(os.path.join(output_dirname, "convolved_grid_20000.fits.gz"))
+        linemasks = np.recarray((2,),  dtype=[('wave_base', float), ('wave_top', float)])
+        linemasks['wave_base'] = (516.8, 517.8)
+        linemasks['wave_top'] = (517.2, 518.2)
+
+        # Observed spectra: grid rows with noise
+        random_state = np.random.RandomState(0)
+        spectra = []
+        for i in (1, 4, 2):
+            spectrum = ispec.create_spectrum_structure(wavelengths, reference_grid[i] + random_state.normal(0., 0.001, len(wavelengths)), np.full(len(wavelengths), 0.001))
+            spectra.append(spectrum)
+        candidates = ispec.estimate_initial_ap_candidates(spectra, output_dirname, 20000, linemasks, top_k=3, chunk_size=2)
+        self.assertEqual(len(candidates), 3)
+        fsegment = ispec.create_wavelength_filter(spectra[0], regions=linemasks)
+        for i, spectrum, candidate in zip((1, 4, 2), spectra, candidates):
+            self.assertEqual((candidate['teff'][0], candidate['logg'][0], candidate['MH'][0]), (ranges['teff'][i], ranges['logg'][i], ranges['MH'][i]))
+            # Weighted chi-square over the whole grid
+            expected_chisq = np.sum(((reference_grid[:, fsegment] - spectrum['flux'][fsegment]) / spectrum['err'][fsegment])**2, axis=1)
+            np.testing.assert_allclose(candidate['chi2'], np.sort(expected_chisq)[:3], rtol=1e-6)
+            # Same results with one spectrum at a time (without errors, not weighted) and the whole grid in one chunk
+            unweighted_candidate = ispec.estimate_initial_ap_candidates(ispec.create_spectrum_structure(spectrum['waveobs'], spectrum['flux']), output_dirname, 20000, linemasks, top_k=3)[0]
+            np.testing.assert_allclose(unweighted_candidate['chi2'], candidate['chi2'] * 0.001**2, rtol=1e-6)
+            np.testing.assert_array_equal(unweighted_candidate['teff'], candidate['teff'])
+            self.assertEqual(ispec.estimate_initial_ap(spectrum, output_dirname, 20000, linemasks)[:3], (ranges['teff'][i], ranges['logg'][i], ranges['MH'][i]))
+        # A pixel without error has the median weight (the rest of the spectrum is still weighted)
+        spectrum = spectra[0].copy()
+        spectrum['err'][fsegment] = random_state.uniform(0.0005, 0.002, np.sum(fsegment))
+        ipixel = np.where(fsegment)[0][10]
+        spectrum['err'][ipixel] = 0.
+        weights = 1. / spectrum['err'][fsegment]**2
+        weights[weights == np.inf] = np.median(weights[weights != np.inf])
+        expected_chisq = np.sum((reference_grid[:, fsegment] - spectrum['flux'][fsegment])**2 * weights, axis=1)
+        candidate = ispec.estimate_initial_ap_candidates(spectrum, output_dirname, 20000, linemasks, top_k=3)[0]
+        np.testing.assert_allclose(candidate['chi2'], np.sort(expected_chisq)[:3], rtol=1e-6)
+        # Grids without the uncompressed copy (i.e. older grids) are converted once
+        memmap_filename = os.path.join(output_dirname, "convolved_grid_20000.npy")
+        os.remove(memmap_filename)
+        os.remove(os.path.join(output_dirname, "convolved_grid_20000.npz"))
+        self.assertEqual(ispec.estimate_initial_ap(spectra[0], output_dirname, 20000, linemasks)[:3], (ranges['teff'][1], ranges['logg'][1], ranges['MH'][1]))
+        np.testing.assert_array_equal(np.load(memmap_filename), reference_grid)
+        # Read-only directories (e.g. shared grids): the FITS file is read in memory
+        os.remove(memmap_filename)
+        os.remove(os.path.join(output_dirname, "convolved_grid_20000.npz"))
+        with mock.patch('numpy.lib.format.open_memmap', side_effect=PermissionError("Read-only file system")):
+            self.assertEqual(ispec.estimate_initial_ap(spectra[0], output_dirname, 20000, linemasks)[:3], (ranges['teff'][1], ranges['logg'][1], ranges['MH'][1]))
+        self.assertEqual([filename for filename in os.listdir(output_dirname) if filename.startswith("convolved_grid_20000.npy")], [])
+
+    def test_convolved_grid_index(self):
+        from unittest import mock
+        from astropy.io import fits
+        from ispec.synth.grid import _load_convolved_grid_index
+        output_dirname = os.path.join(self.tmp_dir, "precomputed_grid")
+        modeled_layers_pack = ispec.load_modeled_layers_pack(self.model)
+        teffs, loggs, MHs = np.meshgrid((4200, 4500, 4800, 5100, 5400), (1.5, 2.0, 2.5), (-0.8, -0.4, 0.0), indexing="ij")
+        ranges = np.recarray((teffs.size,),  dtype=[('teff', int), ('logg', float), ('MH', float), ('alpha', float), ('vmic', float)])
+        ranges['teff'] = teffs.ravel()
+        ranges['logg'] = loggs.ravel()
+        ranges['MH'] = MHs.ravel()
+        ranges['alpha'] = 0.0
+        ranges['vmic'] = 1.0
+        wavelengths = np.arange(515., 520., 0.01)
+        linemasks = np.recarray((2,),  dtype=[('wave_base', float), ('wave_top', float)])
+        linemasks['wave_base'] = (516.8, 517.8)
+        linemasks['wave_top'] = (517.2, 518.2)
+        def generate_spectrum(waveobs, atmosphere_layers, teff, logg, MH, alpha, *args, **kwargs):
+            return 1. - (teff/10000.) * np.exp(-(waveobs - 517.)**2 / (2*(0.03 + 0.01*logg)**2)) - 0.2 * (1 + MH) * np.exp(-(waveobs - 518.)**2 / (2*0.05**2))
+        with mock.patch('ispec.synth.common.generate_spectrum', side_effect=generate_spectrum):
+            ispec.precompute_synthetic_grid(output_dirname, ranges, wavelengths, 20000, modeled_layers_pack, None, None, None, index_linemasks=linemasks)
+        self.assertTrue(os.path.exists(os.path.join(output_dirname, "convolved_grid_20000.index.npz")))
+        reference_grid = fits.getdata(os.path.join(output_dirname, "convolved_grid_20000.fits.gz"))
+
+        random_state = np.random.RandomState(0)
+        rows = random_state.randint(0, len(ranges), 10)
+        spectra = [ispec.create_spectrum_structure(wavelengths, reference_grid[i] + random_state.normal(0., 0.001, len(wavelengths)), np.full(len(wavelengths), 0.001)) for i in rows]
+        candidates = ispec.estimate_initial_ap_candidates(spectra, output_dirname, 20000, linemasks, top_k=1, index_neighbours=3)
+        expected_candidates = ispec.estimate_initial_ap_candidates(spectra, output_dirname, 20000, linemasks, top_k=1, use_index=False)
+        for i, candidate, expected_candidate in zip(rows, candidates, expected_candidates):
+            self.assertEqual((candidate['teff'][0], candidate['logg'][0], candidate['MH'][0]), (ranges['teff'][i], ranges['logg'][i], ranges['MH'][i]))
+            np.testing.assert_allclose(candidate['chi2'], expected_candidate['chi2'], rtol=1e-10)
+
+        # Other linemasks do not use the index
+        isegment = np.where(ispec.create_wavelength_filter(spectra[0], regions=linemasks))[0]
+        self.assertIsNotNone(_load_convolved_grid_index(output_dirname, 20000, isegment))
+        self.assertIsNone(_load_convolved_grid_index(output_dirname, 20000, isegment[1:]))
+        other_linemasks = linemasks[:1]
+        candidate = ispec.estimate_initial_ap_candidates(spectra[0], output_dirname, 20000, other_linemasks, top_k=1)[0]
+        self.assertEqual(candidate['teff'][0], ranges['teff'][rows[0]])
+
+    def test_convolved_grid_principal_components(self):
+        from unittest import mock
+        import ispec.synth.grid
+        principal_components = getattr(ispec.synth.grid, "__principal_components")
+        # Low rank grid with noise
+        random_state = np.random.RandomState(0)
+        for npoints, npixels in ((50, 200), (200, 50)):
+            grid_fluxes = np.dot(random_state.normal(size=(npoints, 3)) * (10., 5., 2.), random_state.normal(size=(3, npixels))) + random_state.normal(0., 0.01, (npoints, npixels))
+            isegment = np.arange(npixels)
+            mean = np.mean(grid_fluxes, axis=0)
+            centered = grid_fluxes - mean
+            eigenvalues, eigenvectors = np.linalg.eigh(np.dot(centered.T, centered))
+            expected_components = eigenvectors[:, ::-1][:, :3].T
+            # Exact (Gram matrix of the points or the pixels) and randomized
+            results = [principal_components(grid_fluxes, isegment, mean, 3, 16)]
+            with mock.patch('ispec.synth.grid._MAX_EXACT_PCA_SIZE', 10):
+                results.append(principal_components(grid_fluxes, isegment, mean, 3, 16))
+            for components, component_eigenvalues, total_variance in results:
+                np.testing.assert_allclose(np.abs(np.sum(components * expected_components, axis=1)), 1., rtol=1e-6)
+                np.testing.assert_allclose(component_eigenvalues, eigenvalues[::-1][:3], rtol=1e-6)
+                self.assertAlmostEqual(total_variance, np.sum(centered**2))
+
+
+def _worker_task(update_progress_func, values, factor=1., crash=False, sleep=0):
+    import time
+    update_progress_func(50)
+    if crash:
+        # Like SPECTRUM's exit calls
+        os._exit(1)
+    time.sleep(sleep)
+    return values*factor, os.getpid()